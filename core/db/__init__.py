@@ -114,6 +114,12 @@ class Database(object):
         dbsession.commit()
         return obj
 
+    @transaction
+    def add_all(self, objs, dbsession=None):
+        dbsession.add_all(objs)
+        dbsession.commit()
+        return objs
+
     @transaction
     def update(self, obj, dbsession=None):
         dbsession.merge(obj)
@@ -122,6 +128,12 @@ class Database(object):
         dbsession.flush()
         return updated_obj
 
+    @transaction
+    def update_fields(self, cls, obj_id, fields, dbsession=None):
+        dbsession.query(cls).filter_by(id=obj_id).update(
+            fields, synchronize_session=False)
+        dbsession.commit()
+
     def refresh(self, obj):
         obj_state = inspect(obj)
         if obj_state.detached:
@@ -0,0 +1,144 @@
+# coding: utf-8
+
+import time
+import logging
+from threading import Thread, Lock, Event
+
+from core.config import config
+from core.utils.graphite import send_metrics
+
+log = logging.getLogger(__name__)
+
+
+class LogJournal(Thread):
+    """
+    Write-behind journal for session log steps and sub-steps.
+    Records are kept in memory and written by one transaction every
+    flush_interval seconds or as soon as flush_size records are queued.
+    When maxsize records are queued the writer flushes them itself,
+    but not more often than every retry_interval seconds after a failed
+    flush. The journal never keeps more than maxsize records: while
+    database is down the oldest ones are dropped and counted.
+
+    Records are added to the transaction as ORM objects, so every row
+    is still inserted by its own INSERT statement: ids of steps and
+    sub-steps are needed after they are written (screenshot paths,
+    updates of run_script sub-steps), and neither a multi-row INSERT
+    nor executemany returns them with SQLAlchemy 0.9.
+    """
+    def __init__(self, database, flush_interval=None, flush_size=None,
+                 maxsize=None, retry_interval=None):
+        Thread.__init__(self)
+        self.running = True
+        self.daemon = True
+        self.database = database
+        self.flush_interval = flush_interval or getattr(
+            config, "LOG_JOURNAL_FLUSH_INTERVAL", 0.2)
+        self.flush_size = flush_size or getattr(
+            config, "LOG_JOURNAL_FLUSH_SIZE", 50)
+        self.maxsize = maxsize or getattr(
+            config, "LOG_JOURNAL_MAXSIZE", 1000)
+        self.retry_interval = retry_interval or getattr(
+            config, "LOG_JOURNAL_RETRY_INTERVAL", 1)
+        self.records = []
+        self.dropped = 0
+        self.failed_at = 0
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.wakeup = Event()
+
+    def __len__(self):
+        return len(self.records)
+
+    def pending(self, record):
+        """
+        :return: True if record is queued and not taken by flush yet,
+                 so it will be written with its current state
+        """
+        with self.lock:
+            return any(r is record for r in self.records)
+
+    def put(self, record):
+        with self.lock:
+            self.records.append(record)
+            size = len(self.records)
+
+        if size >= self.maxsize:
+            if time.time() - self.failed_at >= self.retry_interval:
+                log.warning("Log journal is full (%s records), "
+                            "flushing in request thread" % size)
+                try:
+                    self.flush()
+                except Exception as e:
+                    # records are kept, journal thread will retry
+                    log.exception("Log journal flush failed: %s" % e)
+            with self.lock:
+                dropped = self._trim()
+            self._report_dropped(dropped)
+        elif size >= self.flush_size:
+            self.wakeup.set()
+
+    def _trim(self):
+        excess = max(len(self.records) - self.maxsize, 0)
+        del self.records[:excess]
+        self.dropped += excess
+        return excess
+
+    def _report_dropped(self, count):
+        if count:
+            log.warning("Log journal is full, %s oldest records were "
+                        "dropped (%s in total)" % (count, self.dropped))
+            send_metrics("log_journal.dropped", count)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                records, self.records = self.records, []
+
+            # sub-steps may be queued before their step got an id
+            orphans = [r for r in records if not has_parent_id(r)]
+            records = [r for r in records if has_parent_id(r)]
+
+            batches = [batch for batch in (records, orphans) if batch]
+            while batches:
+                for record in batches[0]:
+                    set_parent_id(record)
+                try:
+                    self.database.add_all(batches[0])
+                except:
+                    self.failed_at = time.time()
+                    with self.lock:
+                        self.records[:0] = sum(batches, [])
+                        dropped = self._trim()
+                    self._report_dropped(dropped)
+                    raise
+                batches.pop(0)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception("Log journal flush failed: %s" % e)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        log.info("LogJournal stopped")
+
+
+def has_parent_id(record):
+    parent = getattr(record, "parent", None)
+    return parent is None or parent.id is not None \
+        or record.session_log_step_id is not None
+
+
+def set_parent_id(record):
+    parent = getattr(record, "parent", None)
+    if parent is not None and record.session_log_step_id is None:
+        record.session_log_step_id = parent.id
@@ -25,7 +25,33 @@ class FeaturesMixin(object):
         current_app.database.refresh(self)
 
 
-class SessionLogSubStep(Base, FeaturesMixin):
+class JournalMixin(FeaturesMixin):
+    """
+    Objects are written through current_app.journal if it is enabled.
+    """
+    @property
+    def journal(self):
+        return getattr(current_app, "journal", None)
+
+    def add(self):
+        if self.journal is not None:
+            self.journal.put(self)
+        else:
+            super(JournalMixin, self).add()
+
+    def save(self):
+        if self.journal is not None and self.journal.pending(self):
+            # not written yet, journal will write its current state
+            return
+        self.flush()
+        super(JournalMixin, self).save()
+
+    def flush(self):
+        if self.id is None and self.journal is not None:
+            self.journal.flush()
+
+
+class SessionLogSubStep(Base, JournalMixin):
     __tablename__ = 'sub_steps'
 
     id = Column(Integer, Sequence('sub_steps_id_seq'), primary_key=True)
@@ -38,15 +64,16 @@ class SessionLogSubStep(Base, FeaturesMixin):
     body = Column(String)
     created = Column(DateTime, default=datetime.now)
 
-    def __init__(self, control_line, body=None, parent_id=None):
+    def __init__(self, control_line, body=None, parent_id=None, parent=None):
         self.control_line = control_line
         self.body = body
         if parent_id:
             self.session_log_step_id = parent_id
+        self.parent = parent
         self.add()
 
 
-class SessionLogStep(Base, FeaturesMixin):
+class SessionLogStep(Base, JournalMixin):
     __tablename__ = 'session_log_steps'
 
     id = Column(Integer, Sequence('session_log_steps_id_seq'),
@@ -81,7 +108,8 @@ class SessionLogStep(Base, FeaturesMixin):
     def add_sub_step(self, control_line, body):
         return SessionLogSubStep(control_line=control_line,
                                  body=body,
-                                 parent_id=self.id)
+                                 parent_id=self.id,
+                                 parent=self)
 
 
 class Session(Base, FeaturesMixin):
@@ -100,6 +128,7 @@ class Session(Base, FeaturesMixin):
     modified = Column(DateTime, default=datetime.now)
     deleted = Column(DateTime)
     selenium_log = Column(String)
+    artifacts = Column(String)
 
     # State
     status = Column(Enum('unknown', 'running', 'succeed', 'failed', 'waiting',
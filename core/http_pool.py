@@ -0,0 +1,158 @@
+# coding: utf-8
+
+import logging
+
+from Queue import Queue
+from StringIO import StringIO
+from requests.structures import CaseInsensitiveDict
+
+from twisted.internet import reactor
+from twisted.internet.error import TimeoutError
+from twisted.python import threadable
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, \
+    PartialDownloadError, readBody
+from twisted.web.http_headers import Headers
+
+from core.config import config
+
+log = logging.getLogger(__name__)
+
+HOP_BY_HOP_HEADERS = ("connection", "keep-alive")
+
+
+def remove_hop_by_hop_headers(headers):
+    for key in list(headers.keys()):
+        if key.lower() in HOP_BY_HOP_HEADERS:
+            del headers[key]
+    return headers
+
+
+def to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def make_headers(headers):
+    _headers = Headers()
+    for key, value in (headers or {}).items():
+        # Content-Length is set by agent from body producer
+        if key.lower() == "content-length":
+            continue
+        _headers.addRawHeader(to_bytes(key), to_bytes(value))
+    return _headers
+
+
+def parse_headers(headers):
+    return CaseInsensitiveDict(
+        (key.lower(), ", ".join(values))
+        for key, values in headers.getAllRawHeaders()
+    )
+
+
+class EndpointHTTPPool(object):
+    """
+    Keep-alive http connections to one endpoint, served by the reactor.
+    Connections which were not used for idle_timeout seconds are closed.
+    """
+    def __init__(self, host, maxsize=None, idle_timeout=None, _reactor=None):
+        self.host = host
+        self.reactor = _reactor or reactor
+        self.pool = HTTPConnectionPool(self.reactor, persistent=True)
+        self.pool.maxPersistentPerHost = maxsize or getattr(
+            config, "HTTP_POOL_MAXSIZE", 10)
+        self.pool.cachedConnectionTimeout = idle_timeout or getattr(
+            config, "HTTP_POOL_IDLE_TIMEOUT", 60)
+        self.agent = Agent(self.reactor, pool=self.pool)
+        self.pending = set()
+        self.closed = False
+
+    def __repr__(self):
+        return "<EndpointHTTPPool host:%s pending:%s>" % (
+            self.host, len(self.pending))
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        """
+        Must be called in reactor thread.
+        :return: Deferred fired with (status, headers, body)
+        """
+        if self.closed:
+            raise RuntimeError("Http pool for %s is closed" % self.host)
+
+        body = FileBodyProducer(StringIO(to_bytes(data or "")))
+        d = self.agent.request(
+            to_bytes(method), to_bytes(url), make_headers(headers), body
+        )
+        self.pending.add(d)
+
+        timeout_call = None
+        if timeout:
+            timeout_call = self.reactor.callLater(timeout, d.cancel)
+
+        def read_response(response):
+            return readBody(response).addErrback(
+                partial_body
+            ).addCallback(
+                lambda content: (
+                    response.code, parse_headers(response.headers), content
+                )
+            )
+
+        def partial_body(failure):
+            # server closed connection without content-length
+            failure.trap(PartialDownloadError)
+            return failure.value.response
+
+        def done(result):
+            self.pending.discard(d)
+            if timeout_call is not None:
+                if timeout_call.active():
+                    timeout_call.cancel()
+                elif not isinstance(result, tuple):
+                    raise TimeoutError("No response for %s in %s sec" %
+                                       (url, timeout))
+            return result
+
+        d.addCallback(read_response)
+        d.addBoth(done)
+        return d
+
+    def request_from_thread(self, *args, **kwargs):
+        """
+        Schedule request in reactor thread.
+        :return: Queue which gets (status, headers, body) or Failure
+        """
+        if threadable.isInIOThread():
+            raise RuntimeError("Blocking request in reactor thread")
+
+        result = Queue(maxsize=1)
+
+        def send():
+            try:
+                d = self.request(*args, **kwargs)
+            except Exception as e:
+                result.put(e)
+            else:
+                d.addBoth(result.put)
+
+        self.reactor.callFromThread(send)
+        return result
+
+    def _close(self):
+        for d in list(self.pending):
+            d.cancel()
+        self.pending.clear()
+        return self.pool.closeCachedConnections()
+
+    def close(self):
+        """
+        Cancel pending requests and close kept-alive connections.
+        Can be called from any thread.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if threadable.isInIOThread():
+            self._close()
+        else:
+            self.reactor.callFromThread(self._close)
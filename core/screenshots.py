@@ -0,0 +1,426 @@
+# coding: utf-8
+
+import os
+import time
+import errno
+import base64
+import hashlib
+import logging
+import tempfile
+import threading
+
+from StringIO import StringIO
+from threading import Lock
+from collections import OrderedDict
+from functools import partial
+from itertools import count
+from multiprocessing import Pool, cpu_count
+
+from PIL import Image
+
+from core.config import config
+from core.utils.graphite import send_metrics
+
+log = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTH = 128
+
+
+def thumbnail_path(path, postfix="_thumb"):
+    return path.split('.png')[0] + "%s.png" % postfix
+
+
+def resize(content, width, height=None):
+    img = Image.open(StringIO(content))
+    if not height:
+        height = int(img.size[1] * width / float(img.size[0]))
+
+    output = StringIO()
+    img.resize((width, height), Image.ANTIALIAS).save(output, "PNG")
+    return output.getvalue()
+
+
+def eager_thumbnail_width():
+    if getattr(config, "SCREENSHOT_EAGER_THUMBNAILS", False):
+        return THUMBNAIL_WIDTH
+    return None
+
+
+def blobs_dir():
+    return os.path.join(config.SCREENSHOTS_DIR, "blobs")
+
+
+def blob_path(key):
+    return os.path.join(blobs_dir(), key[:2], "%s.png" % key)
+
+
+def perceptual_hash(content, size=16):
+    """
+    Difference hash: near-identical images have the same hash.
+    """
+    img = Image.open(StringIO(content)).convert("L").resize(
+        (size + 1, size), Image.ANTIALIAS)
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            offset = row * (size + 1) + col
+            bits = bits << 1 | (pixels[offset] > pixels[offset + 1])
+    return "p%0*x" % (size * size / 4, bits)
+
+
+def blob_key(content):
+    if getattr(config, "SCREENSHOT_PERCEPTUAL_HASH", False):
+        try:
+            return perceptual_hash(
+                content, getattr(config, "SCREENSHOT_PERCEPTUAL_HASH_SIZE", 16)
+            )
+        except IOError:
+            pass
+    return hashlib.sha1(content).hexdigest()
+
+
+def make_dirs(path):
+    # same directory can be made by another thread at the same time
+    if os.path.isdir(path):
+        return
+    try:
+        os.makedirs(path)
+        os.chmod(path, 0777)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def write_blob(path, content):
+    # blob is written to unique temp file and renamed into place,
+    # so other threads and processes never link partial one
+    basedir = os.path.dirname(path)
+    make_dirs(basedir)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=basedir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(temp_path, 0777)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def link(source, path):
+    make_dirs(os.path.dirname(path))
+    temp_path = "%s.%s.%s.tmp" % (
+        path, os.getpid(), threading.current_thread().ident)
+    os.link(source, temp_path)
+    os.rename(temp_path, path)
+
+
+def process_screenshot(path, screenshot, thumbnail_width=None, queued=None):
+    """
+    Decodes base64 screenshot, writes it and its thumbnail.
+    With SCREENSHOT_BLOBS screenshot is written once to blob store
+    and path is hard link to blob, so link count of blob is
+    count of its references.
+    Runs in pool process, so errors are returned instead of raised.
+    :return: path, time of every stage in ms, error
+    """
+    def elapsed(since):
+        return int((time.time() - since) * 1000)
+
+    timings = {}
+    start = time.time()
+    if queued:
+        timings["queue_wait"] = elapsed(queued)
+    try:
+        content = base64.b64decode(screenshot)
+        timings["decode"] = elapsed(start)
+
+        target = path
+        if getattr(config, "SCREENSHOT_BLOBS", True):
+            start = time.time()
+            target = blob_path(blob_key(content))
+            timings["hash"] = elapsed(start)
+
+        start = time.time()
+        if target == path or not os.path.isfile(target):
+            write_blob(target, content)
+            timings["write"] = elapsed(start)
+
+        if thumbnail_width and (
+                target == path or not os.path.isfile(thumbnail_path(target))):
+            start = time.time()
+            try:
+                thumbnail = resize(content, thumbnail_width)
+            except IOError:
+                log.debug("Can\'t resize image '%s'" % path)
+            else:
+                write_blob(thumbnail_path(target), thumbnail)
+            timings["thumbnail"] = elapsed(start)
+
+        if target != path:
+            start = time.time()
+            try:
+                link(target, path)
+            except OSError as e:
+                # blob was deleted as unused after it was checked
+                if e.errno != errno.ENOENT:
+                    raise
+                write_blob(target, content)
+                link(target, path)
+            if thumbnail_width and os.path.isfile(thumbnail_path(target)):
+                try:
+                    link(thumbnail_path(target), thumbnail_path(path))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            timings["link"] = elapsed(start)
+    except Exception as e:
+        return path, timings, "%s" % e
+
+    return path, timings, None
+
+
+def delete_unused_blobs(grace_period=3600):
+    """
+    Deletes blobs which are not linked by any session.
+    Blobs linked less than grace_period seconds ago are kept,
+    they can be linked by screenshot being saved now.
+    """
+    deleted = 0
+    deadline = time.time() - grace_period
+    for dirpath, _, filenames in os.walk(blobs_dir()):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+                if stat.st_nlink == 1 and stat.st_ctime < deadline:
+                    os.remove(path)
+                    deleted += 1
+            except OSError as e:
+                log.info("Unable to delete %s (%s)" % (path, e.strerror))
+    log.info("%s unused screenshot blobs have been deleted" % deleted)
+    return deleted
+
+
+def screenshot_saved(log_step, result):
+    path, timings, error = result
+    if error:
+        log.warning("Screenshot %s wasn't saved: %s" % (path, error))
+        return
+
+    for stage, value in timings.items():
+        send_metrics("screenshots.%s_time" % stage, value)
+    if "link" in timings and "write" not in timings:
+        send_metrics("screenshots.duplicates", 1)
+    log_step.screenshot = path
+    log_step.save()
+
+
+def save_screenshot(log_step, path, screenshot):
+    screenshot_saved(
+        log_step, process_screenshot(path, screenshot, eager_thumbnail_width())
+    )
+
+
+class ScreenshotPipeline(object):
+    """
+    Saves screenshots in process pool.
+    Thumbnails are not made while thumbnail_queue_size screenshots
+    are pending, new screenshots are dropped while queue_size are pending.
+    Screenshots pending longer than task_timeout seconds are expired:
+    task of pool process which was killed never completes.
+    """
+    pool = None
+
+    def __init__(self, app, processes=None, queue_size=None,
+                 thumbnail_queue_size=None, task_timeout=None):
+        self.app = app
+        self.processes = processes or getattr(
+            config, "SCREENSHOT_PROCESSES", None) or cpu_count()
+        self.queue_size = queue_size or getattr(
+            config, "SCREENSHOT_QUEUE_SIZE", 100)
+        self.thumbnail_queue_size = thumbnail_queue_size or getattr(
+            config, "SCREENSHOT_THUMBNAIL_QUEUE_SIZE", self.queue_size / 2)
+        self.task_timeout = task_timeout or getattr(
+            config, "SCREENSHOT_TASK_TIMEOUT", 60)
+        self.pending = 0
+        self.tasks = OrderedDict()
+        self.counter = count()
+        self.expired = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.pending
+
+    def start(self):
+        self.pool = Pool(self.processes)
+        log.info("Screenshot pipeline started with %s processes" %
+                 self.processes)
+
+    def put(self, log_step, path, screenshot):
+        """
+        :return: False if screenshot was dropped
+        """
+        now = time.time()
+        with self.lock:
+            expired = self._expire(now)
+            if self.pending >= self.queue_size:
+                dropped = True
+            else:
+                dropped = False
+                self.pending += 1
+                task = next(self.counter)
+                self.tasks[task] = now
+            pending = self.pending
+
+        if expired:
+            log.warning("%s screenshots weren't saved in %s sec, "
+                        "pool process may be dead" % (expired,
+                                                      self.task_timeout))
+            send_metrics("screenshots.expired", expired)
+        send_metrics("screenshots.queue_depth", pending)
+        if dropped:
+            log.warning("Screenshot %s was dropped, %s screenshots "
+                        "are pending" % (path, pending))
+            send_metrics("screenshots.dropped", 1)
+            return False
+
+        thumbnail_width = eager_thumbnail_width()
+        if thumbnail_width and pending > self.thumbnail_queue_size:
+            thumbnail_width = None
+            send_metrics("screenshots.thumbnails_dropped", 1)
+
+        self.pool.apply_async(
+            process_screenshot,
+            (path, screenshot, thumbnail_width, time.time()),
+            callback=partial(self.done, log_step, task)
+        )
+        return True
+
+    def _expire(self, now):
+        expired = 0
+        while self.tasks:
+            task, started = next(self.tasks.iteritems())
+            if now - started < self.task_timeout:
+                break
+            del self.tasks[task]
+            self.pending -= 1
+            expired += 1
+        self.expired += expired
+        return expired
+
+    def done(self, log_step, task, result):
+        # called in result thread of pool, which must not die
+        with self.lock:
+            if self.tasks.pop(task, None) is not None:
+                self.pending -= 1
+        try:
+            with self.app.app_context():
+                screenshot_saved(log_step, result)
+        except Exception as e:
+            log.exception("Screenshot %s wasn't saved: %s" % (result[0], e))
+
+    def stop(self):
+        if self.pool is not None:
+            if self.expired:
+                # join would wait for lost tasks forever
+                self.pool.terminate()
+            else:
+                self.pool.close()
+                self.pool.join()
+        log.info("Screenshot pipeline stopped")
+
+
+class ThumbnailCache(object):
+    """
+    Resized screenshots, made on first request.
+    Kept in directory limited by max_size bytes,
+    least recently used ones are deleted first.
+    """
+    entries = None
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or os.path.join(
+            config.SCREENSHOTS_DIR, "thumbnails")
+        self.max_size = max_size or getattr(
+            config, "SCREENSHOT_THUMBNAIL_CACHE_SIZE", 256 * 1024 * 1024)
+        self.size = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries or ())
+
+    def load(self):
+        entries = []
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(".png"):
+                    continue
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((stat.st_atime, filename[:-4], stat.st_size))
+        self.entries = OrderedDict(
+            (key, size) for _, key, size in sorted(entries)
+        )
+        self.size = sum(self.entries.values())
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.png" % key)
+
+    @staticmethod
+    def etag(path, width=None, height=None):
+        """
+        Changes with screenshot file, same for links to one blob.
+        """
+        stat = os.stat(path)
+        return hashlib.sha1("%s-%s-%s-%s-%sx%s" % (
+            stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime,
+            width, height
+        )).hexdigest()
+
+    def get(self, path, width, height=None):
+        """
+        :return: png content of screenshot resized to width
+        """
+        key = self.etag(path, width, height)
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            hit = key in self.entries
+            if hit:
+                self.entries[key] = self.entries.pop(key)
+
+        if hit:
+            try:
+                with open(self.path(key)) as f:
+                    return f.read()
+            except IOError:
+                # deleted by another process
+                self.remove(key)
+
+        with open(path) as f:
+            content = resize(f.read(), width, height)
+        self.put(key, content)
+        return content
+
+    def put(self, key, content):
+        write_blob(self.path(key), content)
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = len(content)
+            self.size += len(content)
+            while self.size > self.max_size and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
@@ -1,19 +1,26 @@
 # coding: utf-8
 
+import os
 import time
-import requests
+import heapq
+import select
 import logging
 
-from Queue import Queue
-from threading import Thread
+from Queue import Empty
+from itertools import count
+from threading import Thread, Lock
 from datetime import datetime
 from flask import current_app
+from twisted.python.failure import Failure
+from twisted.internet.error import TimeoutError
 
 from core import constants
 from core.db import models
 from core.config import config
 from core.exceptions import SessionException, RequestException, RequestTimeoutException
 from core.video import VNCVideoHelper
+from core.http_pool import EndpointHTTPPool, remove_hop_by_hop_headers
+from core.utils.graphite import send_metrics
 
 log = logging.getLogger(__name__)
 
@@ -61,7 +68,11 @@ class Session(models.Session):
     current_log_step = None
     vnc_helper = None
     take_screencast = None
+    screenshot_capture = None
+    http_pool = None
     is_active = True
+    saved_state = None
+    saved_at = 0
 
     def __init__(self, name=None, dc=None):
         super(Session, self).__init__(name, dc)
@@ -99,21 +110,64 @@ class Session(models.Session):
     def set_user(self, username):
         self.user = current_app.database.get_user(username=username)
 
+    def get_state(self):
+        return dict(
+            (column.key, getattr(self, column.key))
+            for column in self.__table__.columns
+        )
+
+    def changed_fields(self):
+        return dict(
+            (key, value) for key, value in self.get_state().items()
+            if self.saved_state.get(key) != value
+        )
+
+    def add(self):
+        super(Session, self).add()
+        self.saved_state = self.get_state()
+        self.saved_at = time.time()
+
+    def save(self, coalesce=False):
+        """
+        Write changed columns with one UPDATE without reloading the row.
+        :param coalesce: skip write if session was saved less than
+        SESSION_SAVE_INTERVAL seconds ago, changes will be written
+        with the next save
+        """
+        if self.saved_state is None:
+            # session was loaded from database
+            return super(Session, self).save()
+
+        if coalesce and time.time() - self.saved_at < getattr(
+                config, "SESSION_SAVE_INTERVAL", 5):
+            return
+
+        fields = self.changed_fields()
+        if fields:
+            current_app.database.update_fields(
+                type(self), self.id, fields)
+            self.saved_state.update(fields)
+        self.saved_at = time.time()
+
+    def get_http_pool(self):
+        if not self.http_pool:
+            self.http_pool = EndpointHTTPPool(self.endpoint_ip)
+        return self.http_pool
+
     def start_timer(self):
         self.modified = datetime.now()
-        self.save()
+        self.save(coalesce=True)
         self.is_active = False
+        current_app.sessions.worker.schedule(self)
 
     def stop_timer(self):
         self.is_active = True
+        current_app.sessions.worker.cancel(self)
 
     def save_artifacts(self):
-        artifacts = {
-            "selenium_server": "/var/log/selenium_server.log"
-        }
         if not self.endpoint_ip:
             return False
-        return self.endpoint.save_artifacts(self, artifacts)
+        return self.endpoint.save_artifacts(self)
 
     def close(self, reason=None):
         self.closed = True
@@ -122,13 +176,30 @@ class Session(models.Session):
         self.deleted = datetime.now()
         self.save()
 
+        if self.screenshot_capture is not None:
+            # last screenshot is taken while endpoint is still ours
+            self.screenshot_capture.flush()
+
+        if getattr(current_app, "journal", None) is not None:
+            current_app.journal.flush()
+
         if self.vnc_helper:
-            self.vnc_helper.stop_recording()
-            self.vnc_helper.stop_proxy()
-            if not self.take_screencast and "succeed" in self.status:
+            keep_video = self.take_screencast or "succeed" not in self.status
+            self.vnc_helper.stop_recording(persist=keep_video)
+            if not keep_video:
                 self.vnc_helper.delete_source_video()
 
+        if getattr(current_app, "vnc_proxy", None) is not None:
+            current_app.vnc_proxy.disconnect(self.id)
+
         current_app.sessions.remove(self)
+        current_app.sessions.worker.cancel(self)
+
+        if getattr(current_app, "pool", None) is not None:
+            current_app.pool.cancel(self.id)
+
+        if self.http_pool:
+            self.http_pool.close()
 
         if hasattr(self, "ws"):
             self.ws.close()
@@ -164,7 +235,12 @@ class Session(models.Session):
         self.endpoint = endpoint
         self.set_vm(endpoint)
         self.status = "running"
-        self.vnc_helper = VNCVideoHelper(self.endpoint_ip, filename_prefix=self.id)
+        recorder = None
+        if getattr(config, "SCREENCAST_RECORDER_PROCESSES", 0):
+            recorder = current_app.recorder
+        self.vnc_helper = VNCVideoHelper(
+            self.endpoint_ip, filename_prefix=self.id, service=recorder
+        )
         self.vnc_helper.start_recording()
 
         log.info("Session %s starting on %s (%s)." %
@@ -194,64 +270,143 @@ class Session(models.Session):
 
         if request.headers.get("Host"):
             del request.headers['Host']
-
-        def get_response():
-            try:
-                queue.put(
-                    requests.request(
-                        method=request.method,
-                        url=url,
-                        headers=request.headers,
-                        data=request.data,
-                        timeout=timeout
-                    )
-                )
-            except Exception as e:
-                queue.put(e)
+        remove_hop_by_hop_headers(request.headers)
+        http_pool = self.get_http_pool()
+        check_interval = getattr(config, "MAKE_REQUEST_CHECK_INTERVAL", 0.5)
 
         attempts = getattr(config, "MAKE_REQUEST_ATTEMPTS_AMOUNT", 3)
         for attempt in range(1, attempts+1):
-            queue = Queue()
             log.info("Attempt {}. Making user request {}".format(attempt, url))
-            t = Thread(target=get_response)
-            t.daemon = True
-            t.start()
-
-            while t.isAlive():
-                yield None, None, None
-
-            response = queue.get()
-            if attempt >= attempts:
-                if isinstance(response, requests.Timeout):
+            result = http_pool.request_from_thread(
+                method=request.method,
+                url=url,
+                headers=request.headers,
+                data=request.data,
+                timeout=timeout
+            )
+
+            while True:
+                try:
+                    response = result.get(timeout=check_interval)
+                    break
+                except Empty:
+                    yield None, None, None
+
+            if isinstance(response, Failure):
+                response = response.value
+
+            if not isinstance(response, Exception):
+                status, headers, content = response
+                yield status, headers, content
+                break
+            elif self.closed:
+                raise SessionException(
+                    "Session %s closed while waiting for response from '%s'"
+                    % (self.id, url)
+                )
+            elif attempt >= attempts:
+                if isinstance(response, TimeoutError):
                     raise RequestTimeoutException(
                         "No response for '%s' in %s sec. Original: %s" % (url, timeout, response)
                     )
-                elif isinstance(response, Exception):
-                    raise RequestException("Error for '%s'. Original: %s" % (url, response))
-            elif isinstance(response, requests.Response):
-                yield response.status_code, response.headers, response.content
-                break
+                raise RequestException("Error for '%s'. Original: %s" % (url, response))
 
 
 class SessionWorker(Thread):
+    """
+    Times out inactive sessions by deadlines kept in a heap.
+    Rescheduled and cancelled sessions leave stale heap entries,
+    which are dropped when they get on top of the heap.
+    Worker sleeps in select on a wakeup pipe until the nearest deadline.
+    """
     def __init__(self, sessions):
         Thread.__init__(self)
         self.running = True
         self.daemon = True
         self.sessions = sessions
+        self.deadlines = []
+        self.scheduled = {}
+        self.counter = count()
+        self.lock = Lock()
+        self.wakeup_in, self.wakeup_out = os.pipe()
+
+    def schedule(self, session, timeout=None):
+        if timeout is None:
+            timeout = config.SESSION_TIMEOUT
+        entry = (time.time() + timeout, next(self.counter), session)
+
+        with self.lock:
+            self.scheduled[session.id] = entry
+            heapq.heappush(self.deadlines, entry)
+            if len(self.deadlines) > 2 * len(self.scheduled) + 100:
+                self.deadlines = self.scheduled.values()
+                heapq.heapify(self.deadlines)
+            nearest = self.deadlines[0] is entry
+        if nearest:
+            self.wakeup()
+
+    def cancel(self, session):
+        with self.lock:
+            self.scheduled.pop(session.id, None)
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_out, "x")
+        except OSError:
+            pass
+
+    def sleep(self, timeout):
+        """
+        Blocks until timeout or wakeup(), timeout None is infinite
+        """
+        readable, _, _ = select.select([self.wakeup_in], [], [], timeout)
+        if readable:
+            os.read(self.wakeup_in, 4096)
+
+    def next_expired(self):
+        while self.running:
+            with self.lock:
+                if not self.deadlines:
+                    delay = None
+                else:
+                    deadline, _, session = entry = self.deadlines[0]
+                    if self.scheduled.get(session.id) is not entry:
+                        heapq.heappop(self.deadlines)
+                        continue
+
+                    delay = deadline - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self.deadlines)
+                        del self.scheduled[session.id]
+                        return deadline, session
+
+            # wakeup() written after lock is released makes pipe readable
+            self.sleep(delay)
+
+        return None, None
 
     def run(self):
         with self.sessions.app.app_context():
             while self.running:
-                for session in self.sessions.running():
-                    if not session.is_active \
-                            and session.inactivity > config.SESSION_TIMEOUT:
+                deadline, session = self.next_expired()
+                if session is None:
+                    continue
+
+                send_metrics("session_timeout_lag",
+                             (time.time() - deadline) * 1000)
+                if session.status == "running" and not session.is_active:
+                    try:
                         session.timeout()
-                time.sleep(1)
+                    except Exception as e:
+                        log.exception("Session %s timeout failed: %s"
+                                      % (session.id, e))
 
     def stop(self):
         self.running = False
+        self.wakeup()
         self.join()
+        os.close(self.wakeup_in)
+        os.close(self.wakeup_out)
         log.info("SessionWorker stopped")
 
 
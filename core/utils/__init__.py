@@ -87,8 +87,7 @@ def write_file(path, content):
     basedir = os.path.dirname(path)
     if not os.path.exists(basedir):
         os.makedirs(basedir)
-
-    os.chmod(basedir, 0777)
+        os.chmod(basedir, 0777)
 
     with open(path, "w") as f:
         f.write(content)
@@ -166,6 +165,35 @@ def generator_wait_for(condition, timeout=5):
     yield condition()
 
 
+def generator_join(thread, interval=0.5):
+    thread.join(interval)
+    while thread.isAlive():
+        yield None
+        thread.join(interval)
+
+
+class OutputBuffer(object):
+    """
+    Output collected by chunks, chunks are joined only when it's read.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def __nonzero__(self):
+        return any(self.chunks)
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+
+    def getvalue(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+
 class BucketThread(Thread):
     def __init__(self, bucket, *args, **kwargs):
         Thread.__init__(self, *args, **kwargs)
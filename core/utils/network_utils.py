@@ -1,6 +1,16 @@
+import os
+import time
+import errno
+import select
+import socket
+import logging
 import netifaces
+from threading import Thread, Lock, Event
+
 from . import system_utils
-import socket
+from core.config import config
+
+log = logging.getLogger(__name__)
 
 
 def get_interface_subnet(inteface):
@@ -77,3 +87,273 @@ def ping(ip, port):
         return True
 
     return False
+
+
+class ProbeTarget(object):
+    """
+    Ports of one host checked by PortProber.
+    """
+    invalid = False
+    address = None
+
+    def __init__(self, prober, ip, ports):
+        self.prober = prober
+        self.ip = ip
+        self.ports = tuple(ports)
+        self.results = dict((port, False) for port in self.ports)
+        self.attempts = dict((port, 0) for port in self.ports)
+        self.ready = Event()
+        self.attempted = Event()
+        self.waiters = 0
+
+    def __repr__(self):
+        return "<ProbeTarget %s:%s waiters:%s>" % (
+            self.ip, list(self.ports), self.waiters)
+
+    def wait(self, timeout):
+        """
+        Wait until all ports are open or timeout is over,
+        but until every port was tried at least once.
+        :return: list of port states in order of ports
+        """
+        if self.invalid:
+            return [False for _ in self.ports]
+        self.ready.wait(timeout)
+        if not self.ready.is_set():
+            self.attempted.wait(self.prober.connect_timeout + 1)
+        return [self.results[port] for port in self.ports]
+
+    def release(self):
+        self.prober.release(self)
+
+
+class Probe(object):
+    def __init__(self, target, port):
+        self.target = target
+        self.port = port
+        self.sock = None
+        self.deadline = None
+        self.next_attempt = 0
+        self.backoff = 0
+
+
+class PortProber(Thread):
+    """
+    Checks ports of all hosts waiting to be ready with non-blocking
+    connects in one thread. Failed ports are tried again with
+    exponential backoff, target.ready is set when all ports are open.
+    Sockets are polled, so their descriptors aren't limited by FD_SETSIZE.
+    """
+    def __init__(self, connect_timeout=None, min_backoff=None,
+                 max_backoff=None):
+        Thread.__init__(self)
+        self.running = True
+        self.daemon = True
+        self.connect_timeout = connect_timeout or getattr(
+            config, "PROBER_CONNECT_TIMEOUT", 1)
+        self.min_backoff = min_backoff or getattr(
+            config, "PROBER_MIN_BACKOFF", 0.1)
+        self.max_backoff = max_backoff or getattr(
+            config, "PROBER_MAX_BACKOFF", 2)
+        self.targets = dict()
+        self.probes = dict()
+        self.lock = Lock()
+        self.wakeup_in, self.wakeup_out = os.pipe()
+
+    def acquire(self, ip, ports):
+        """
+        :return: ProbeTarget shared by all waiters of the same ports,
+                 must be released
+        """
+        if not ip or not isinstance(ip, basestring):
+            log.warning("Ports %s of invalid host %r can't be probed" %
+                        (list(ports), ip))
+            target = ProbeTarget(self, ip, ports)
+            target.invalid = True
+            return target
+
+        key = (ip, tuple(ports))
+        with self.lock:
+            target = self.targets.get(key)
+            if target is None:
+                target = self.targets[key] = ProbeTarget(self, ip, ports)
+            target.waiters += 1
+        self.wakeup()
+        return target
+
+    def release(self, target):
+        if target.invalid:
+            return
+        with self.lock:
+            target.waiters -= 1
+            key = (target.ip, target.ports)
+            if target.waiters <= 0 and self.targets.get(key) is target:
+                del self.targets[key]
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_out, "x")
+        except OSError:
+            pass
+
+    def update_probes(self, now):
+        with self.lock:
+            targets = self.targets.values()
+
+        for key, probe in self.probes.items():
+            if probe.target not in targets:
+                self.close_probe(probe)
+                del self.probes[key]
+
+        for target in targets:
+            for port in target.ports:
+                if target.results[port]:
+                    continue
+                probe = self.probes.setdefault(
+                    (target, port), Probe(target, port))
+                if probe.sock is None and probe.next_attempt <= now:
+                    self.connect(probe, now)
+
+    @staticmethod
+    def resolve(target):
+        """
+        Host is resolved once for all ports and attempts.
+        :return: family, address with port 0
+        """
+        if target.address is None:
+            family, _, _, _, address = socket.getaddrinfo(
+                target.ip, 0, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+            target.address = family, address
+        return target.address
+
+    def connect(self, probe, now):
+        # any error fails only this probe, prober thread is shared
+        try:
+            family, address = self.resolve(probe.target)
+            probe.sock = socket.socket(family, socket.SOCK_STREAM)
+            probe.sock.setblocking(0)
+            error = probe.sock.connect_ex(
+                (address[0], probe.port) + address[2:])
+        except Exception as e:
+            log.debug("Probe %s:%s failed: %s" %
+                      (probe.target.ip, probe.port, e))
+            self.done(probe, False, now)
+            return
+
+        probe.deadline = now + self.connect_timeout
+        if error == 0:
+            self.done(probe, True, now)
+        elif error not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.done(probe, False, now)
+
+    @staticmethod
+    def close_probe(probe):
+        if probe.sock is not None:
+            probe.sock.close()
+            probe.sock = None
+
+    def done(self, probe, success, now):
+        self.close_probe(probe)
+        target = probe.target
+        target.attempts[probe.port] += 1
+
+        if success:
+            target.results[probe.port] = True
+        else:
+            probe.backoff = min(
+                max(probe.backoff * 2, self.min_backoff), self.max_backoff)
+            probe.next_attempt = now + probe.backoff
+
+        if all(target.attempts.values()):
+            target.attempted.set()
+        if all(target.results.values()):
+            with self.lock:
+                key = (target.ip, target.ports)
+                if self.targets.get(key) is target:
+                    del self.targets[key]
+            target.ready.set()
+
+    def next_timeout(self, now):
+        times = [probe.deadline if probe.sock else probe.next_attempt
+                 for probe in self.probes.values()]
+        if not times:
+            return None
+        return max(min(times) - now, 0)
+
+    def run(self):
+        while self.running:
+            now = time.time()
+            self.update_probes(now)
+            connecting = dict(
+                (probe.sock.fileno(), probe)
+                for probe in self.probes.values() if probe.sock
+            )
+
+            poller = select.poll()
+            poller.register(self.wakeup_in, select.POLLIN)
+            for fd in connecting:
+                poller.register(fd, select.POLLOUT)
+            timeout = self.next_timeout(now)
+            try:
+                events = poller.poll(
+                    None if timeout is None else timeout * 1000)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    log.exception("Port prober poll failed: %s" % e)
+                continue
+
+            now = time.time()
+            for fd, _ in events:
+                if fd == self.wakeup_in:
+                    os.read(self.wakeup_in, 4096)
+                    continue
+                probe = connecting[fd]
+                try:
+                    error = probe.sock.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR)
+                except Exception as e:
+                    log.debug("Probe %s:%s failed: %s" %
+                              (probe.target.ip, probe.port, e))
+                    error = e
+                self.done(probe, error == 0, now)
+
+            for probe in connecting.values():
+                if probe.sock is not None and probe.deadline <= now:
+                    self.done(probe, False, now)
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+        self.join(1)
+
+
+_prober = None
+_prober_lock = Lock()
+
+
+def get_prober():
+    global _prober
+    with _prober_lock:
+        if _prober is None or not _prober.is_alive():
+            _prober = PortProber()
+            _prober.start()
+        return _prober
+
+
+def probe_ports(ip, ports):
+    """
+    :return: ProbeTarget, must be released
+    """
+    return get_prober().acquire(ip, ports)
+
+
+def wait_ports(ip, ports, timeout):
+    """
+    :return: list of port states in order of ports
+    """
+    target = probe_ports(ip, ports)
+    try:
+        return target.wait(timeout)
+    finally:
+        target.release()
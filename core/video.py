@@ -3,26 +3,528 @@
 import os
 import sys
 import time
+import errno
+import select
 import signal
+import socket
 import logging
 import os.path
-import websockify
+import resource
 import multiprocessing
 
+from collections import deque
+from StringIO import StringIO
+from threading import Lock
+
 from core.config import config
 from vnc2flv import flv, rfb, video
-from core.utils.network_utils import get_free_port
+from core.utils.graphite import send_metrics
 
 log = logging.getLogger(__name__)
 
 
+class FLVRingBuffer(flv.FLVWriter):
+    """
+    FLV writer which keeps only last max_duration msec (and max_size bytes)
+    of video in memory as segments starting with keyframes.
+    Nothing is written to disk until save(filename) is called.
+    """
+    def __init__(self, max_duration, max_size=None, **kwargs):
+        self.max_duration = max_duration
+        self.max_size = max_size
+        self.head = StringIO()
+        self.segments = deque()
+        flv.FLVWriter.__init__(self, self.head, **kwargs)
+
+    def end_tag(self, tag, timestamp=None):
+        data = self.fp.getvalue()
+        if tag == self.TAG_VIDEO and data and ord(data[0]) & 0x10:
+            # tag is written to base fp when pushed buffer is popped
+            segment = StringIO()
+            self.segments.append((self.basetime + int(timestamp), segment))
+            self.fpstack[-1] = segment
+        flv.FLVWriter.end_tag(self, tag, timestamp)
+        if tag == self.TAG_VIDEO:
+            self.trim()
+
+    @property
+    def size(self):
+        return sum(segment.tell() for _, segment in self.segments)
+
+    def trim(self):
+        while len(self.segments) > 1 and (
+            self.duration - self.segments[1][0] >= self.max_duration or
+            (self.max_size and self.size > self.max_size)
+        ):
+            self.segments.popleft()
+
+    def save(self, filename):
+        self.flush()
+        flv.DataWriter.close(self)
+        with open(filename, 'wb') as fp:
+            fp.write(self.head.getvalue())
+            for _, segment in self.segments:
+                fp.write(segment.getvalue())
+
+            # re-write metadata with duration of kept video
+            start = self.segments[0][0] if self.segments else 0
+            self.metadata['duration'] = (self.duration - start) * .001
+            self.duration = 0
+            self.fp = fp
+            fp.seek(self.metadata_pos)
+            self.write_metadata()
+
+
+class AdaptiveFLVVideoSink(video.FLVVideoSink):
+    """
+    Writes frames at framerate only while screen is changing.
+    Unchanged screen is written once per idle_interval msec and keyframe
+    is written with the first change after keyframe_interval msec.
+    """
+    def __init__(self, writer, idle_interval=10000, keyframe_interval=10000,
+                 **kwargs):
+        video.FLVVideoSink.__init__(self, writer, **kwargs)
+        self.idle_interval = idle_interval
+        self.keyframe_interval = keyframe_interval
+        self.last_frame = None
+        self.last_keyframe = None
+        self.skipped_frames = 0
+
+    def flush(self, t):
+        if not self.screen:
+            return
+
+        # frame slots between updates are never written
+        current = t * self.framerate / 1000
+        if current < self.curframe:
+            return
+        self.skipped_frames += current - self.curframe
+        self.curframe = current
+        timestamp = self.curframe * 1000 / self.framerate
+
+        changed = bool(self.screen.changed())
+        if changed or self.last_frame is None or \
+                timestamp - self.last_frame >= self.idle_interval:
+            key = self.last_keyframe is None or (
+                changed and
+                timestamp - self.last_keyframe >= self.keyframe_interval
+            )
+            # get_update_frame makes keyframe if curframe % keyframe == 0
+            self.keyframe = 1 if key else 0
+            self.writer.write_video_frame(timestamp, self.get_update_frame())
+            self.last_frame = timestamp
+            if key:
+                self.last_keyframe = timestamp
+        else:
+            self.skipped_frames += 1
+        self.curframe += 1
+
+
+class Recording(object):
+    """
+    vnc2flv recording of one vnc server: RFB client, FLV sink and writer.
+    """
+    def __init__(self, filename, host='localhost', port=5900,
+                 framerate=12, keyframe=120,
+                 preferred_encoding=(0,),
+                 blocksize=32, clipping=None,
+                 debug=0, buffer_duration=None, buffer_size=None,
+                 adaptive=False, idle_interval=10000,
+                 keyframe_interval=10000):
+        self.filename = filename
+        self.session_id = None
+        self.started = time.time()
+        self.connect_deadline = None
+        if buffer_duration:
+            self.fp = None
+            self.writer = FLVRingBuffer(buffer_duration * 1000, buffer_size,
+                                        framerate=framerate, debug=debug)
+        else:
+            self.fp = file(filename, 'wb')
+            self.writer = flv.FLVWriter(self.fp, framerate=framerate,
+                                        debug=debug)
+        if adaptive:
+            self.sink = AdaptiveFLVVideoSink(
+                self.writer, idle_interval=idle_interval,
+                keyframe_interval=keyframe_interval,
+                blocksize=blocksize, framerate=framerate,
+                clipping=clipping, debug=debug)
+        else:
+            self.sink = video.FLVVideoSink(
+                self.writer,
+                blocksize=blocksize, framerate=framerate, keyframe=keyframe,
+                clipping=clipping, debug=debug)
+        self.client = rfb.RFBNetworkClient(
+            host, port, self.sink, timeout=500/framerate,
+            pwdcache=rfb.PWDCache('%s:%d' % (host, port)),
+            preferred_encoding=preferred_encoding, debug=debug)
+
+    def __repr__(self):
+        return "<Recording %s:%s to %s>" % (
+            self.client.host, self.client.port, self.filename)
+
+    def fileno(self):
+        return self.client.sock.fileno()
+
+    @property
+    def connecting(self):
+        return self.connect_deadline is not None
+
+    @property
+    def connect_expired(self):
+        return self.connecting and time.time() > self.connect_deadline
+
+    def open(self):
+        """
+        Starts non-blocking connect, connected() must be called
+        when socket becomes writable
+        """
+        rfb.RFBProxy.open(self.client)
+        self.client.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client.sock.setblocking(0)
+        error = self.client.sock.connect_ex(
+            (self.client.host, self.client.port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+        self.connect_deadline = time.time() + getattr(
+            config, "SCREENCAST_RECORDER_CONNECT_TIMEOUT", 5)
+
+    def connected(self):
+        error = self.client.sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+        self.connect_deadline = None
+        self.client.sock.settimeout(self.client.timeout * .001)
+
+    def connect(self):
+        """
+        Blocking open() for recording in its own process
+        """
+        self.open()
+        _, writable, _ = select.select(
+            [], [self], [], max(self.connect_deadline - time.time(), 0))
+        if not writable:
+            raise socket.timeout("timed out")
+        self.connected()
+
+    def read(self):
+        data = self.client.sock.recv(self.client.bufsiz)
+        if not data:
+            raise rfb.RFBProtocolError('unexpected EOF')
+        self.client.feed(data)
+
+    def flush(self):
+        if self.client.session_open:
+            self.client.sink.flush(self.client.time())
+
+    @property
+    def expired(self):
+        max_duration = getattr(config, "SCREENCAST_RECORDER_MAX_DURATION", 1800)
+        return time.time() - self.started > max_duration
+
+    def close(self, persist=True):
+        """
+        :param persist: write buffered video to file
+        """
+        try:
+            if getattr(self.client, "sock", None) is not None:
+                self.client.close()
+        finally:
+            if self.fp is None:
+                if persist:
+                    self.writer.save(self.filename)
+            else:
+                self.writer.close()
+                self.fp.close()
+            self.report_skipped_frames()
+
+    def report_skipped_frames(self):
+        skipped_frames = getattr(self.sink, "skipped_frames", None)
+        if skipped_frames is None:
+            return
+        log.info("%s frames of unchanged screen weren't written to %s" % (
+            skipped_frames, self.filename))
+        send_metrics("vnc_recorder.skipped_frames", skipped_frames)
+
+
+def memory_usage():
+    """
+    :return: resident memory of current process in KB
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RecorderWorker(multiprocessing.Process):
+    """
+    Records many sessions in one process, RFB connections of all
+    recordings are multiplexed with select.
+    Commands are sent over pipe: ("start", session_id, filename, host,
+    port, kwargs), ("stop", session_id, persist), ("stats",), ("exit",).
+    """
+    def __init__(self, index):
+        super(RecorderWorker, self).__init__(name="vnc-recorder-%s" % index)
+        self.daemon = True
+        self.index = index
+        self.commands, self.conn = multiprocessing.Pipe()
+        # parent side
+        self.sessions = set()
+        self.lock = Lock()
+        # worker side
+        self.recordings = {}
+        self.usage = None
+
+    def start(self):
+        super(RecorderWorker, self).start()
+        # worker end must be open only in worker, so that dead worker
+        # is seen as broken pipe instead of pipe which is never read
+        self.conn.close()
+
+    def _send(self, command, timeout=None):
+        """
+        :return: False if command wasn't sent to dead or stuck worker
+        """
+        if timeout is None:
+            timeout = getattr(config, "SCREENCAST_RECORDER_SEND_TIMEOUT", 1)
+        if not self.is_alive():
+            log.warning("VNC recorder worker %s is dead, command %s "
+                        "wasn't sent" % (self.index, command[0]))
+            return False
+        _, writable, _ = select.select([], [self.commands], [], timeout)
+        if not writable:
+            log.warning("VNC recorder worker %s doesn't read commands, "
+                        "command %s wasn't sent" % (self.index, command[0]))
+            return False
+        try:
+            self.commands.send(command)
+        except (IOError, EOFError) as e:
+            log.warning("VNC recorder worker %s: command %s wasn't sent: %s"
+                        % (self.index, command[0], e))
+            return False
+        return True
+
+    def send(self, *command):
+        with self.lock:
+            return self._send(command)
+
+    def request(self, *command, **kwargs):
+        timeout = kwargs.get("timeout", 1)
+        with self.lock:
+            try:
+                # answers which came after timeout
+                while self.commands.poll():
+                    self.commands.recv()
+                if self._send(command, timeout) and self.commands.poll(timeout):
+                    return self.commands.recv()
+            except (IOError, EOFError) as e:
+                log.warning("VNC recorder worker %s: no answer to %s: %s"
+                            % (self.index, command[0], e))
+
+    def run(self):
+        self.commands.close()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.usage = self.cpu_time(), time.time()
+        interval = getattr(config, "SCREENCAST_RECORDER_STATS_INTERVAL", 10)
+        stats_time = time.time()
+        log.info("VNC recorder worker %s started" % self.index)
+
+        running = True
+        while running:
+            connecting = [recording for recording in self.recordings.values()
+                          if recording.connecting]
+            connected = [recording for recording in self.recordings.values()
+                         if not recording.connecting]
+            readable, writable, _ = select.select(
+                [self.conn] + connected, connecting, [], 0.1
+            )
+            for recording in writable:
+                self.connect(recording)
+            for source in readable:
+                if source is self.conn:
+                    try:
+                        running = self.handle(self.conn.recv())
+                    except EOFError:
+                        running = False
+                else:
+                    self.read(source)
+
+            for session_id, recording in self.recordings.items():
+                if recording.connect_expired:
+                    log.warning("VNC recorder can't connect to %s:%s: "
+                                "timed out" % (recording.client.host,
+                                               recording.client.port))
+                    self.stop(session_id)
+                elif recording.expired:
+                    log.warning("VNC recorder for %s has been stopped because "
+                                "max duration was exceeded" % recording.filename)
+                    self.stop(session_id)
+                else:
+                    recording.flush()
+
+            if time.time() - stats_time >= interval:
+                stats_time = time.time()
+                self.send_stats()
+
+        for session_id in self.recordings.keys():
+            self.stop(session_id)
+        log.info("VNC recorder worker %s stopped" % self.index)
+
+    def handle(self, command):
+        action, args = command[0], command[1:]
+        if action == "start":
+            self.start_recording(*args)
+        elif action == "stop":
+            self.stop(*args)
+        elif action == "stats":
+            self.conn.send(self.stats())
+        elif action == "exit":
+            return False
+        return True
+
+    def start_recording(self, session_id, filename, host, port, kwargs):
+        recording = Recording(filename, host, port, **kwargs)
+        recording.session_id = session_id
+        try:
+            recording.open()
+        except:
+            log.exception("VNC recorder can't connect to %s:%s" % (host, port))
+            recording.close()
+            return
+        self.recordings[session_id] = recording
+
+    def connect(self, recording):
+        try:
+            recording.connected()
+        except:
+            log.exception("VNC recorder can't connect to %s:%s" % (
+                recording.client.host, recording.client.port))
+            self.stop(recording.session_id)
+            return
+        log.info("Started screencast recording for {}:{} to {}".format(
+            recording.client.host, recording.client.port, recording.filename))
+
+    def read(self, recording):
+        try:
+            recording.read()
+        except:
+            log.exception("Error in VNC recorder({})".format(recording.filename))
+            self.stop(recording.session_id)
+
+    def stop(self, session_id, persist=True):
+        recording = self.recordings.pop(session_id, None)
+        if recording is None:
+            return
+        try:
+            recording.close(persist)
+        except:
+            log.exception("Error on stopping VNC recorder({})".format(
+                recording.filename))
+        log.info("Stopped screencast recording to {}".format(recording.filename))
+
+    @staticmethod
+    def cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def stats(self):
+        cpu_time, now = self.cpu_time(), time.time()
+        last_cpu_time, last_time = self.usage
+        self.usage = cpu_time, now
+        return {
+            "worker": self.index,
+            "pid": os.getpid(),
+            "sessions": len(self.recordings),
+            "cpu": round(
+                100.0 * (cpu_time - last_cpu_time) / max(now - last_time, 0.001), 1
+            ),
+            "memory": memory_usage()
+        }
+
+    def send_stats(self):
+        stats = self.stats()
+        for key in ("sessions", "cpu", "memory"):
+            send_metrics("vnc_recorder.worker_%s.%s" % (self.index, key),
+                         stats[key])
+
+
+class VNCRecorderService(object):
+    """
+    Fixed pool of recorder processes shared by all sessions,
+    new recording goes to worker with fewer sessions.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or getattr(
+            config, "SCREENCAST_RECORDER_PROCESSES", multiprocessing.cpu_count())
+        self.workers = []
+        self.sessions = {}
+        self.lock = Lock()
+
+    def start(self):
+        for index in range(self.processes):
+            self.workers.append(self.start_worker(index))
+        log.info("VNC recorder service started with %s workers" % self.processes)
+
+    @staticmethod
+    def start_worker(index):
+        worker = RecorderWorker(index)
+        worker.start()
+        return worker
+
+    def start_recording(self, session_id, filename, host, port=5900, **kwargs):
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    log.warning("VNC recorder worker %s is dead, restarting" %
+                                worker.index)
+                    for _session_id in worker.sessions:
+                        self.sessions.pop(_session_id, None)
+                    self.workers[i] = self.start_worker(worker.index)
+
+            worker = min(self.workers, key=lambda w: len(w.sessions))
+            worker.sessions.add(session_id)
+            self.sessions[session_id] = worker
+        worker.send("start", session_id, filename, host, port, kwargs)
+        return worker
+
+    def stop_recording(self, session_id, persist=True):
+        with self.lock:
+            worker = self.sessions.pop(session_id, None)
+            if worker is None:
+                return
+            worker.sessions.discard(session_id)
+        worker.send("stop", session_id, persist)
+
+    def stats(self, timeout=1):
+        return [worker.request("stats", timeout=timeout)
+                for worker in self.workers if worker.is_alive()]
+
+    def stop(self, timeout=5):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.send("exit")
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        log.info("VNC recorder service stopped")
+
+
 class VNCVideoHelper:
     recorder = None
-    proxy = None
-    __proxy_port = None
+    persist = None
     __filepath = None
 
-    def __init__(self, host, port=5900, filename_prefix='vnc'):
+    def __init__(self, host, port=5900, filename_prefix='vnc', service=None):
+        """
+        :param service: VNCRecorderService, recording process
+        is started per session if it's not set
+        """
+        self.service = service
         self.filename_prefix = filename_prefix
         self.dir_path = os.sep.join([config.SCREENSHOTS_DIR,
                                      str(self.filename_prefix)])
@@ -32,22 +534,11 @@ class VNCVideoHelper:
         self.port = port
 
     @staticmethod
-    def _flvrec(filename, host='localhost', port=5900,
-                framerate=12, keyframe=120,
-                preferred_encoding=(0,),
-                blocksize=32, clipping=None,
-                debug=0):
-        fp = file(filename, 'wb')
-        pwdcache = rfb.PWDCache('%s:%d' % (host, port))
-        writer = flv.FLVWriter(fp, framerate=framerate, debug=debug)
-        sink = video.FLVVideoSink(
-            writer,
-            blocksize=blocksize, framerate=framerate, keyframe=keyframe,
-            clipping=clipping, debug=debug)
-        client = rfb.RFBNetworkClient(
-            host, port, sink, timeout=500/framerate,
-            pwdcache=pwdcache, preferred_encoding=preferred_encoding,
-            debug=debug)
+    def _flvrec(filename, host='localhost', port=5900, log_filename=None,
+                persist=None, **kwargs):
+        if log_filename:
+            sys.stderr = sys.stdout = open(log_filename, 'w')
+        recording = Recording(filename, host, port, **kwargs)
         log.debug('Start vnc recording to %s' % filename)
         return_code = 0
         try:
@@ -55,18 +546,13 @@ class VNCVideoHelper:
                 log.debug("%s %s" % (sig, frame))
                 raise SystemExit
             signal.signal(signal.SIGTERM, sigterm_handler)
-            client.open()
-            try:
-                current_time = time.time()
-                max_duration = getattr(config, "SCREENCAST_RECORDER_MAX_DURATION", 1800)
-                while True:
-                    if time.time() - current_time > max_duration:
-                        log.warning("VNC recorder for {} has been stopped "
-                                    "because max duration({}) was exceeded".format(filename, max_duration))
-                        raise SystemExit
-                    client.idle()
-            finally:
-                client.close()
+            recording.connect()
+            while True:
+                if recording.expired:
+                    log.warning("VNC recorder for {} has been stopped "
+                                "because max duration was exceeded".format(filename))
+                    raise SystemExit
+                recording.client.idle()
         except Exception as e:
             if isinstance(e, SystemExit):
                 log.info("VNC recorder process({}): Got SIGTERM. stopping...".format(filename))
@@ -74,8 +560,7 @@ class VNCVideoHelper:
                 log.exception("Error in VNC recorder process({})".format(filename))
                 return_code = 1
         finally:
-            writer.close()
-            fp.close()
+            recording.close(persist is not None and persist.is_set())
             exit(return_code)
             log.info('Stopped vnc recording to %s' % filename)
 
@@ -91,41 +576,41 @@ class VNCVideoHelper:
             os.remove(vnc_log)
             log.debug('File %s was deleted' % vnc_log)
 
-    def start_proxy(self):
-        self.__proxy_port = get_free_port()
-        sys.argv = [
-            "--daemon",
-            "--wrap-mode=ignore",
-            "--record=%s/proxy_vnc_%s.log" % (self.dir_path, self.port),
-            "0.0.0.0:%d" % self.__proxy_port,
-            "%s:%s" % (self.host, self.port)
-        ]
-
-        self.proxy = multiprocessing.Process(
-            target=websockify.websocketproxy.websockify_init
-        )
-
-        self.proxy.start()
-
-    def get_proxy_port(self):
-        return self.__proxy_port
-
-    def stop_proxy(self):
-        if self.proxy and self.proxy.is_alive():
-            self.proxy.terminate()
-
     def start_recording(self, framerate=5, size=(800, 600)):
-        sys.stderr = sys.stdout = open(os.sep.join([
-            self.dir_path, 'vnc_video.log'
-        ]), 'w')
         self.__filepath = os.sep.join([self.dir_path,
                                        str(self.filename_prefix) + '.flv'])
 
         kwargs = {
             'framerate': framerate,
             'clipping': video.str2clip("%sx%s+0-0" % (size[0], size[1])),
-            'debug': 1
+            'buffer_duration': getattr(config, "SCREENCAST_BUFFER_DURATION", 0),
+            'buffer_size': getattr(config, "SCREENCAST_BUFFER_MAX_SIZE", 64 * 1024 * 1024)
         }
+        if getattr(config, "SCREENCAST_ADAPTIVE", False):
+            kwargs.update({
+                'framerate': getattr(config, "SCREENCAST_MAX_FRAMERATE", 10),
+                'adaptive': True,
+                'idle_interval': getattr(config, "SCREENCAST_IDLE_FRAME_INTERVAL", 10) * 1000,
+                'keyframe_interval': getattr(config, "SCREENCAST_KEYFRAME_INTERVAL", 10) * 1000
+            })
+        if self.service:
+            worker = self.service.start_recording(
+                self.filename_prefix, self.__filepath, self.host, self.port,
+                **kwargs
+            )
+            log.info(
+                "Started screencast recording(worker:{}) for {}:{} to {}".format(
+                    worker.index, self.host, self.port, self.dir_path
+                )
+            )
+            return
+
+        self.persist = multiprocessing.Event()
+        kwargs.update({
+            'debug': 1,
+            'log_filename': os.sep.join([self.dir_path, 'vnc_video.log']),
+            'persist': self.persist
+        })
         self.recorder = multiprocessing.Process(
             target=self._flvrec,
             args=(self.__filepath, self.host, self.port),
@@ -139,8 +624,18 @@ class VNCVideoHelper:
             )
         )
 
-    def stop_recording(self):
+    def stop_recording(self, persist=True):
+        """
+        :param persist: write buffered video to file,
+        used only if SCREENCAST_BUFFER_DURATION is set
+        """
+        if self.service:
+            self.service.stop_recording(self.filename_prefix, persist)
+            return
+
         if self.recorder and self.recorder.is_alive():
+            if persist:
+                self.persist.set()
             self.recorder.terminate()
             log.info(
                 "Stopped screencast recording(pid:{}) for {}:{} to {}".format(
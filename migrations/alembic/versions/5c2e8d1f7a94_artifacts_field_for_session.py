@@ -0,0 +1,21 @@
+"""artifacts field for session
+
+Revision ID: 5c2e8d1f7a94
+Revises: 4f80a6b3ffc2
+Create Date: 2026-10-18 14:02:11.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5c2e8d1f7a94'
+down_revision = '4f80a6b3ffc2'
+
+
+def upgrade():
+    op.add_column('sessions', sa.Column('artifacts', sa.String))
+
+
+def downgrade():
+    op.drop_column('sessions', 'artifacts')
@@ -11,6 +11,7 @@ import unittest
 
 from mock import Mock, patch
 from nose.twistedtools import reactor
+from twisted.internet.defer import succeed
 
 from core.utils.network_utils import get_socket
 
@@ -79,9 +80,11 @@ def get_session_request(address, session):
                    "/wd/hub/session/%s" % str(session))
 
 
-def run_script(address, session, script):
-    return request("%s:%s" % address, "POST",
-                   "/wd/hub/session/%s/vmmaster/runScript" % str(session),
+def run_script(address, session, script, stream=False):
+    url = "/wd/hub/session/%s/vmmaster/runScript" % str(session)
+    if stream:
+        url += "?stream=1"
+    return request("%s:%s" % address, "POST", url,
                    body=json.dumps({"script": script}))
 
 
@@ -231,4 +234,4 @@ def vmmaster_server_mock(port):
 
 
 def request_mock(**kwargs):
-    return Mock(status_code=200, headers={}, content=json.dumps({'status': 0}))
+    return succeed((200, {}, json.dumps({'status': 0})))
@@ -3,8 +3,7 @@
 import json
 from datetime import datetime
 from mock import Mock, patch
-from multiprocessing import Process
-from helpers import BaseTestCase, fake_home_dir, DatabaseMock, wait_for
+from helpers import BaseTestCase, fake_home_dir, DatabaseMock
 from lode_runner import dataprovider
 from core import constants
 
@@ -127,6 +126,117 @@ class TestApi(BaseTestCase):
         self.assertEqual(screenshots_count, len(screenshots))
         self.assertEqual(200, body['metacode'])
 
+    def test_get_resized_screenshot(self):
+        """
+        - get screenshot of step resized to width
+        - get it again with etag of first response
+
+        Expected: resized png, then 304 without resizing
+        """
+        import os
+        import shutil
+        from StringIO import StringIO
+        from PIL import Image
+        from core.config import config
+        path = os.sep.join([config.SCREENSHOTS_DIR, "1", "1.png"])
+        os.makedirs(os.path.dirname(path))
+        Image.new("RGB", (256, 128), "white").save(path, "PNG")
+        step = Mock(session_id=1, screenshot=path)
+
+        with patch('flask.current_app.database.get_step_by_id',
+                   Mock(return_value=step)):
+            response = self.vmmaster_client.get(
+                '/api/session/1/step/1/screenshot?width=64')
+            with patch('core.screenshots.resize', Mock()) as resize:
+                cached_response = self.vmmaster_client.get(
+                    '/api/session/1/step/1/screenshot?width=64',
+                    headers={'If-None-Match': response.headers['ETag']})
+        shutil.rmtree(os.path.dirname(path))
+        shutil.rmtree(self.app.thumbnails.directory)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/png', response.mimetype)
+        self.assertEqual(
+            (64, 32), Image.open(StringIO(response.data)).size)
+        self.assertEqual(304, cached_response.status_code)
+        self.assertFalse(resize.called)
+
+    def test_get_full_size_screenshot(self):
+        """
+        - get screenshot of step without width
+
+        Expected: png file was sent as is
+        """
+        import os
+        import shutil
+        from core.config import config
+        path = os.sep.join([config.SCREENSHOTS_DIR, "1", "1.png"])
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("png content")
+        step = Mock(session_id=1, screenshot=path)
+
+        try:
+            with patch('flask.current_app.database.get_step_by_id',
+                       Mock(return_value=step)):
+                response = self.vmmaster_client.get(
+                    '/api/session/1/step/1/screenshot')
+                data = response.data
+                response.close()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/png', response.mimetype)
+        self.assertEqual("png content", data)
+        self.assertIsNotNone(response.headers.get('ETag'))
+
+    @dataprovider([
+        ('not a png', 415),
+        (None, 404)
+    ])
+    def test_get_resized_invalid_screenshot(self, content, code):
+        """
+        - get resized screenshot which isn't png or was deleted
+
+        Expected: error code instead of server error
+        """
+        import os
+        import shutil
+        from core.config import config
+        path = os.sep.join([config.SCREENSHOTS_DIR, "1", "1.png"])
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content or "")
+        if content is None:
+            os.remove(path)
+
+        try:
+            with patch('vmmaster.api.helpers.get_screenshot_path',
+                       Mock(return_value=path)):
+                response = self.vmmaster_client.get(
+                    '/api/session/1/step/1/screenshot?width=64')
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+            shutil.rmtree(self.app.thumbnails.directory, ignore_errors=True)
+
+        self.assertEqual(code, json.loads(response.data)['metacode'])
+
+    @dataprovider([
+        ('?width=64', 2, 404),
+        ('?width=0', 1, 400),
+        ('?height=64', 1, 400)
+    ])
+    def test_get_screenshot_with_wrong_params(self, query, session_id, code):
+        step = Mock(session_id=session_id, screenshot=__file__)
+
+        with patch('flask.current_app.database.get_step_by_id',
+                   Mock(return_value=step)):
+            response = self.vmmaster_client.get(
+                '/api/session/1/step/1/screenshot%s' % query)
+        body = json.loads(response.data)
+        self.assertEqual(code, body['metacode'])
+
     def test_get_screenshots_for_label(self):
 
         steps = [
@@ -149,71 +259,62 @@ class TestApi(BaseTestCase):
         self.assertEqual(1, len(screenshots))
         self.assertEqual(200, body['metacode'])
 
-    def test_failed_get_vnc_info_with_create_proxy(self):
+    def test_get_vnc_info(self):
+        """
+        - run session
+        - get vnc info
+
+        Expected: websocket proxy path of vmmaster server
+        """
         from core.sessions import Session
         endpoint = Mock(ip='127.0.0.1')
         session = Session()
         session.name = "session1"
         session.created = session.modified = datetime.now()
+        session.run(endpoint)
 
-        expected = 5901
-
-        with patch(
-            'flask.current_app.sessions.active',
-            Mock(return_value=[session])
-        ), patch(
-                'websockify.websocketproxy.websockify_init', Mock()
-        ):
-            session.run(endpoint)
-            response = self.vmmaster_client.get(
-                '/api/session/%s/vnc_info' % session.id)
+        response = self.vmmaster_client.get(
+            '/api/session/%s/vnc_info' % session.id)
 
         body = json.loads(response.data)
         self.assertEqual(200, response.status_code)
-
-        vnc_proxy_port = body['result']['vnc_proxy_port']
-        self.assertEqual(type(expected), type(vnc_proxy_port))
+        self.assertDictEqual({
+            'vnc_proxy_port': 9001,
+            'vnc_proxy_path': 'proxy/vnc/%s' % session.id,
+            'vnc_proxy_traffic': {}
+        }, body['result'])
         self.assertEqual(200, body['metacode'])
-        self.assertTrue(isinstance(session.vnc_helper.proxy, Process))
-
         session.close()
-        self.assertTrue(wait_for(
-            lambda: not session.vnc_helper.proxy.is_alive()))
 
-    def test_get_vnc_info_for_running_proxy(self):
+    def test_get_vnc_info_with_connected_viewers(self):
+        """
+        - run session
+        - get vnc info while proxy has viewers of session
+
+        Expected: traffic of session viewers
+        """
         from core.sessions import Session
         endpoint = Mock(ip='127.0.0.1')
         session = Session()
         session.name = "session1"
         session.created = session.modified = datetime.now()
         session.run(endpoint)
-        session.vnc_helper = Mock(proxy=Mock(),
-                                  get_proxy_port=Mock(return_value=5900))
-
-        expected = {
-            'vnc_proxy_port': 5900
-        }
+        traffic = {'viewers': 1, 'to_vm': 10, 'from_vm': 1000}
+        self.app.vnc_proxy = Mock(stats=Mock(return_value=traffic))
 
         response = self.vmmaster_client.get(
             '/api/session/%s/vnc_info' % session.id)
 
         body = json.loads(response.data)
-        self.assertEqual(200, response.status_code)
-
-        vnc_proxy_port = body['result']
-        self.assertDictEqual(expected, vnc_proxy_port)
-        self.assertEqual(200, body['metacode'])
+        self.assertDictEqual(traffic, body['result']['vnc_proxy_traffic'])
+        self.app.vnc_proxy.stats.assert_called_once_with(session.id)
         session.close()
+        self.app.vnc_proxy.disconnect.assert_called_once_with(session.id)
 
     def test_get_vnc_info_if_session_not_found(self):
         with patch(
                 'flask.current_app.sessions.active',
                 Mock(return_value=[])
-        ), patch(
-                'websockify.websocketproxy.websockify_init', Mock()
-        ), patch(
-                'core.utils.network_utils.get_free_port',
-                Mock(side_effect=5900)
         ):
             response = self.vmmaster_client.get('/api/session/1/vnc_info')
         body = json.loads(response.data)
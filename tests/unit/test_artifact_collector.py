@@ -1,5 +1,10 @@
 # coding: utf-8
 import os
+import gzip
+import shutil
+import json
+import time
+import shlex
 
 from flask import Flask
 from mock import patch, Mock
@@ -7,11 +12,13 @@ from tests.unit.helpers import BaseTestCase, DatabaseMock, wait_for
 from core.config import config, setup_config
 
 
-def run_script_mock(script, host):
-    yield 200, {}, '{"output": "test text"}'
+def run_script_mock(script, host, output=None):
+    output.write("test ")
+    output.write("text")
+    yield 200, {}, '{"status": 0, "output": ""}'
 
 
-def failed_run_script_mock(script, host):
+def failed_run_script_mock(script, host, output=None):
     yield 500, {}, ''
 
 
@@ -33,6 +40,7 @@ class TestArtifactCollector(BaseTestCase):
 
     def tearDown(self):
         self.ctx.pop()
+        shutil.rmtree(os.sep.join([config.SCREENSHOTS_DIR, '1']), ignore_errors=True)
 
     @patch('vmpool.artifact_collector.run_script', run_script_mock)
     def test_add_tasks(self):
@@ -116,9 +124,10 @@ class TestArtifactCollector(BaseTestCase):
 
     def test_unavailable_run_script_during_add_tasks(self):
         """
-        - add tasks
+        - add tasks, agent is unavailable
 
-        Expected: selenium log was saved and endpoint was deleted
+        Expected: selenium log wasn't saved, error wasn't written to file,
+        endpoint was deleted
         """
         from vmpool.artifact_collector import ArtifactCollector
         with patch(
@@ -144,30 +153,96 @@ class TestArtifactCollector(BaseTestCase):
             in_queue = art_collector.add_tasks(session.id, {'selenium_server': '/var/log/selenium_server.log'})
 
         self.assertTrue(in_queue)
-        self.assertTrue(wait_for(
-            lambda: session.selenium_log == log_path))
-        with open(session.selenium_log, 'r') as f:
-            text = f.read()
-            self.assertEqual(text, '[Errno -2] Name or service not known')
         self.assertTrue(wait_for(
             lambda: len(art_collector.get_queue()) == 0))
         self.assertTrue(wait_for(
             lambda: session.endpoint.delete.called))
+        self.assertIsNone(session.selenium_log)
+        self.assertFalse(os.path.exists(log_path))
         art_collector.stop()
 
+    def test_artifact_writer_compress_and_size_cap(self):
+        """
+        - write chunks to compressed writer with size cap
+
+        Expected: gzipped file contains output up to cap, writer truncated
+        """
+        from vmpool.artifact_collector import ArtifactWriter
+        path = os.sep.join([config.SCREENSHOTS_DIR, '1', 'selenium_server.log'])
+        writer = ArtifactWriter(path, compress=True, max_size=6)
+        for chunk in ("test ", u"text", "more"):
+            writer.write(chunk)
+        writer.close()
+
+        self.assertEqual(path + ".gz", writer.path)
+        self.assertEqual({
+            "path": writer.path, "received": 13, "written": 6,
+            "truncated": True
+        }, writer.info)
+        with gzip.open(writer.path, 'rb') as f:
+            self.assertEqual('test t', f.read())
+
+    def test_collect_artifacts_by_globs(self):
+        """
+        - collect plain artifact and glob artifact with size limit
+
+        Expected: every found file was saved, large file was truncated,
+        artifacts were registered on session with one save
+        """
+        from vmpool.artifact_collector import ArtifactTask, collect_artifacts
+        files = {
+            '/var/log/selenium_server.log': 'selenium log',
+            '/tmp/chrome.log': 'chrome log',
+            '/tmp/firefox $(reboot).log': 'firefox log'
+        }
+        scripts = []
+
+        def agent_mock(script, host, output=None):
+            command = json.loads(script)["script"]
+            scripts.append(command)
+            if command.startswith('for'):
+                output = '/tmp/chrome.log\0/tmp/firefox $(reboot).log\0'
+                yield 200, {}, json.dumps({"status": 0, "output": output})
+                return
+            output.write(files[shlex.split(command)[-1]])
+            yield 200, {}, '{"status": 0, "output": ""}'
+
+        session = Mock(id=1, endpoint_ip='127.0.0.1', selenium_log=None)
+        self.app.database.get_session = Mock(return_value=session)
+        task = ArtifactTask(1, {
+            'selenium_server': '/var/log/selenium_server.log',
+            'browser': {'path': '/tmp/*.log', 'max_size': 6}
+        })
+
+        with patch('vmpool.artifact_collector.run_script', agent_mock):
+            collect_artifacts(task)
+
+        session_dir = os.sep.join([config.SCREENSHOTS_DIR, '1'])
+        artifacts = json.loads(session.artifacts)
+        self.assertEqual({
+            'selenium_server': os.sep.join([session_dir, 'selenium_server.log']),
+            'browser/chrome': os.sep.join([session_dir, 'browser', 'chrome.log']),
+            'browser/firefox $(reboot)': os.sep.join([session_dir, 'browser', 'firefox $(reboot).log'])
+        }, artifacts)
+        self.assertEqual(artifacts['selenium_server'], session.selenium_log)
+        session.save.assert_called_once_with()
+        self.assertIn('head -c 7 /tmp/chrome.log', scripts)
+        self.assertIn("head -c 7 '/tmp/firefox $(reboot).log'", scripts)
+        self.assertTrue(scripts[0].startswith('for f in /tmp/*.log;'))
+        with open(artifacts['browser/firefox $(reboot)']) as f:
+            self.assertEqual('firefo', f.read())
+        self.assertTrue(task.writers['browser/firefox $(reboot)'].truncated)
+
     def test_stop_artifact_collector(self):
         """
         - stop artifact collector
 
         Expected: all tasks were deleted
         """
-        from vmpool.artifact_collector import ArtifactCollector
-        from multiprocessing.pool import AsyncResult
+        from vmpool.artifact_collector import ArtifactCollector, ArtifactTask
 
         art_collector = ArtifactCollector(Mock())
-        task = AsyncResult(cache={1: ""}, callback=None)
-        task._job = 1
-        task._ready = True
+        task = ArtifactTask(1, {'selenium_server': '/var/log/selenium_server.log'})
         art_collector.in_queue = {
             1: [task]
         }
@@ -175,3 +250,91 @@ class TestArtifactCollector(BaseTestCase):
 
         self.assertTrue(wait_for(
             lambda: len(art_collector.get_queue()) == 0))
+        self.assertTrue(task.ready())
+
+    def test_failed_sessions_first_and_hypervisor_limit(self):
+        """
+        - add tasks of succeed sessions and failed session on one hypervisor
+        - add task of succeed session on another hypervisor
+        - take tasks
+
+        Expected: failed session was first, second task was from
+        another hypervisor, no tasks over hypervisor limit
+        """
+        from vmpool.artifact_collector import ArtifactCollector, \
+            PRIORITY_FAILED, PRIORITY_DEFAULT
+
+        art_collector = ArtifactCollector(Mock(), hypervisor_limit=1)
+        art_collector.close()
+        path = '/var/log/selenium_server.log'
+        for session_id, priority, hypervisor in (
+            (1, PRIORITY_DEFAULT, 'node1'),
+            (2, PRIORITY_FAILED, 'node1'),
+            (3, PRIORITY_DEFAULT, 'node2')
+        ):
+            art_collector.add_task(
+                session_id, 'selenium_server', path, priority, hypervisor
+            )
+
+        self.assertEqual(2, art_collector.next_task().session_id)
+        self.assertEqual(3, art_collector.next_task().session_id)
+        self.assertIsNone(art_collector.next_task())
+        self.assertEqual([1, 2, 3], sorted(art_collector.get_queue()))
+
+    def test_unknown_hypervisor_is_not_limited(self):
+        """
+        - add three tasks without hypervisor
+        - take tasks with hypervisor limit 1
+
+        Expected: all tasks were taken
+        """
+        from vmpool.artifact_collector import ArtifactCollector
+
+        art_collector = ArtifactCollector(Mock(), hypervisor_limit=1)
+        art_collector.close()
+        for session_id in (1, 2, 3):
+            art_collector.add_task(
+                session_id, 'selenium_server', '/var/log/selenium_server.log'
+            )
+
+        self.assertEqual(
+            [1, 2, 3],
+            [art_collector.next_task().session_id for _ in range(3)]
+        )
+
+    def test_task_timeout_releases_endpoint(self):
+        """
+        - add task which runs longer than timeout
+
+        Expected: task was aborted, its websocket was closed,
+        endpoint was deleted
+        """
+        from vmpool.artifact_collector import ArtifactCollector
+        endpoint = Mock(delete=Mock())
+        session = Mock(id=1, endpoint_name='test_endpoint')
+        self.app.database.get_session = Mock(return_value=session)
+        vmpool = Mock(get_by_name=Mock(return_value=endpoint))
+        vmpool.app = self.app
+        self.app.pool = vmpool
+
+        ws = Mock(keep_running=True)
+
+        def collect(task):
+            writer = task.writer('selenium_server', '/var/log/selenium_server.log')
+            writer.attach(ws)
+            time.sleep(1)
+
+        with patch(
+            'vmpool.artifact_collector.collect_artifacts',
+            Mock(side_effect=collect)
+        ):
+            art_collector = ArtifactCollector(vmpool, timeout=0.1)
+            art_collector.add_tasks(1, {'selenium_server': '/var/log/selenium_server.log'})
+            task = art_collector.in_queue[1][0]
+
+            self.assertTrue(wait_for(lambda: endpoint.delete.called))
+        self.assertTrue(task.aborted)
+        self.assertFalse(ws.keep_running)
+        self.assertTrue(ws.sock.abort.called)
+        self.assertEqual(0, len(art_collector.get_queue()))
+        art_collector.stop()
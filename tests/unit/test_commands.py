@@ -4,6 +4,7 @@ import copy
 import json
 
 from mock import Mock, PropertyMock, patch
+from twisted.internet.defer import succeed
 from helpers import Handler, BaseTestCase
 from helpers import ServerMock, get_free_port, DatabaseMock
 
@@ -148,9 +149,9 @@ class TestStartSessionCommands(CommonCommandsTestCase):
         Mock(return_value=True)
     )
     @patch(
-        'requests.request', Mock(side_effect=Mock(
+        'core.http_pool.EndpointHTTPPool.request', Mock(side_effect=Mock(
             __name__="request",
-            return_value=(200, {}, json.dumps({'status': 0}))))
+            return_value=succeed((200, {}, json.dumps({'status': 0})))))
     )
     def test_start_session_when_session_was_timeouted(self):
         request = copy.copy(self.request)
@@ -162,15 +163,46 @@ class TestStartSessionCommands(CommonCommandsTestCase):
         Mock(return_value=True)
     )
     @patch(
-        'requests.request', Mock(side_effect=Mock(
+        'core.http_pool.EndpointHTTPPool.request', Mock(side_effect=Mock(
             __name__="request",
-            return_value=(200, {}, json.dumps({'status': 0}))))
+            return_value=succeed((200, {}, json.dumps({'status': 0})))))
     )
     def test_start_session_when_session_was_closed(self):
         request = copy.copy(self.request)
         self.assertRaises(SessionException, self.commands.start_session,
                           request, self.session)
 
+    @patch(
+        'vmmaster.webdriver.commands.selenium_status',
+        Mock(__name__="selenium_status")
+    )
+    def test_start_session_with_hot_session(self):
+        """
+        - vm has hot session matching desired capabilities
+        - start session
+
+        Expected: hot session was adopted, selenium session wasn't started
+        """
+        from vmpool.clone import HotSession
+        profile = {"browserName": "firefox", "version": "",
+                   "javascriptEnabled": True}
+        self.session.endpoint.take_hot_session = Mock(
+            return_value=HotSession("selenium1", profile, json.dumps(
+                {"sessionId": "selenium1", "status": 0, "value": profile})))
+        request = copy.copy(self.request)
+
+        with patch.object(
+            config, "HOT_SESSION_PROFILES", [profile], create=True
+        ):
+            status, headers, body = self.commands.start_session(
+                request, self.session)
+
+        self.assertEqual(200, status)
+        self.assertEqual(self.session.id, json.loads(body)["sessionId"])
+        self.assertEqual("selenium1", self.session.selenium_session)
+        self.assertFalse(self.commands.selenium_status.called)
+        self.assertFalse(self.commands.start_selenium_session.called)
+
 
 @patch('flask.current_app.database', Mock())
 class TestStartSeleniumSessionCommands(CommonCommandsTestCase):
@@ -312,6 +344,22 @@ class TestCheckVmOnline(CommonCommandsTestCase):
             CreationException, self.commands.ping_vm, self.session
         )
 
+    def test_check_vm_online_skipped_for_healthy_vm(self):
+        """
+        - vm was pinged successfully just now
+        - ping vm with closed selenium port
+
+        Expected: ping was skipped, cache hit was counted
+        """
+        from vmpool import HealthState
+        config.SELENIUM_PORT = get_free_port()
+        self.session.endpoint.health = HealthState()
+        self.session.endpoint.health.update(True)
+        hits = HealthState.stats()["hits"]
+
+        self.assertTrue(self.commands.ping_vm(self.session))
+        self.assertEqual(hits + 1, HealthState.stats()["hits"])
+
     def test_check_vm_online_status_failed(self):
         def do_GET(handler):
             handler.send_reply(500, self.response_headers,
@@ -464,6 +512,48 @@ class TestRunScript(CommonCommandsTestCase):
         self.assertEqual(200, response[0])
         self.assertEqual(self.response_body, response[2])
 
+    @patch('flask.current_app.database', Mock())
+    @patch(
+        'vmmaster.webdriver.helpers.is_request_closed',
+        Mock(return_value=False)
+    )
+    def test_run_script_updates_sub_step_once_per_interval(self):
+        """
+        - agent sends 100 output messages at once
+
+        Expected: sub-step was updated with first message and on close,
+        full output was returned
+        """
+        class WebSocketAppMock(object):
+            def __init__(self, host, on_message, on_close, on_open,
+                         on_error):
+                self.on_message = on_message
+                self.on_close = on_close
+
+            def run_forever(self):
+                for i in range(100):
+                    self.on_message(self, "%s\n" % i)
+                self.on_close(self)
+
+            def close(self):
+                pass
+
+        self.session.add_session_step("POST /runScript")
+        with patch(
+            'websocket.WebSocketApp', WebSocketAppMock
+        ), patch(
+            'vmmaster.webdriver.commands.update_log_step', Mock()
+        ) as update_mock:
+            status, headers, body = self.commands.run_script(
+                self.request, self.session)
+
+        output = "".join("%s\n" % i for i in range(100))
+        self.assertEqual(200, status)
+        self.assertEqual(output, json.loads(body)["output"])
+        self.assertEqual(2, update_mock.call_count)
+        self.assertEqual(
+            output, json.loads(update_mock.call_args[1]["message"])["output"])
+
 
 class TestLabelCommands(CommonCommandsTestCase):
     def test_label(self):
@@ -481,3 +571,161 @@ class TestLabelCommands(CommonCommandsTestCase):
         json_body = json.loads(body)
         self.assertEqual(json_body["value"], label)
         self.assertEqual(json_body["labelId"], label_id)
+
+
+class TestScreenshotCapture(CommonCommandsTestCase):
+    def test_capture_policies(self):
+        """
+        - pass commands to capture policies
+
+        Expected: screenshots are taken for failed commands,
+        every n-th command and commands which change page
+        """
+        from vmmaster.webdriver.capture import CapturePolicy
+        path = "/wd/hub/session/1/url"
+        url = json.dumps({"url": "http://example.com"})
+
+        failure = CapturePolicy("failure")
+        self.assertTrue(failure.should_capture("POST", path, url, 500, "{}"))
+        self.assertTrue(failure.should_capture(
+            "POST", path, url, 200, json.dumps({"status": 7})))
+        self.assertFalse(failure.should_capture(
+            "POST", path, url, 200, json.dumps({"status": 0})))
+
+        every_n = CapturePolicy("every_n", every=2)
+        self.assertEqual(
+            [False, True, False, True],
+            [every_n.should_capture("GET", path, "", 200, "{}")
+             for _ in range(4)]
+        )
+
+        changed = CapturePolicy("changed")
+        self.assertTrue(changed.should_capture("POST", path, url, 200, "{}"))
+        self.assertFalse(changed.should_capture("POST", path, url, 200, "{}"))
+        self.assertFalse(changed.should_capture("GET", path, "", 200, "{}"))
+        self.assertTrue(changed.should_capture(
+            "POST", "/wd/hub/session/1/element/1/click", "{}", 200, "{}"))
+
+    def test_screenshots_are_coalesced(self):
+        """
+        - take screenshot after three steps while first one is taken
+
+        Expected: screenshots were taken for first and last steps only
+        """
+        from threading import Event
+        from helpers import wait_for
+        from vmmaster.webdriver.capture import ScreenshotCapture
+        started, taken = Event(), Event()
+
+        def take_screenshot(session, port):
+            started.set()
+            taken.wait(5)
+            yield "screenshot"
+
+        steps = [Mock(name="step%s" % i) for i in range(3)]
+        capture = ScreenshotCapture(self.session)
+        with patch(
+            'vmmaster.webdriver.commands.take_screenshot', take_screenshot
+        ), patch(
+            'vmmaster.webdriver.helpers.save_screenshot', Mock()
+        ) as save_screenshot:
+            capture.schedule(steps[0])
+            started.wait(5)
+            for step in steps[1:]:
+                capture.schedule(step)
+            taken.set()
+            self.assertTrue(wait_for(lambda: capture.thread is None))
+
+        self.assertEqual(
+            [steps[0], steps[2]],
+            [call[0][2] for call in save_screenshot.call_args_list]
+        )
+
+    def test_last_screenshot_is_taken_on_close(self):
+        """
+        - take screenshot after two steps while first one is taken
+        - close session and flush capture
+        - take screenshot after close
+
+        Expected: screenshot of last step was taken before flush returned,
+        screenshot after close wasn't taken
+        """
+        from threading import Event
+        from vmmaster.webdriver.capture import ScreenshotCapture
+        started, taken = Event(), Event()
+
+        def take_screenshot(session, port):
+            started.set()
+            taken.wait(5)
+            yield "screenshot"
+
+        steps = [Mock(name="step%s" % i) for i in range(3)]
+        capture = ScreenshotCapture(self.session)
+        with patch(
+            'vmmaster.webdriver.commands.take_screenshot', take_screenshot
+        ), patch(
+            'vmmaster.webdriver.helpers.save_screenshot', Mock()
+        ) as save_screenshot, patch.object(
+            self.session, 'closed', False
+        ):
+            capture.schedule(steps[0])
+            started.wait(5)
+            capture.schedule(steps[1])
+            self.session.closed = True
+            taken.set()
+            capture.flush(5)
+            capture.schedule(steps[2])
+
+        self.assertEqual(
+            [steps[0], steps[1]],
+            [call[0][2] for call in save_screenshot.call_args_list]
+        )
+        self.assertIsNone(capture.thread)
+
+    def test_screenshot_of_failure_is_taken_at_once(self):
+        """
+        - failed command without screenshot in response
+          with failure screenshot policy
+
+        Expected: screenshot was taken in request thread
+        """
+        from vmmaster.webdriver.capture import ScreenshotCapture, CapturePolicy
+        capture = ScreenshotCapture(self.session, CapturePolicy("failure"))
+        with patch(
+            'vmmaster.webdriver.commands.take_screenshot',
+            Mock(return_value=iter(["screenshot"]))
+        ), patch(
+            'vmmaster.webdriver.helpers.save_screenshot', Mock()
+        ) as save_screenshot, patch(
+            'core.sessions.Session.current_log_step',
+            PropertyMock(return_value=Mock(id=1))
+        ):
+            capture.on_command(
+                "POST", "/wd/hub/session/1/element/1/click", "{}", 500, "{}"
+            )
+
+        self.assertEqual(1, save_screenshot.call_count)
+        self.assertIsNone(capture.thread)
+
+    def test_screenshot_from_failed_response(self):
+        """
+        - failed command with screenshot in response
+
+        Expected: screenshot from response was saved,
+        vmmaster agent wasn't requested
+        """
+        from vmmaster.webdriver import capture
+        self.session.take_screenshot = True
+        body = json.dumps({"status": 13, "value": {"screen": "screenshot"}})
+        with patch(
+            'vmmaster.webdriver.commands.take_screenshot', Mock()
+        ) as take_screenshot, patch(
+            'vmmaster.webdriver.helpers.save_screenshot', Mock()
+        ) as save_screenshot:
+            capture.take_screenshot(
+                self.session, "POST", "/wd/hub/session/1/element/1/click",
+                "{}", 500, body
+            )
+
+        save_screenshot.assert_called_once_with(self.session, "screenshot")
+        self.assertFalse(take_screenshot.called)
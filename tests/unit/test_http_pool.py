@@ -0,0 +1,86 @@
+# coding: utf-8
+
+from Queue import Empty
+
+from core.config import setup_config
+from helpers import BaseTestCase, ServerMock, get_free_port
+from nose.twistedtools import reactor
+
+
+class TestEndpointHTTPPool(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_config('data/config.py')
+        cls.host = "localhost"
+        cls.server = ServerMock(cls.host, get_free_port())
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        from core.http_pool import EndpointHTTPPool
+        self.http_pool = EndpointHTTPPool(self.host, _reactor=reactor)
+        self.url = "http://%s:%s/" % (self.host, self.server.port)
+
+    def tearDown(self):
+        self.http_pool.close()
+
+    def test_request_from_thread(self):
+        """
+        - make request from non-reactor thread
+
+        Expected: response was received, no pending requests left
+        """
+        result = self.http_pool.request_from_thread(
+            method="POST", url=self.url,
+            headers={"reply": "200", "Content-Length": 4}, data="body"
+        )
+        status, headers, body = result.get(timeout=5)
+
+        self.assertEqual(200, status)
+        self.assertEqual("body", body)
+        self.assertEqual(0, len(self.http_pool.pending))
+
+    def test_request_timeout(self):
+        """
+        - make request to port which never answers
+
+        Expected: request failed with TimeoutError
+        """
+        import socket
+        from twisted.internet.error import TimeoutError
+
+        sock = socket.socket()
+        sock.bind((self.host, 0))
+        sock.listen(1)
+        url = "http://%s:%s/" % (self.host, sock.getsockname()[1])
+
+        result = self.http_pool.request_from_thread(
+            method="GET", url=url, timeout=0.1
+        )
+        failure = result.get(timeout=5)
+        sock.close()
+
+        self.assertTrue(failure.check(TimeoutError))
+
+    def test_request_after_close(self):
+        """
+        - close pool
+        - make request
+
+        Expected: request was not sent
+        """
+        self.http_pool.close()
+        result = self.http_pool.request_from_thread(method="GET", url=self.url)
+
+        self.assertIsInstance(result.get(timeout=5), RuntimeError)
+        self.assertRaises(Empty, result.get_nowait)
+
+    def test_remove_hop_by_hop_headers(self):
+        from core.http_pool import remove_hop_by_hop_headers
+        headers = {"Connection": "close", "keep-alive": "1", "Accept": "*/*"}
+
+        self.assertEqual({"Accept": "*/*"},
+                         remove_hop_by_hop_headers(headers))
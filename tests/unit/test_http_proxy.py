@@ -4,9 +4,12 @@ from mock import Mock, patch
 from core.config import setup_config
 
 from helpers import (vmmaster_server_mock, server_is_up, server_is_down,
-                     BaseTestCase, get_free_port, ServerMock)
+                     BaseTestCase, get_free_port, ServerMock, wait_for)
 
+import socket
 import requests
+import websocket
+from threading import Thread
 
 
 class TestHttpProxy(BaseTestCase):
@@ -87,3 +90,123 @@ class TestHttpProxy(BaseTestCase):
             "make sure you request uri has "
             "/proxy/session/<session_id>/port/<port_number>/<destination>",
             response.content)
+
+
+class EchoServer(Thread):
+    def __init__(self, host, port):
+        Thread.__init__(self)
+        self.daemon = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(1)
+
+    def run(self):
+        connection, _ = self.socket.accept()
+        data = connection.recv(1024)
+        while data:
+            connection.sendall(data)
+            data = connection.recv(1024)
+        connection.close()
+
+    def stop(self):
+        self.socket.close()
+
+
+class TestVNCProxy(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        self.host = "localhost"
+        self.port = 9001
+        self.address = (self.host, self.port)
+        self.vmmaster = vmmaster_server_mock(self.port)
+        server_is_up(self.address)
+        self.free_port = get_free_port()
+        self.vmmaster.app.vnc_proxy.port = self.free_port
+
+        self.ctx = self.vmmaster.app.app_context()
+        self.ctx.push()
+
+        from core.sessions import Session
+        self.session = Session()
+        self.session.endpoint_ip = "localhost"
+
+    def tearDown(self):
+        self.session.close()
+        self.ctx.pop()
+        self.vmmaster.app.sessions.kill_all()
+        self.vmmaster.app.cleanup()
+        del self.vmmaster
+        server_is_down(self.address)
+
+    def test_vnc_proxy(self):
+        """
+        - connect to vnc proxy of session by websocket
+        - send message
+
+        Expected: message was passed to vnc server and back,
+        traffic was accounted while viewer was connected
+        """
+        server = EchoServer(self.host, self.free_port)
+        server.start()
+        with patch(
+            'core.sessions.Sessions.get_session', Mock(
+                return_value=self.session)
+        ):
+            ws = websocket.create_connection(
+                "ws://%s:%s/proxy/vnc/%s" %
+                (self.host, self.port, self.session.id),
+                subprotocols=["binary"], timeout=5
+            )
+        ws.send_binary("RFB 003.008\n")
+        self.assertEqual("RFB 003.008\n", ws.recv())
+        self.assertDictEqual(
+            {"viewers": 1, "to_vm": 12, "from_vm": 12},
+            self.vmmaster.app.vnc_proxy.stats(self.session.id)
+        )
+
+        ws.close()
+        server.stop()
+        self.assertTrue(wait_for(
+            lambda: not self.vmmaster.app.vnc_proxy.stats(
+                self.session.id)["viewers"]))
+
+    def test_vnc_proxy_for_session_without_endpoint(self):
+        """
+        - connect to vnc proxy of session which has no endpoint yet
+
+        Expected: 500, session was looked up outside of reactor thread
+        """
+        from twisted.python.threadable import isInIOThread
+        in_reactor = []
+
+        def get_session(session_id):
+            in_reactor.append(isInIOThread())
+            return self.session
+
+        self.session.endpoint_ip = None
+        with patch(
+            'core.sessions.Sessions.get_session', Mock(side_effect=get_session)
+        ):
+            response = requests.get(
+                "http://%s:%s/proxy/vnc/%s" %
+                (self.host, self.port, self.session.id),
+                headers={"Upgrade": "websocket", "Connection": "Upgrade",
+                         "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ==",
+                         "Sec-WebSocket-Version": "13"}
+            )
+        self.assertEqual(500, response.status_code)
+        self.assertIn("has no endpoint yet", response.text)
+        self.assertEqual([False], in_reactor)
+
+    def test_vnc_proxy_without_upgrade(self):
+        """
+        - request vnc proxy of session by plain http
+
+        Expected: 400
+        """
+        response = requests.get(
+            "http://%s:%s/proxy/vnc/%s" %
+            (self.host, self.port, self.session.id)
+        )
+        self.assertEqual(400, response.status_code)
@@ -0,0 +1,166 @@
+# coding: utf-8
+
+from flask import Flask
+from mock import Mock
+from tests.unit.helpers import BaseTestCase, DatabaseMock, wait_for
+from core.config import setup_config
+
+
+def set_primary_keys(records):
+    for i, record in enumerate(records, 1):
+        record.id = i
+
+
+class TestLogJournal(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_config('data/config.py')
+        cls.app = Flask(__name__)
+
+    def setUp(self):
+        from core.db.journal import LogJournal
+        self.app.database = DatabaseMock()
+        self.app.database.add_all = Mock(side_effect=set_primary_keys)
+        self.app.journal = LogJournal(
+            self.app.database, flush_interval=60, flush_size=3, maxsize=5
+        )
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        del self.app.journal
+
+    def test_steps_are_written_in_one_batch(self):
+        """
+        - add step and two sub-steps
+        - flush journal
+
+        Expected: step was written before sub-steps, sub-steps linked to step
+        """
+        from core.db.models import SessionLogStep
+        step = SessionLogStep("POST /wd/hub/session", session_id=1)
+        sub_step_1 = step.add_sub_step("POST /session", "{}")
+        sub_step_2 = step.add_sub_step("200", "{}")
+
+        self.assertEqual(3, len(self.app.journal))
+        self.assertFalse(self.app.database.add.called)
+
+        self.app.journal.flush()
+
+        self.assertEqual(
+            [((([step],), {})), (([sub_step_1, sub_step_2],), {})],
+            self.app.database.add_all.call_args_list
+        )
+        self.assertEqual(0, len(self.app.journal))
+        self.assertEqual(step.id, sub_step_1.session_log_step_id)
+        self.assertEqual(step.id, sub_step_2.session_log_step_id)
+
+    def test_flush_by_size(self):
+        """
+        - start journal
+        - add flush_size records
+
+        Expected: records were written by journal thread
+        """
+        from core.db.models import SessionLogStep
+        self.app.journal.start()
+        for _ in range(3):
+            SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+
+        self.assertTrue(wait_for(lambda: not len(self.app.journal)))
+        self.app.journal.stop()
+        self.assertEqual(1, self.app.database.add_all.call_count)
+
+    def test_failed_backpressure_flush_is_not_raised(self):
+        """
+        - add maxsize records with database error
+
+        Expected: error wasn't raised to the caller, records are kept
+        """
+        from core.db.models import SessionLogStep
+        self.app.database.add_all = Mock(side_effect=Exception("db error"))
+        for _ in range(5):
+            SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+
+        self.assertEqual(5, len(self.app.journal))
+
+    def test_journal_is_bounded_while_database_is_down(self):
+        """
+        - add more than maxsize records with database error
+
+        Expected: flush was retried in caller once per retry interval,
+        the oldest records were dropped and counted
+        """
+        from core.db.models import SessionLogStep
+        self.app.database.add_all = Mock(side_effect=Exception("db error"))
+        steps = [SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+                 for _ in range(12)]
+
+        self.assertEqual(1, self.app.database.add_all.call_count)
+        self.assertEqual(5, len(self.app.journal))
+        self.assertEqual(7, self.app.journal.dropped)
+        self.assertEqual(steps[-5:], self.app.journal.records)
+
+    def test_backpressure_when_journal_is_full(self):
+        """
+        - add maxsize records without running journal thread
+
+        Expected: records were written by the caller
+        """
+        from core.db.models import SessionLogStep
+        for _ in range(5):
+            SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+
+        self.assertEqual(0, len(self.app.journal))
+        self.assertEqual(1, self.app.database.add_all.call_count)
+
+    def test_records_are_kept_if_flush_failed(self):
+        """
+        - add step
+        - flush journal with database error
+
+        Expected: exception raised, step is still in journal
+        """
+        from core.db.models import SessionLogStep
+        self.app.database.add_all = Mock(side_effect=Exception("db error"))
+        SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+
+        self.assertRaises(Exception, self.app.journal.flush)
+        self.assertEqual(1, len(self.app.journal))
+
+    def test_save_of_pending_step_is_deferred(self):
+        """
+        - add step
+        - update step
+        - flush journal
+
+        Expected: step wasn't written by update,
+        it was written with updated body by flush
+        """
+        from core.db.models import SessionLogStep
+        from core.sessions import update_log_step
+        step = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        update_log_step(step, message="{}")
+
+        self.assertFalse(self.app.database.add_all.called)
+        self.assertFalse(self.app.database.update.called)
+
+        self.app.journal.flush()
+        self.app.database.add_all.assert_called_once_with([step])
+        self.assertEqual("{}", step.body)
+
+    def test_save_written_step(self):
+        """
+        - add step and flush journal
+        - save step
+
+        Expected: step was updated
+        """
+        from core.db.models import SessionLogStep
+        step = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        self.app.journal.flush()
+        step.save()
+
+        self.assertEqual(1, self.app.database.add_all.call_count)
+        self.app.database.update.assert_called_once_with(step)
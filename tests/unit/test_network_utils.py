@@ -0,0 +1,161 @@
+# coding: utf-8
+
+import os
+import socket
+import resource
+from threading import Timer
+from mock import patch, Mock
+from core.config import setup_config
+from helpers import BaseTestCase, get_free_port
+
+
+def listen(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("localhost", port))
+    sock.listen(5)
+    return sock
+
+
+class TestPortProber(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        from core.utils.network_utils import PortProber
+        self.prober = PortProber(
+            connect_timeout=1, min_backoff=0.05, max_backoff=0.2)
+        self.prober.start()
+        self.sockets = []
+
+    def tearDown(self):
+        self.prober.stop()
+        for sock in self.sockets:
+            sock.close()
+
+    def test_open_and_closed_ports(self):
+        """
+        - listen one port
+        - probe it with one closed port
+
+        Expected: only listened port is open, probe was not waiting timeout
+        """
+        open_port, closed_port = get_free_port(), get_free_port()
+        self.sockets.append(listen(open_port))
+
+        target = self.prober.acquire("localhost", [open_port, closed_port])
+        self.assertEqual([True, False], target.wait(0))
+        target.release()
+
+        self.assertEqual({}, self.prober.targets)
+
+    def test_port_opened_later(self):
+        """
+        - probe closed port
+        - listen it after 0.3 seconds
+
+        Expected: target became ready
+        """
+        port = get_free_port()
+        timer = Timer(0.3, lambda: self.sockets.append(listen(port)))
+        timer.start()
+
+        target = self.prober.acquire("localhost", [port])
+        self.assertEqual([True], target.wait(5))
+        self.assertGreater(target.attempts[port], 1)
+        target.release()
+
+    def test_waiters_share_target(self):
+        """
+        - acquire the same ports twice
+
+        Expected: one target is shared
+        """
+        port = get_free_port()
+        target1 = self.prober.acquire("localhost", [port])
+        target2 = self.prober.acquire("localhost", [port])
+
+        self.assertIs(target1, target2)
+        self.assertEqual(2, target1.waiters)
+        target1.release()
+        target2.release()
+        self.assertEqual({}, self.prober.targets)
+
+    def test_invalid_host(self):
+        """
+        - probe ports of host which is not a string
+
+        Expected: ports are closed without waiting, target isn't shared
+        """
+        target = self.prober.acquire(None, [get_free_port()])
+        self.assertEqual([False], target.wait(5))
+        target.release()
+
+        self.assertEqual({}, self.prober.targets)
+
+    def test_failed_probe_does_not_stop_prober(self):
+        """
+        - probe port, address lookup raises unexpected error
+        - probe listened port
+
+        Expected: first port is closed, second one is open,
+        prober is still running
+        """
+        open_port = get_free_port()
+        self.sockets.append(listen(open_port))
+        getaddrinfo = socket.getaddrinfo
+
+        def lookup(host, port, *args):
+            if host != "localhost":
+                raise TypeError("unexpected")
+            return getaddrinfo(host, port, *args)
+
+        with patch('socket.getaddrinfo', lookup):
+            target = self.prober.acquire("broken", [get_free_port()])
+            self.assertEqual([False], target.wait(0))
+            target.release()
+
+            target = self.prober.acquire("localhost", [open_port])
+            self.assertEqual([True], target.wait(5))
+            target.release()
+
+        self.assertTrue(self.prober.is_alive())
+
+    def test_host_is_resolved_once(self):
+        """
+        - probe two closed ports until they were tried several times
+
+        Expected: host was resolved once
+        """
+        lookup = Mock(side_effect=socket.getaddrinfo)
+        with patch('socket.getaddrinfo', lookup):
+            target = self.prober.acquire(
+                "localhost", [get_free_port(), get_free_port()])
+            self.assertEqual([False, False], target.wait(0.5))
+            target.release()
+
+        self.assertGreater(min(target.attempts.values()), 1)
+        self.assertEqual(1, lookup.call_count)
+
+    def test_descriptors_above_fd_setsize(self):
+        """
+        - take descriptors up to 1024
+        - probe listened port
+
+        Expected: port is open, prober is still running
+        """
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1100:
+            self.skipTest("not enough descriptors")
+        port = get_free_port()
+        self.sockets.append(listen(port))
+        fds = []
+        try:
+            while not fds or fds[-1] < 1024:
+                fds.append(os.dup(0))
+
+            target = self.prober.acquire("localhost", [port])
+            self.assertEqual([True], target.wait(5))
+            target.release()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        self.assertTrue(self.prober.is_alive())
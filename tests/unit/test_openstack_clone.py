@@ -130,7 +130,7 @@ class TestOpenstackClone(BaseTestCase):
     )
     @patch.multiple(
         'core.utils.network_utils',
-        ping=Mock(return_value=True)
+        wait_ports=Mock(return_value=[True, True])
     )
     def test_ping_success(self):
         """
@@ -369,6 +369,65 @@ class TestOpenstackClone(BaseTestCase):
             self.app.pool.using[0].rebuild()
             self.assertEqual(self.app.pool.count(), 0)
 
+    @patch.multiple(
+        'vmpool.clone.OpenstackClone',
+        _wait_for_activated_service=custom_wait,
+        ping_vm=Mock(return_value=True),
+        rebuild=Mock()
+    )
+    @patch(
+        'vmpool.clone.run_script',
+        Mock(side_effect=lambda script, host: iter(
+            [(None, None, None), (200, {}, '{"status": 0, "output": ""}')]
+        ))
+    )
+    def test_recycle_preloaded_vm(self):
+        """
+        - turn on VM_RECYCLE
+        - get preloaded vm
+        - delete vm after session
+
+        Expected: vm has been returned to pool without rebuild
+        """
+        from core.config import config
+        with patch.object(config, "VM_RECYCLE", True, create=True):
+            self.app.pool.preload(self.platform, prefix='preloaded')
+            vm = self.app.pool.get_by_platform(self.platform)
+            vm.delete()
+
+        self.assertEqual([vm], list(self.app.pool.pool))
+        self.assertEqual(0, len(self.app.pool.using))
+        self.assertEqual(1, vm.sessions_count)
+        self.assertFalse(vm.rebuild.called)
+
+    @patch.multiple(
+        'vmpool.clone.OpenstackClone',
+        _wait_for_activated_service=custom_wait,
+        ping_vm=Mock(return_value=True),
+        reset=Mock(return_value=True),
+        rebuild=Mock()
+    )
+    def test_rebuild_vm_after_max_sessions(self):
+        """
+        - turn on VM_RECYCLE with VM_RECYCLE_MAX_SESSIONS = 2
+        - get and delete preloaded vm twice
+
+        Expected: vm has been recycled once, then rebuilt
+        """
+        from core.config import config
+        with patch.object(
+            config, "VM_RECYCLE", True, create=True
+        ), patch.object(
+            config, "VM_RECYCLE_MAX_SESSIONS", 2, create=True
+        ):
+            self.app.pool.preload(self.platform, prefix='preloaded')
+            for _ in range(2):
+                vm = self.app.pool.get_by_platform(self.platform)
+                vm.delete()
+
+        self.assertEqual(1, vm.reset.call_count)
+        self.assertEqual(1, vm.rebuild.call_count)
+
     @patch.multiple(
         'vmpool.clone.OpenstackClone',
         ping_vm=Mock(return_value=True),
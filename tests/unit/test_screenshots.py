@@ -0,0 +1,328 @@
+# coding: utf-8
+
+import os
+import base64
+import shutil
+
+from StringIO import StringIO
+from flask import Flask
+from mock import Mock, patch
+from PIL import Image
+from tests.unit.helpers import BaseTestCase, wait_for
+
+
+def make_screenshot(size=(256, 128), dot=None):
+    output = StringIO()
+    img = Image.new("RGB", size, "white")
+    if dot:
+        img.putpixel(dot, (0, 0, 0))
+    img.save(output, "PNG")
+    return base64.b64encode(output.getvalue())
+
+
+class TestScreenshotPipeline(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        from core.config import setup_config, config
+        setup_config('data/config.py')
+        cls.app = Flask(__name__)
+        cls.dir_path = os.sep.join([config.SCREENSHOTS_DIR, "pipeline"])
+
+    def setUp(self):
+        from core.config import config
+        from core.screenshots import ScreenshotPipeline
+        config.SCREENSHOT_EAGER_THUMBNAILS = True
+        self.pipeline = ScreenshotPipeline(
+            self.app, processes=1, queue_size=2, thumbnail_queue_size=1
+        )
+        self.pipeline.start()
+        self.log_step = Mock(id=1, screenshot=None, save=Mock())
+        self.path = os.sep.join([self.dir_path, "1.png"])
+
+    def tearDown(self):
+        from core.config import config
+        from core.screenshots import blobs_dir
+        del config.SCREENSHOT_EAGER_THUMBNAILS
+        self.pipeline.stop()
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+        shutil.rmtree(blobs_dir(), ignore_errors=True)
+
+    def test_screenshot_with_thumbnail(self):
+        """
+        - put screenshot to pipeline
+
+        Expected: screenshot and its thumbnail were written,
+        log step was saved with screenshot path
+        """
+        self.assertTrue(
+            self.pipeline.put(self.log_step, self.path, make_screenshot()))
+
+        self.assertTrue(wait_for(lambda: self.log_step.save.called))
+        self.assertEqual(self.path, self.log_step.screenshot)
+        self.assertEqual(0, len(self.pipeline))
+        thumbnail = Image.open(os.sep.join([self.dir_path, "1_thumb.png"]))
+        self.assertEqual((128, 64), thumbnail.size)
+
+    def test_thumbnails_are_dropped_first(self):
+        """
+        - put screenshot while thumbnail_queue_size screenshots are pending
+        - put screenshot while queue_size screenshots are pending
+
+        Expected: first screenshot was written without thumbnail,
+        second screenshot was dropped
+        """
+        self.pipeline.pending = 1
+        self.assertTrue(
+            self.pipeline.put(self.log_step, self.path, make_screenshot()))
+        self.assertTrue(wait_for(lambda: self.log_step.save.called))
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertFalse(
+            os.path.isfile(os.sep.join([self.dir_path, "1_thumb.png"])))
+
+        self.pipeline.pending = 2
+        self.assertFalse(
+            self.pipeline.put(Mock(), self.path, make_screenshot()))
+        self.pipeline.pending = 0
+
+    def test_lost_screenshots_are_expired(self):
+        """
+        - put screenshots which are never completed by pool
+          until queue is full
+        - put screenshot after task timeout
+
+        Expected: lost screenshots were expired,
+        last screenshot wasn't dropped
+        """
+        import time
+        self.pipeline.task_timeout = 0.1
+        with patch.object(self.pipeline.pool, 'apply_async', Mock()):
+            for _ in range(2):
+                self.assertTrue(
+                    self.pipeline.put(Mock(), self.path, make_screenshot()))
+            self.assertFalse(
+                self.pipeline.put(Mock(), self.path, make_screenshot()))
+
+            time.sleep(0.2)
+            with patch('core.screenshots.send_metrics') as send_metrics:
+                self.assertTrue(
+                    self.pipeline.put(Mock(), self.path, make_screenshot()))
+
+        self.assertEqual(1, len(self.pipeline))
+        self.assertEqual(2, self.pipeline.expired)
+        send_metrics.assert_any_call("screenshots.expired", 2)
+
+
+class TestScreenshotStore(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        from core.config import setup_config, config
+        setup_config('data/config.py')
+        cls.dir_path = os.sep.join([config.SCREENSHOTS_DIR, "store"])
+
+    def setUp(self):
+        from core.config import config
+        config.SCREENSHOT_EAGER_THUMBNAILS = True
+        self.paths = [
+            os.sep.join([self.dir_path, "1", "1.png"]),
+            os.sep.join([self.dir_path, "2", "1.png"])
+        ]
+
+    def tearDown(self):
+        from core.config import config
+        from core.screenshots import blobs_dir
+        del config.SCREENSHOT_EAGER_THUMBNAILS
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+        shutil.rmtree(blobs_dir(), ignore_errors=True)
+
+    def save(self, path, screenshot):
+        from core.screenshots import save_screenshot
+        log_step = Mock(id=1, screenshot=None)
+        save_screenshot(log_step, path, screenshot)
+        self.assertEqual(path, log_step.screenshot)
+
+    def test_duplicates_are_linked_to_one_blob(self):
+        """
+        - save same screenshot for two sessions
+
+        Expected: both screenshots and thumbnails are links to one blob
+        """
+        from core.screenshots import thumbnail_path
+        for path in self.paths:
+            self.save(path, make_screenshot())
+
+        first, second = [os.stat(path) for path in self.paths]
+        self.assertEqual(first.st_ino, second.st_ino)
+        self.assertEqual(3, first.st_nlink)
+        self.assertEqual(
+            os.stat(thumbnail_path(self.paths[0])).st_ino,
+            os.stat(thumbnail_path(self.paths[1])).st_ino
+        )
+
+    def test_near_duplicates_with_perceptual_hash(self):
+        """
+        - save screenshots which differ by one pixel
+        - save them with SCREENSHOT_PERCEPTUAL_HASH
+
+        Expected: screenshots were stored as different blobs,
+        and as one blob with perceptual hash
+        """
+        from core.config import config
+        self.save(self.paths[0], make_screenshot())
+        self.save(self.paths[1], make_screenshot(dot=(10, 10)))
+        self.assertNotEqual(os.stat(self.paths[0]).st_ino,
+                            os.stat(self.paths[1]).st_ino)
+
+        config.SCREENSHOT_PERCEPTUAL_HASH = True
+        try:
+            self.save(self.paths[0], make_screenshot())
+            self.save(self.paths[1], make_screenshot(dot=(10, 10)))
+        finally:
+            del config.SCREENSHOT_PERCEPTUAL_HASH
+        self.assertEqual(os.stat(self.paths[0]).st_ino,
+                         os.stat(self.paths[1]).st_ino)
+
+    def test_same_screenshot_saved_in_parallel_threads(self):
+        """
+        - save same screenshot for many sessions in parallel threads
+
+        Expected: every screenshot was saved as link to one blob
+        """
+        from threading import Thread
+        from core.screenshots import process_screenshot
+        screenshot = make_screenshot()
+        paths = [os.sep.join([self.dir_path, str(i), "1.png"])
+                 for i in range(8)]
+        results = []
+
+        for _ in range(5):
+            shutil.rmtree(self.dir_path, ignore_errors=True)
+            threads = [
+                Thread(target=lambda p: results.append(
+                    process_screenshot(p, screenshot, 128)), args=(path,))
+                for path in paths
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([None] * 40, [error for _, _, error in results])
+        self.assertEqual(1, len(set(os.stat(path).st_ino for path in paths)))
+
+    def test_deleted_blob_is_written_again(self):
+        """
+        - save screenshot while its blob is deleted before it's linked
+
+        Expected: blob was written again and screenshot was linked to it
+        """
+        from core import screenshots
+        link = screenshots.link
+        self.save(self.paths[0], make_screenshot())
+        deleted = []
+
+        def delete_and_link(source, path):
+            if path == self.paths[1] and not deleted:
+                deleted.append(source)
+                os.remove(source)
+            link(source, path)
+
+        with patch('core.screenshots.link', Mock(side_effect=delete_and_link)):
+            self.save(self.paths[1], make_screenshot())
+        self.assertTrue(os.path.isfile(self.paths[1]))
+
+    def test_delete_unused_blobs(self):
+        """
+        - save same screenshot for two sessions
+        - delete screenshots of one session, then of another session
+        - delete unused blobs after each deletion
+
+        Expected: blob was deleted with its last link
+        """
+        from core.screenshots import delete_unused_blobs
+        for path in self.paths:
+            self.save(path, make_screenshot())
+
+        shutil.rmtree(os.path.dirname(self.paths[0]))
+        self.assertEqual(0, delete_unused_blobs(grace_period=0))
+
+        shutil.rmtree(os.path.dirname(self.paths[1]))
+        self.assertEqual(2, delete_unused_blobs(grace_period=0))
+
+
+class TestThumbnailCache(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        from core.config import setup_config, config
+        setup_config('data/config.py')
+        cls.dir_path = os.sep.join([config.SCREENSHOTS_DIR, "cache"])
+
+    def setUp(self):
+        from core.screenshots import ThumbnailCache
+        os.makedirs(self.dir_path)
+        self.path = os.sep.join([self.dir_path, "1.png"])
+        Image.new("RGB", (256, 128), "white").save(self.path, "PNG")
+        self.cache = ThumbnailCache(os.sep.join([self.dir_path, "thumbnails"]))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_least_recently_used_are_deleted(self):
+        """
+        - get thumbnails of three sizes in cache for two of them
+        - get first thumbnail again
+
+        Expected: second thumbnail was deleted, first was read from cache
+        """
+        for width in (64, 32):
+            self.cache.get(self.path, width)
+        self.cache.max_size = self.cache.size
+        self.cache.get(self.path, 64)
+        self.cache.get(self.path, 16)
+
+        self.assertEqual(
+            [self.cache.etag(self.path, 64), self.cache.etag(self.path, 16)],
+            list(self.cache.entries)
+        )
+        self.assertEqual(2, len(os.listdir(self.cache.directory)))
+
+    def test_cache_is_loaded_from_directory(self):
+        """
+        - get thumbnail
+        - create new cache for same directory
+
+        Expected: thumbnail is read from directory without resizing
+        """
+        from core.screenshots import ThumbnailCache
+        content = self.cache.get(self.path, 64)
+        cache = ThumbnailCache(self.cache.directory)
+
+        with patch('core.screenshots.resize', Mock()) as resize:
+            self.assertEqual(content, cache.get(self.path, 64))
+        self.assertFalse(resize.called)
+        self.assertEqual(len(content), cache.size)
+
+    def test_same_thumbnail_made_in_parallel_threads(self):
+        """
+        - get same thumbnail in parallel threads with empty cache
+
+        Expected: every thread got whole thumbnail,
+        it was counted in cache once and no temp files were left
+        """
+        from threading import Thread
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(self.cache.get(self.path, 64)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual((64, 32), Image.open(StringIO(results[0])).size)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(len(results[0]), self.cache.size)
+        self.assertEqual(["%s.png" % self.cache.etag(self.path, 64)],
+                         os.listdir(self.cache.directory))
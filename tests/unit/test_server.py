@@ -7,7 +7,7 @@ from mock import Mock, patch, PropertyMock
 from uuid import uuid4
 from threading import Thread
 from multiprocessing.pool import ThreadPool
-from core.config import setup_config, config
+from core.config import setup_config
 from tests.unit.helpers import server_is_up, server_is_down, \
     new_session_request, get_session_request, delete_session_request, \
     vmmaster_label, run_script, request_with_drop, BaseTestCase, \
@@ -360,6 +360,39 @@ class TestServer(BaseTestServer):
         self.assertEqual(output, response.content)
         session.close()
 
+    def test_run_script_with_streaming(self):
+        """
+        - create vmmaster session
+        - send run_script request with streaming
+        Expected: output chunks and status were sent as json lines
+        """
+        from core.sessions import Session
+        session = Session()
+        session.selenium_session = '1'
+
+        def run_script_mock(request, session, stream=None):
+            for chunk in ("hello ", "world\n"):
+                stream.put(chunk)
+            return 200, {}, json.dumps({"status": 0, "output": "hello world\n"})
+
+        with patch(
+            'core.sessions.Sessions.get_session',
+            Mock(return_value=session)
+        ), patch.dict(
+            'vmmaster.webdriver.commands.AgentCommands',
+            {'runScript': run_script_mock}
+        ):
+            response = run_script(
+                self.address, session.id, "echo 'hello world'", stream=True)
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(
+            [{"output": "hello "}, {"output": "world\n"},
+             {"status": 0, "code": 200}],
+            [json.loads(line) for line in response.content.splitlines()]
+        )
+        session.close()
+
     @patch(
         'vmmaster.webdriver.commands.InternalCommands',
         {'vmmasterLabel': Mock(
@@ -419,14 +452,64 @@ class TestSessionWorker(BaseTestCase):
         session = Mock()
         session.timeout = Mock()
         session.is_active = False
-        session.inactivity = config.SESSION_TIMEOUT + 1
+        session.status = "running"
 
-        self.app.sessions.running = Mock(return_value=[session])
         self.worker.start()
+        self.worker.schedule(session, timeout=0.1)
         time.sleep(1)
         session.timeout.assert_any_call()
         session.close()
 
+    def test_rescheduled_session_timeouted_once(self):
+        """
+        - schedule session timeout twice
+        Expected: session timeouted once by the last deadline
+        """
+        session = Mock(is_active=False, status="running")
+
+        self.worker.start()
+        self.worker.schedule(session, timeout=0.1)
+        self.worker.schedule(session, timeout=0.5)
+        time.sleep(0.3)
+        self.assertFalse(session.timeout.called)
+
+        wait_for(lambda: session.timeout.called, timeout=2)
+        self.assertEqual(1, session.timeout.call_count)
+        self.assertEqual(0, len(self.worker.scheduled))
+
+    def test_worker_sleeps_until_deadline(self):
+        """
+        - schedule session timeout
+        - wait for session timeout
+        Expected: worker slept once for the whole timeout
+        """
+        session = Mock(is_active=False, status="running")
+
+        with patch.object(self.worker, 'sleep', Mock(wraps=self.worker.sleep)) as sleep:
+            self.worker.start()
+            self.worker.schedule(session, timeout=0.5)
+            wait_for(lambda: session.timeout.called, timeout=2)
+            sleeps = sleep.call_count
+
+        self.assertTrue(session.timeout.called)
+        self.assertLessEqual(sleeps, 3)
+
+    def test_cancelled_session_not_timeouted(self):
+        """
+        - schedule session timeout
+        - cancel session timeout
+        Expected: session not timeouted
+        """
+        session = Mock(is_active=False, status="running")
+
+        self.worker.start()
+        self.worker.schedule(session, timeout=0.1)
+        self.worker.cancel(session)
+        time.sleep(0.5)
+
+        self.assertFalse(session.timeout.called)
+        self.assertEqual(0, len(self.worker.deadlines))
+
 
 @patch.multiple(
         "vmpool.clone.KVMClone",
@@ -691,6 +774,9 @@ class TestServerWithPreloadedVM(BaseTestCase):
             self.ctx.push()
 
             self.pool = self.vmmaster.app.pool
+            # preloader creates vm in its thread pool, patches must be active
+            wait_for(lambda: self.pool.pool and
+                     not any(vm.creating for vm in self.pool.pool))
 
         server_is_up(self.address)
 
@@ -718,9 +804,7 @@ class TestServerWithPreloadedVM(BaseTestCase):
         - make new session request
         Expected: session created
         """
-        while True:
-            if self.pool.pool[0].ready is True:
-                break
+        self.assertTrue(wait_for(lambda: self.pool.pool[0].ready is True))
 
         response = new_session_request(self.address, self.desired_caps)
 
@@ -780,7 +864,7 @@ class TestSessionSteps(BaseTestServer):
         Expected: session was created, session_step was created
         """
 
-        def raise_exception(dc):
+        def raise_exception(dc, session_id=None):
             raise Exception('something ugly happened in get_vm')
 
         with patch(
@@ -817,7 +901,7 @@ class TestSessionSteps(BaseTestServer):
         def raise_exception(*args, **kwargs):
             raise Exception('something ugly happened in make_request')
 
-        def new_vm_mock(arg):
+        def new_vm_mock(arg, session_id=None):
             yield Mock(ip=1)
 
         with patch(
@@ -883,7 +967,7 @@ class TestRunScriptTimeGreaterThenSessionTimeout(BaseTestCase):
         new=Mock(side_effect=selenium_status_true_mock)
     )
     @patch(
-        'requests.request',
+        'core.http_pool.EndpointHTTPPool.request',
         new=Mock(
             __name__="request",
             side_effect=request_mock
@@ -904,7 +988,7 @@ class TestRunScriptTimeGreaterThenSessionTimeout(BaseTestCase):
         - exception while waiting endpoint
         Expected: session was created, session_step was created
         """
-        def get_vm_mock(arg):
+        def get_vm_mock(arg, session_id=None):
             yield Mock(name="test_vm_1", ip="127.0.0.1")
 
         with patch(
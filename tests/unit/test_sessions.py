@@ -0,0 +1,86 @@
+# coding: utf-8
+
+from datetime import datetime
+from flask import Flask
+from mock import Mock, patch
+from helpers import BaseTestCase, DatabaseMock
+from core.config import setup_config
+
+
+class TestSessionSave(BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_config('data/config.py')
+        cls.app = Flask(__name__)
+        cls.app.sessions = Mock()
+
+    def setUp(self):
+        self.app.database = DatabaseMock()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        with patch('core.db.Database', DatabaseMock()):
+            from core.sessions import Session
+            self.session = Session(name="session1")
+        self.session.modified = datetime.now()
+        self.session.save()
+        self.app.database.update_fields.reset_mock()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_save_writes_only_changed_fields(self):
+        """
+        - change status
+        - save session
+
+        Expected: only status was written, row was not reloaded
+        """
+        self.session.status = "running"
+        self.session.save()
+
+        self.app.database.update_fields.assert_called_once_with(
+            type(self.session), self.session.id, {"status": "running"})
+        self.assertFalse(self.app.database.update.called)
+
+    def test_save_without_changes(self):
+        """
+        - save session without changes
+
+        Expected: nothing was written
+        """
+        self.session.save()
+
+        self.assertFalse(self.app.database.update_fields.called)
+
+    def test_start_timer_coalesces_saves(self):
+        """
+        - call start_timer twice
+        - close session
+
+        Expected: timer changes were written only with session closing
+        """
+        self.session.start_timer()
+        self.session.start_timer()
+        self.assertFalse(self.app.database.update_fields.called)
+
+        with patch('core.sessions.Session.save_artifacts', Mock()):
+            self.session.close()
+
+        fields = self.app.database.update_fields.call_args[0][2]
+        self.assertEqual(1, self.app.database.update_fields.call_count)
+        self.assertEqual(self.session.modified, fields["modified"])
+        self.assertTrue(fields["closed"])
+
+    def test_start_timer_saves_after_interval(self):
+        """
+        - call start_timer SESSION_SAVE_INTERVAL seconds after last save
+
+        Expected: modified was written
+        """
+        self.session.saved_at = 0
+        self.session.start_timer()
+
+        self.app.database.update_fields.assert_called_once_with(
+            type(self.session), self.session.id,
+            {"modified": self.session.modified})
@@ -1,8 +1,9 @@
 # coding: utf-8
 
-from mock import Mock, patch
+import time
+from mock import Mock, PropertyMock, patch
 from core.config import config, setup_config
-from helpers import BaseTestCase
+from helpers import BaseTestCase, wait_for
 from flask import Flask
 
 
@@ -95,6 +96,130 @@ class TestVirtualMachinePool(BaseTestCase):
 
         self.assertIsNone(self.pool.add(self.platform))
 
+    @patch.object(config, "KVM_SNAPSHOT_RESET", True, create=True)
+    def test_snapshot_revert_on_rebuild(self):
+        """
+        - turn on KVM_SNAPSHOT_RESET
+        - preload vm and wait until it's ready
+        - get vm and delete it after session
+
+        Expected: snapshot was taken once and reverted,
+        vm has been returned to pool without cloning, its age was reset
+        """
+        self.pool.preload(self.platform, prefix="preloaded")
+        vm = self.pool.pool[0]
+        self.assertTrue(wait_for(lambda: vm.ready))
+        self.assertEqual(vm.name, vm.snapshot)
+
+        clone_origin_calls = vm.clone_origin.call_count
+        vm = self.pool.get_by_platform(self.platform)
+        created = vm.created
+        vm.delete()
+
+        domain = vm.conn.lookupByName.return_value
+        self.assertEqual(1, domain.snapshotCreateXML.call_count)
+        self.assertEqual(1, domain.revertToSnapshot.call_count)
+        self.assertEqual([vm], list(self.pool.pool))
+        self.assertEqual(0, len(self.pool.using))
+        self.assertTrue(vm.ready)
+        self.assertEqual(clone_origin_calls, vm.clone_origin.call_count)
+        self.assertGreater(vm.created, created)
+
+    def test_rebuild_is_counted_as_loading(self):
+        """
+        - preload vm and wait until it's ready
+        - get vm and delete it after session, vm is rebuilt
+
+        Expected: new clone was counted as loading by preloader
+        while it was created, and not after it
+        """
+        self.pool.preload(self.platform, prefix="preloaded")
+        vm = self.pool.get_by_platform(self.platform)
+        add = self.pool.add
+        loading = []
+
+        def add_and_count(*args, **kwargs):
+            loading.append(self.pool.preloader.loading[self.platform])
+            return add(*args, **kwargs)
+
+        with patch.object(type(self.pool), "add", Mock(side_effect=add_and_count)), \
+                patch('core.utils.delete_file', Mock()):
+            vm.delete()
+
+        self.assertEqual([1], loading)
+        self.assertEqual(0, self.pool.preloader.loading[self.platform])
+        self.assertEqual(1, len(self.pool.pool))
+
+    def test_failed_snapshot_deletion(self):
+        """
+        - preload vm with snapshot
+        - delete vm, snapshot deletion fails
+
+        Expected: domain was destroyed and undefined anyway
+        """
+        from core.exceptions import libvirtError
+        self.pool.preload(self.platform, prefix="preloaded")
+        vm = self.pool.pool[0]
+        vm.snapshot = vm.name
+
+        vm.conn = Mock()
+        domain = vm.conn.lookupByName.return_value
+        domain.snapshotLookupByName.return_value.delete.side_effect = \
+            libvirtError("snapshot is busy")
+        with patch('core.utils.delete_file', Mock()):
+            vm.delete(try_to_rebuild=False)
+
+        self.assertTrue(domain.destroy.called)
+        self.assertTrue(domain.undefine.called)
+        self.assertNotIn(vm, self.pool.pool)
+
+    def test_hot_session_through_http_pool(self):
+        """
+        - start hot session on vm
+        - delete hot session, selenium doesn't respond
+
+        Expected: requests were sent through http pool of vm,
+        failed deletion wasn't raised
+        """
+        import json
+        from Queue import Queue
+        from twisted.internet.error import ConnectionRefusedError
+
+        def respond(response):
+            result = Queue()
+            result.put(response)
+            return result
+
+        vm = self.pool.add(self.platform)
+        body = json.dumps({"sessionId": "selenium1", "status": 0})
+        with patch(
+            'core.http_pool.EndpointHTTPPool.request_from_thread',
+            Mock(side_effect=[respond((200, {}, body)),
+                              respond(ConnectionRefusedError())])
+        ) as request:
+            vm.start_hot_session({"browserName": "firefox"})
+            self.assertEqual("selenium1", vm.hot_session.id)
+            vm.delete_hot_session()
+
+        self.assertEqual(["POST", "DELETE"],
+                         [c[1]["method"] for c in request.call_args_list])
+        self.assertIsNone(vm.hot_session)
+
+    def test_fresh_vm_is_not_pinged(self):
+        """
+        - preload vm, it was pinged just now
+        - get vm
+
+        Expected: vm was not pinged again
+        """
+        self.pool.preload(self.platform)
+        vm = self.pool.pool[0]
+        vm.health.update(True)
+        ping_calls = vm.ping_vm.call_count
+
+        self.assertIs(vm, self.pool.get_by_platform(self.platform))
+        self.assertEqual(ping_calls, vm.ping_vm.call_count)
+
     def test_platform_from_config(self):
         desired_caps = {
             'desiredCapabilities': {
@@ -109,3 +234,388 @@ class TestVirtualMachinePool(BaseTestCase):
         for vm in get_vm(desired_caps):
             self.assertEqual(vm.platform, config.PLATFORM)
             break
+
+
+class TestVirtualMachinesList(BaseTestCase):
+    def setUp(self):
+        from vmpool.virtual_machines_pool import VirtualMachinesList
+        self.pool = VirtualMachinesList()
+        self.using = VirtualMachinesList()
+
+    @staticmethod
+    def make_vm(name, platform="test_origin_1", ready=True):
+        from vmpool import VirtualMachine
+        vm = VirtualMachine(name, platform)
+        vm.ready = ready
+        return vm
+
+    def test_move_newest_ready_vm(self):
+        """
+        - add two ready vms and one not ready vm of platform
+        - add ready vm of another platform
+        - move ready vm of platform to using
+
+        Expected: the newest ready vm of platform was moved
+        """
+        vm1 = self.make_vm("vm1")
+        vm2 = self.make_vm("vm2")
+        self.pool.append(vm1)
+        self.pool.append(vm2)
+        self.pool.append(self.make_vm("vm3", ready=False))
+        self.pool.append(self.make_vm("vm4", platform="test_origin_2"))
+
+        vm = self.pool.move_ready("test_origin_1", to=self.using)
+
+        self.assertIs(vm2, vm)
+        self.assertEqual([vm2], list(self.using))
+        self.assertNotIn(vm2, self.pool)
+        self.assertEqual({"test_origin_1": 2, "test_origin_2": 1},
+                         self.pool.counts())
+
+    def test_move_ready_stops_at_first_ready_vm(self):
+        """
+        - add ready vm, then two newer ready vms
+        - move ready vm to using
+
+        Expected: the newest vm was moved, older vms weren't checked
+        """
+        vm1 = Mock(platform="test_origin_1", checking=False)
+        vm1.name = "vm1"
+        type(vm1).ready = ready = PropertyMock(return_value=True)
+        self.pool.append(vm1)
+        self.pool.append(self.make_vm("vm2"))
+        self.pool.append(self.make_vm("vm3"))
+
+        self.assertEqual(
+            "vm3", self.pool.move_ready("test_origin_1", self.using).name)
+        self.assertFalse(ready.called)
+
+    def test_move_ready_without_ready_vms(self):
+        """
+        - add not ready vm
+        - move ready vm to using
+
+        Expected: nothing was moved
+        """
+        self.pool.append(self.make_vm("vm1", ready=False))
+
+        self.assertFalse(self.pool.has_ready("test_origin_1"))
+        self.assertIsNone(self.pool.move_ready("test_origin_1", self.using))
+        self.assertEqual(1, len(self.pool))
+        self.assertEqual(0, len(self.using))
+
+    def test_move_preferred_vm(self):
+        """
+        - add two ready vms of platform
+        - move vm preferring the older one
+
+        Expected: older vm was moved
+        """
+        vm1, vm2 = self.make_vm("vm1"), self.make_vm("vm2")
+        self.pool.append(vm1)
+        self.pool.append(vm2)
+
+        self.assertIs(vm1, self.pool.move_ready(
+            "test_origin_1", to=self.using, prefer=lambda vm: vm is vm1))
+        self.assertIs(vm2, self.pool.move_ready(
+            "test_origin_1", to=self.using, prefer=lambda vm: vm is vm1))
+
+    def test_name_index(self):
+        """
+        - add vm
+        - remove vm twice
+
+        Expected: vm found by name until removed, second removal failed
+        """
+        vm = self.make_vm("vm1")
+        self.pool.append(vm)
+        self.assertIs(vm, self.pool.get("vm1"))
+
+        self.pool.remove(vm)
+        self.assertIsNone(self.pool.get("vm1"))
+        self.assertRaises(ValueError, self.pool.remove, vm)
+        self.assertFalse(self.pool.discard(vm))
+
+    def test_list_compatibility(self):
+        vm1, vm2 = self.make_vm("vm1"), self.make_vm("vm2")
+        self.pool.append(vm1)
+        self.using.append(vm2)
+
+        self.assertIs(vm1, self.pool[0])
+        self.assertEqual([vm1, vm2], self.pool + self.using)
+        self.assertEqual([vm2, vm1], [vm2] + self.pool)
+
+
+class TestVirtualMachinesWaitQueue(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        with patch(
+            'core.connection.Virsh', Mock()
+        ), patch(
+            'core.network.Network', Mock()
+        ):
+            from vmpool.virtual_machines_pool import VirtualMachinesPool
+            self.pool = VirtualMachinesPool
+
+    def tearDown(self):
+        self.pool.waiters.clear()
+        self.pool.waiters_by_session.clear()
+        self.pool.positions = None
+
+    def test_waiters_queue_is_fifo(self):
+        """
+        - enqueue two waiters of platform
+        - dequeue first waiter
+
+        Expected: second waiter became first and was woken up
+        """
+        waiter1 = self.pool.enqueue("test_origin_1", session_id=1)
+        waiter2 = self.pool.enqueue("test_origin_1", session_id=2)
+
+        self.assertTrue(self.pool.is_first(waiter1))
+        self.assertFalse(self.pool.is_first(waiter2))
+
+        self.pool.dequeue(waiter1)
+
+        self.assertTrue(self.pool.is_first(waiter2))
+        self.assertTrue(waiter2.event.is_set())
+
+    def test_notify_wakes_only_first_waiter_of_platform(self):
+        """
+        - enqueue two waiters of platform and one of another platform
+        - notify platform
+
+        Expected: only first waiter of platform was woken up
+        """
+        waiter1 = self.pool.enqueue("test_origin_1")
+        waiter2 = self.pool.enqueue("test_origin_1")
+        waiter3 = self.pool.enqueue("test_origin_2")
+
+        self.pool.notify("test_origin_1")
+
+        self.assertTrue(waiter1.event.is_set())
+        self.assertFalse(waiter2.event.is_set())
+        self.assertFalse(waiter3.event.is_set())
+
+    def test_returned_vm_wakes_first_waiter(self):
+        """
+        - enqueue waiter of platform
+        - return vm of platform to pool
+
+        Expected: waiter was woken up
+        """
+        from vmpool import VirtualMachine
+        vm = VirtualMachine("vm1", "test_origin_1")
+        self.pool.using.append(vm)
+        waiter = self.pool.enqueue("test_origin_1")
+
+        self.pool.return_vm(vm)
+        self.pool.remove_vm(vm)
+
+        self.assertTrue(waiter.event.is_set())
+
+    def test_queue_position(self):
+        """
+        - enqueue waiters of two platforms
+
+        Expected: position is counted in platform queue
+        """
+        self.pool.enqueue("test_origin_1", session_id=1)
+        self.pool.enqueue("test_origin_2", session_id=2)
+        self.pool.enqueue("test_origin_1", session_id=3)
+
+        self.assertEqual(1, self.pool.queue_position(1))
+        self.assertEqual(1, self.pool.queue_position(2))
+        self.assertEqual(2, self.pool.queue_position(3))
+        self.assertIsNone(self.pool.queue_position(4))
+
+    def test_cancelled_waiter_leaves_queue(self):
+        """
+        - enqueue two waiters of platform
+        - cancel waiter of first session
+
+        Expected: first waiter left queue, second waiter became first
+        """
+        waiter1 = self.pool.enqueue("test_origin_1", session_id=1)
+        waiter2 = self.pool.enqueue("test_origin_1", session_id=2)
+
+        self.pool.cancel(1)
+
+        self.assertTrue(waiter1.cancelled)
+        self.assertIsNone(self.pool.queue_position(1))
+        self.assertEqual(1, self.pool.queue_position(2))
+        self.assertTrue(self.pool.is_first(waiter2))
+        self.assertTrue(waiter2.event.is_set())
+
+    @patch.object(config, "GET_VM_CHECK_INTERVAL", 0.1, create=True)
+    def test_waiting_for_turn_is_yielded(self):
+        """
+        - wait for turn while pool has no vm
+        - stop waiting after the first yield
+
+        Expected: waiting was yielded after check interval,
+        waiter left queue
+        """
+        from vmpool.endpoint import wait_for_turn
+        app = Flask(__name__)
+        app.pool = self.pool
+        with app.app_context(), patch.object(
+            self.pool, "get_vm", Mock(return_value=None)
+        ):
+            turn = wait_for_turn("test_origin_1", session_id=1)
+            start = time.time()
+            self.assertIsNone(next(turn))
+            self.assertLess(time.time() - start, 0.5)
+            turn.close()
+
+        self.assertIsNone(self.pool.queue_position(1))
+        self.assertFalse(self.pool.waiters["test_origin_1"])
+
+
+class TestVirtualMachinesPoolPreloader(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        config.KVM_PRELOADED = {"test_origin_1": 3, "test_origin_2": 1}
+
+        from vmpool.virtual_machines_pool import VirtualMachinesList, \
+            VirtualMachinesPoolPreloader, PlatformArrivals
+        self.pool = Mock(
+            pool=VirtualMachinesList(), using=VirtualMachinesList(),
+            arrivals=PlatformArrivals(window=60)
+        )
+        self.pool.count_virtual_machines = Mock(return_value={})
+        self.preloader = VirtualMachinesPoolPreloader(
+            self.pool, parallelism=3)
+
+    def tearDown(self):
+        self.preloader.threads.close()
+        self.preloader.maintenance.close()
+
+    def test_need_load_for_all_platforms(self):
+        """
+        - get platforms to load with parallelism 3
+
+        Expected: both platforms are loaded at once
+        """
+        self.assertEqual(
+            ["test_origin_1", "test_origin_2", "test_origin_1"],
+            self.preloader.need_load()
+        )
+
+    def test_need_load_counts_loading_vms(self):
+        """
+        - start loading all vms of platform with parallelism 4
+        - get platforms to load
+
+        Expected: only one vm of another platform may be loaded now
+        """
+        self.preloader.parallelism = 4
+        self.preloader.loading["test_origin_1"] = 3
+
+        self.assertEqual(["test_origin_2"], self.preloader.need_load())
+
+    def test_need_load_skips_vms_being_created(self):
+        """
+        - start loading two vms of platform, their clones are added to pool
+        - get platforms to load
+
+        Expected: clones were counted once, as loading,
+        so platform still has the biggest shortage
+        """
+        from vmpool import VirtualMachine
+        from vmpool.virtual_machines_pool import VirtualMachinesPool
+        self.pool.count_virtual_machines = \
+            VirtualMachinesPool.count_virtual_machines
+        for name in ("vm1", "vm2"):
+            vm = VirtualMachine(name, "test_origin_1")
+            vm.creating = True
+            self.pool.pool.append(vm)
+        self.preloader.loading["test_origin_1"] = 2
+
+        self.assertEqual(["test_origin_1"], self.preloader.need_load())
+
+    def test_targets_from_arrival_rate(self):
+        """
+        - enable forecasting for 60 seconds
+        - add 5 requests of platform for the last minute
+
+        Expected: platform target is raised to 5
+        """
+        self.preloader.forecast_time = 60
+        now = time.time()
+        self.pool.arrivals.add("test_origin_2", now=now - 61)
+        for i in reversed(range(5)):
+            self.pool.arrivals.add("test_origin_2", now=now - i)
+
+        self.assertEqual(
+            {"test_origin_1": 3, "test_origin_2": 5},
+            self.preloader.targets()
+        )
+
+    @patch.object(config, "HOT_SESSION_PROFILES", [
+        {"browserName": "firefox"}, {"browserName": "chrome"}
+    ], create=True)
+    def test_warm_up_hot_sessions(self):
+        """
+        - add two idle vms and one checking vm to pool
+        - warm up with two hot session profiles
+
+        Expected: idle vms got hot sessions of different profiles
+        outside of preload threads, checking vm was skipped
+        """
+        self.preloader.threads.close()
+        self.preloader.threads = Mock()
+        vms = [Mock(platform="test_origin_1", ready=True, checking=False,
+                    hot_session=None) for _ in range(3)]
+        for i, vm in enumerate(vms):
+            vm.name = "vm%s" % i
+            self.pool.pool.append(vm)
+        vms[2].checking = True
+
+        self.preloader.warm_up()
+
+        self.assertTrue(wait_for(lambda: not any(
+            vm.checking for vm in vms[:2])))
+        started = sorted(vm.start_hot_session.call_args[0][0]["browserName"]
+                         for vm in vms[:2])
+        self.assertEqual(["chrome", "firefox"], started)
+        self.assertFalse(vms[2].start_hot_session.called)
+        self.assertFalse(self.preloader.threads.apply_async.called)
+
+    def test_refresh_health(self):
+        """
+        - add ready vm without health check to pool
+        - refresh health
+
+        Expected: vm ports were probed outside of preload threads,
+        vm is fresh
+        """
+        from vmpool import HealthState
+        self.preloader.threads.close()
+        self.preloader.threads = Mock()
+        vm = Mock(platform="test_origin_1", ready=True, checking=False,
+                  health=HealthState())
+        vm.name = "vm1"
+        self.pool.pool.append(vm)
+
+        with patch('core.utils.network_utils.wait_ports',
+                   Mock(return_value=[True, True])):
+            self.preloader.refresh_health()
+            self.assertTrue(wait_for(lambda: vm.health.is_fresh()))
+
+        self.assertTrue(wait_for(lambda: not self.preloader.refreshing))
+        self.assertFalse(self.preloader.threads.apply_async.called)
+
+    def test_preload_in_threads(self):
+        """
+        - run preloader
+
+        Expected: vms of all platforms were preloaded
+        """
+        self.pool.preload = Mock(return_value=Mock())
+        for platform in self.preloader.need_load():
+            self.preloader.load(platform)
+
+        self.assertTrue(wait_for(lambda: self.pool.preload.call_count == 3))
+        self.assertTrue(wait_for(
+            lambda: not sum(self.preloader.loading.values())))
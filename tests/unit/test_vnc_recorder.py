@@ -1,5 +1,8 @@
 # coding: utf-8
 
+import os
+import shutil
+
 from flask import Flask
 from mock import patch, Mock
 from tests.unit.helpers import BaseTestCase, DatabaseMock, wait_for
@@ -65,3 +68,226 @@ class TestVNCVideoHelper(BaseTestCase):
                 self.session.close()
                 self.assertTrue(wait_for(
                     lambda: not self.session.vnc_helper.recorder.is_alive()))
+
+    def test_ring_buffer_keeps_last_segments(self):
+        """
+        - write 10 sec of video with keyframe every 2 sec
+          to ring buffer for 3 sec
+        - save buffer to file
+
+        Expected: file starts from keyframe and contains last 3-5 sec of video
+        """
+        from vnc2flv.flv import FLVParser
+        from core.config import config
+        from core.video import FLVRingBuffer
+        writer = FLVRingBuffer(3000, framerate=2)
+        for frame in range(20):
+            flags = 0x13 if frame % 4 == 0 else 0x23
+            writer.write_video_frame(frame * 500, chr(flags) + 'frame')
+
+        filename = os.sep.join([config.SCREENSHOTS_DIR, 'buffer.flv'])
+        writer.save(filename)
+
+        with open(filename, 'rb') as f:
+            tags = [(timestamp, keyframe) for tag, _, timestamp, _, keyframe
+                    in FLVParser(f) if tag == FLVParser.TAG_VIDEO]
+        os.remove(filename)
+
+        self.assertEqual((6000, 0x10), tags[0])
+        self.assertEqual(9500, tags[-1][0])
+        self.assertEqual(8, len(tags))
+
+    def test_run_recorder_in_service(self):
+        """
+        - call session.run() with recorder service
+        - call session.close()
+
+        Expected: recording was started and stopped by service
+        """
+        from core.config import config
+        endpoint = Mock(ip='127.0.0.1', name='test_endpoint')
+        self.app.recorder = Mock()
+
+        with patch(
+            'core.db.Database', DatabaseMock()
+        ), patch.object(
+            config, 'SCREENCAST_RECORDER_PROCESSES', 2, create=True
+        ):
+            from core.sessions import Session
+            session = Session(dc={'takeScreencast': True, 'platform': 'test_origin_1'})
+            session.run(endpoint=endpoint)
+            session.close()
+        del self.app.recorder
+        shutil.rmtree(session.vnc_helper.dir_path, ignore_errors=True)
+
+        args = session.vnc_helper.service.start_recording.call_args[0]
+        self.assertEqual((session.id, '127.0.0.1', 5900), (args[0], args[2], args[3]))
+        self.assertIsNone(session.vnc_helper.recorder)
+        session.vnc_helper.service.stop_recording.assert_called_once_with(
+            session.id, True)
+
+    def test_recorder_service(self):
+        """
+        - start service with two workers
+        - start two recordings
+        - get workers stats
+        - stop service
+
+        Expected: recordings went to different workers, every worker
+        reported stats, workers were stopped
+        """
+        from core.config import config
+        from core.video import VNCRecorderService
+        from core.utils.network_utils import get_free_port
+        filenames = [os.sep.join([config.SCREENSHOTS_DIR, 'service_%s.flv' % session_id])
+                     for session_id in (1, 2)]
+        service = VNCRecorderService(processes=2)
+        service.start()
+        try:
+            port = get_free_port()
+            workers = [
+                service.start_recording(
+                    session_id, filename, '127.0.0.1', port, buffer_duration=1
+                )
+                for session_id, filename in zip((1, 2), filenames)
+            ]
+            stats = service.stats()
+            service.stop_recording(1)
+        finally:
+            service.stop()
+            for filename in filenames:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        self.assertNotEqual(workers[0].index, workers[1].index)
+        self.assertEqual([0, 1], sorted(s["worker"] for s in stats))
+        for s in stats:
+            self.assertEqual(set(["worker", "pid", "sessions", "cpu", "memory"]), set(s.keys()))
+        self.assertEqual({2: workers[1]}, service.sessions)
+        self.assertFalse(any(worker.is_alive() for worker in service.workers))
+
+    def test_connect_does_not_block_worker(self):
+        """
+        - start worker
+        - start recording to server with full accept backlog
+        - request worker stats
+
+        Expected: worker answered while recording was connecting
+        """
+        import time
+        import socket
+        from core.config import config
+        from core.video import RecorderWorker
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(0)
+        client = socket.create_connection(server.getsockname())
+        with patch.object(config, 'SCREENCAST_RECORDER_CONNECT_TIMEOUT', 5, create=True):
+            worker = RecorderWorker(0)
+            worker.start()
+        try:
+            worker.send("start", 1, os.sep.join([config.SCREENSHOTS_DIR, 'unreachable.flv']),
+                        "127.0.0.1", server.getsockname()[1], {"buffer_duration": 1})
+            start = time.time()
+            stats = worker.request("stats", timeout=2)
+            elapsed = time.time() - start
+            worker.send("stop", 1, False)
+            worker.send("exit")
+            worker.join(5)
+        finally:
+            if worker.is_alive():
+                worker.terminate()
+            client.close()
+            server.close()
+
+        self.assertIsNotNone(stats)
+        self.assertLess(elapsed, 1)
+
+    def test_refused_connection(self):
+        """
+        - open recording to port which isn't listened
+        - call connected() when socket is writable
+
+        Expected: connection error was raised
+        """
+        import select
+        import socket
+        from core.video import Recording
+        from core.utils.network_utils import get_free_port
+        recording = Recording('refused.flv', '127.0.0.1', get_free_port(), buffer_duration=1)
+        try:
+            recording.open()
+            self.assertTrue(recording.connecting)
+            select.select([], [recording], [], 1)
+            self.assertRaises(socket.error, recording.connected)
+        finally:
+            recording.close(persist=False)
+
+    def test_commands_to_stuck_and_dead_worker(self):
+        """
+        - start worker which doesn't read commands
+        - send commands until pipe is full
+        - terminate worker and send command
+
+        Expected: commands weren't sent instead of blocking sender
+        """
+        import time
+        from core.config import config
+        from core.video import RecorderWorker
+        with patch.object(RecorderWorker, 'run', lambda self: time.sleep(10)):
+            worker = RecorderWorker(0)
+            worker.start()
+        self.assertTrue(worker.conn.closed)
+
+        with patch.object(config, 'SCREENCAST_RECORDER_SEND_TIMEOUT', 0.1, create=True):
+            try:
+                sent = 0
+                while worker.send("stop", "x" * 4096) and sent < 10000:
+                    sent += 1
+                self.assertTrue(0 < sent < 10000)
+            finally:
+                worker.terminate()
+                worker.join()
+            self.assertFalse(worker.send("stop", 1))
+            self.assertIsNone(worker.request("stats"))
+
+    def test_adaptive_sink_skips_idle_frames(self):
+        """
+        - flush adaptive sink without screen changes
+        - flush after idle interval
+        - change screen and flush twice
+
+        Expected: unchanged frames were skipped, one idle frame was written,
+        keyframe was written only with the first change after keyframe interval
+        """
+        from core.video import AdaptiveFLVVideoSink
+        writer = Mock()
+        sink = AdaptiveFLVVideoSink(
+            writer, idle_interval=2000, keyframe_interval=1000, framerate=10
+        )
+        sink.init_screen(64, 64)
+        for t in (0, 200, 400, 1000, 2000):
+            sink.flush(t)
+        for t, pixel in ((2100, '\xff'), (2300, '\x80')):
+            sink.update_screen_rgbabits((0, 0), (4, 4), pixel * 64)
+            sink.flush(t)
+
+        frames = [(args[0], bool(ord(args[1][0]) & 0x10))
+                  for args, _ in writer.write_video_frame.call_args_list]
+        self.assertEqual(
+            [(0, True), (2000, False), (2100, True), (2300, False)], frames)
+        self.assertEqual(20, sink.skipped_frames)
+
+    def test_skipped_frames_are_reported_on_close(self):
+        """
+        - close adaptive recording which skipped frames
+
+        Expected: skipped frames were sent as metric
+        """
+        from core.video import Recording
+        recording = Recording('skipped.flv', adaptive=True, buffer_duration=1)
+        recording.sink.skipped_frames = 20
+
+        with patch('core.video.send_metrics') as send_metrics:
+            recording.close(persist=False)
+        send_metrics.assert_called_once_with('vnc_recorder.skipped_frames', 20)
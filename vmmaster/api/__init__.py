@@ -1,10 +1,12 @@
 # coding: utf-8
 
 import json
+import errno
 import helpers
 import logging
 
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, Response, jsonify, request, current_app, \
+    send_file
 
 from core import constants
 from vmpool.api import helpers as vmpool_helpers
@@ -44,10 +46,16 @@ def artifacts():
     queue = vmpool_helpers.get_artifact_collector_queue()
     return render_json({
         "amount": len(queue),
-        "queue": queue
+        "queue": queue,
+        "progress": vmpool_helpers.get_artifact_collector_progress()
     })
 
 
+@api.route('/recorder')
+def recorder():
+    return render_json({'workers': helpers.get_recorder_stats()})
+
+
 @api.route('/platforms')
 def platforms():
     return render_json(result={'platforms': vmpool_helpers.get_platforms()})
@@ -134,6 +142,51 @@ def get_screenshot_for_log_step(session_id, log_step_id):
     })
 
 
+@api.route(
+    '/session/<int:session_id>/step/<int:log_step_id>/screenshot',
+    methods=['GET']
+)
+def get_screenshot_image(session_id, log_step_id):
+    """
+    Screenshot png, resized to width and height from query if they are set.
+    """
+    width = request.args.get('width', type=int)
+    height = request.args.get('height', type=int)
+    max_size = getattr(config, "SCREENSHOT_MAX_RESIZE", 4096)
+    if height and not width or any(
+            value is not None and not 0 < value <= max_size
+            for value in (width, height)):
+        return render_json("Width and height should be from 1 to %s, "
+                           "height can't be set without width" % max_size,
+                           400)
+
+    path = helpers.get_screenshot_path(session_id, log_step_id)
+    if not path:
+        return render_json("Screenshot for step %s not found" % log_step_id,
+                           404)
+
+    try:
+        etag = current_app.thumbnails.etag(path, width, height)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        elif width:
+            response = Response(
+                current_app.thumbnails.get(path, width, height),
+                mimetype='image/png'
+            )
+        else:
+            response = send_file(path, mimetype='image/png', add_etags=False)
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return render_json(
+                "Screenshot for step %s not found" % log_step_id, 404)
+        log.warning("Screenshot %s can't be resized: %s" % (path, e))
+        return render_json(
+            "Screenshot for step %s isn't a valid png" % log_step_id, 415)
+    response.set_etag(etag)
+    return response
+
+
 @api.route('/session/<int:session_id>/label/<int:label_id>/screenshots',
            methods=['GET'])
 def get_screenshots_for_label(session_id, label_id):
@@ -148,15 +201,11 @@ def get_vnc_info(session_id):
 
     _session = helpers.get_session(session_id)
     if _session and _session.endpoint_ip:
-        if _session.vnc_helper.proxy:
-            result, code = (
-                {'vnc_proxy_port': _session.vnc_helper.get_proxy_port()}, 200
-            )
-        else:
-            _session.vnc_helper.start_proxy()
-            result, code = (
-                {'vnc_proxy_port': _session.vnc_helper.get_proxy_port()}, 200
-            )
+        result, code = {
+            'vnc_proxy_port': config.PORT,
+            'vnc_proxy_path': 'proxy/vnc/%s' % session_id,
+            'vnc_proxy_traffic': helpers.get_vnc_proxy_stats(session_id)
+        }, 200
 
     return render_json(result=result, code=code)
 
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import os
 from flask import current_app
 from core.exceptions import SessionException
 
@@ -26,10 +27,24 @@ def get_sessions():
 def get_queue():
     queue = list()
     for session in current_app.sessions.waiting():
-        queue.append(session.info)
+        info = session.info
+        info["position"] = current_app.pool.queue_position(session.id)
+        queue.append(info)
     return queue
 
 
+def get_recorder_stats():
+    if current_app.recorder is None:
+        return []
+    return current_app.recorder.stats()
+
+
+def get_vnc_proxy_stats(session_id):
+    if current_app.vnc_proxy is None:
+        return {}
+    return current_app.vnc_proxy.stats(session_id)
+
+
 def get_user(user_id):
     return current_app.database.get_user(user_id=user_id)
 
@@ -56,6 +71,14 @@ def get_screenshots(session_id, log_step_id=None):
     return sorted(screenshots)
 
 
+def get_screenshot_path(session_id, log_step_id):
+    log_step = current_app.database.get_step_by_id(log_step_id)
+    if log_step and log_step.session_id == session_id \
+            and log_step.screenshot and os.path.isfile(log_step.screenshot):
+        return log_step.screenshot
+    return None
+
+
 def get_screenshots_for_label(session_id, label_id):
     steps_groups = {}
     current_label = 0
@@ -18,13 +18,32 @@ class JSONEncoder(json.JSONEncoder):
 class Vmmaster(Flask):
     def __init__(self, *args, **kwargs):
         from core.db import Database
+        from core.db.journal import LogJournal
         from core.sessions import Sessions
+        from core.video import VNCRecorderService
+        from core.screenshots import ScreenshotPipeline, ThumbnailCache
         from vmpool.virtual_machines_pool import VirtualMachinesPool
 
         super(Vmmaster, self).__init__(*args, **kwargs)
         self.running = True
         self.uuid = str(uuid1())
+        self.recorder = None
+        if getattr(config, "SCREENCAST_RECORDER_PROCESSES", 0):
+            # fork recorder workers before pool and sessions threads start
+            self.recorder = VNCRecorderService()
+            self.recorder.start()
+        self.screenshots = None
+        if getattr(config, "SCREENSHOT_PROCESSES", 0):
+            self.screenshots = ScreenshotPipeline(self)
+            self.screenshots.start()
+        self.thumbnails = ThumbnailCache()
         self.database = Database()
+        self.journal = None
+        # websocket vnc proxy is set by VMMasterServer
+        self.vnc_proxy = None
+        if getattr(config, "LOG_JOURNAL", False):
+            self.journal = LogJournal(self.database)
+            self.journal.start()
         self.pool = VirtualMachinesPool(self)
         self.sessions = Sessions(self)
         self.json_encoder = JSONEncoder
@@ -40,6 +59,12 @@ class Vmmaster(Flask):
         log.info("Shutting down...")
         self.pool.stop_workers()
         self.sessions.worker.stop()
+        if self.screenshots is not None:
+            self.screenshots.stop()
+        if self.journal is not None:
+            self.journal.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
         self.pool.free()
         self.unregister()
         self.pool.platforms.cleanup()
@@ -9,6 +9,7 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import ArgumentError
 
 from core.config import config, setup_config
+from core.screenshots import delete_unused_blobs
 from core.db.models import Session, User
 from core.utils import change_user_vmmaster
 from core.utils.init import home_dir
@@ -78,6 +79,7 @@ def delete_session_data(sessions=None):
             delete(session_id)
         log.info(
             "%s sessions have been deleted.\n" % (str(sessions_count)))
+        delete_unused_blobs()
     else:
         log.info("Nothing to delete.\n")
 
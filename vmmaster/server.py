@@ -14,6 +14,7 @@ from twisted.internet.threads import deferToThread
 
 from app import create_app
 from http_proxy import ProxyResource, HTTPChannelWithClient
+from vnc_proxy import VNCProxyResource
 from core.config import config
 
 log = logging.getLogger(__name__)
@@ -56,7 +57,10 @@ class VMMasterServer(object):
         wsgi_resource = WSGIResource(self.reactor, self.thread_pool, self.app)
 
         root_resource = RootResource(wsgi_resource)
-        root_resource.putChild("proxy", ProxyResource(self.app))
+        self.app.vnc_proxy = VNCProxyResource(self.app)
+        proxy_resource = RootResource(ProxyResource(self.app))
+        proxy_resource.putChild("vnc", self.app.vnc_proxy)
+        root_resource.putChild("proxy", proxy_resource)
         site = Site(root_resource)
         site.protocol = HTTPChannelWithClient
         self.bind = self.reactor.listenTCP(port, site)
@@ -70,6 +74,8 @@ class VMMasterServer(object):
 
     def __del__(self):
         d = self.bind.stopListening()
+        # port is closed by reactor thread, wake it up if it waits in select
+        self.reactor.wakeUp()
         _block_on(d, 20)
         self.app.cleanup()
         self.thread_pool.stop()
@@ -0,0 +1,363 @@
+# coding: utf-8
+
+import base64
+import logging
+import struct
+from hashlib import sha1
+from threading import Lock
+from collections import defaultdict
+
+from websocket import ABNF
+from twisted.internet import reactor, protocol
+from twisted.internet.threads import deferToThread
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from core.config import config
+from core.utils.graphite import send_metrics
+
+log = logging.getLogger(__name__)
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_VERSION = "13"
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+
+def accept_key(key):
+    return base64.b64encode(sha1(key + WEBSOCKET_GUID).digest())
+
+
+def frame_header(length, opcode=ABNF.OPCODE_BINARY):
+    """
+    Header of unmasked final frame, payload is written after it
+    without copying it into one string.
+    """
+    if length < 126:
+        return struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        return struct.pack("!BBH", 0x80 | opcode, 126, length)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+
+def parse_frame(data, max_size):
+    """
+    :return: (fin, opcode, payload, frame length) or None
+    if data doesn't contain whole frame yet
+    """
+    if len(data) < 2:
+        return None
+    first, second = ord(data[0]), ord(data[1])
+    fin, opcode = first & 0x80, first & 0x0f
+    masked, length = second & 0x80, second & 0x7f
+    offset = 2
+    if length == 126:
+        if len(data) < 4:
+            return None
+        length, = struct.unpack_from("!H", data, 2)
+        offset = 4
+    elif length == 127:
+        if len(data) < 10:
+            return None
+        length, = struct.unpack_from("!Q", data, 2)
+        offset = 10
+
+    if not masked:
+        raise WebSocketError(CLOSE_PROTOCOL_ERROR,
+                             "Client frames must be masked")
+    if length > max_size:
+        raise WebSocketError(CLOSE_TOO_BIG,
+                             "Frame is too big: %s bytes" % length)
+
+    if len(data) < offset + 4 + length:
+        return None
+    mask = data[offset:offset + 4]
+    offset += 4
+    payload = ABNF.mask(mask, data[offset:offset + length])
+    return fin, opcode, payload, offset + length
+
+
+class WebSocketError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class VNCClientProtocol(protocol.Protocol):
+    def __init__(self, viewer):
+        self.viewer = viewer
+
+    def connectionMade(self):
+        self.viewer.vnc_connected(self)
+
+    # VM => Proxy
+    def dataReceived(self, data):
+        self.viewer.send(data)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.viewer.close(CLOSE_GOING_AWAY)
+
+
+class VNCClientFactory(protocol.ClientFactory):
+    def __init__(self, viewer):
+        self.viewer = viewer
+
+    def buildProtocol(self, addr):
+        return VNCClientProtocol(self.viewer)
+
+    def clientConnectionFailed(self, connector, reason):
+        log.warning("VNC proxy for session %s: %s" % (
+            self.viewer.session_id, reason.getErrorMessage()))
+        self.viewer.close(CLOSE_GOING_AWAY)
+
+
+class VNCViewer(object):
+    """
+    One websocket client of session vnc server.
+    Takes over http channel of upgrade request: data of the channel
+    is passed to write(), data from vnc server is passed to send().
+    """
+    vnc = None
+    closed = False
+
+    def __init__(self, proxy, session_id, channel, subprotocol=None,
+                 max_size=None):
+        self.proxy = proxy
+        self.session_id = session_id
+        self.channel = channel
+        self.transport = channel.transport
+        self.base64 = subprotocol == "base64"
+        self.max_size = max_size or getattr(
+            config, "VNC_PROXY_MAX_FRAME_SIZE", 1024 * 1024)
+        self.buffer = ""
+        self.message = []
+        self.pending = []
+        self.to_vm = 0
+        self.from_vm = 0
+
+    def __repr__(self):
+        return "<VNCViewer session:%s to_vm:%s from_vm:%s>" % (
+            self.session_id, self.to_vm, self.from_vm)
+
+    # Client => Proxy
+    def write(self, data):
+        if self.closed:
+            return
+        self.buffer += data
+        try:
+            while True:
+                frame = parse_frame(self.buffer, self.max_size)
+                if frame is None:
+                    break
+                fin, opcode, payload, length = frame
+                self.buffer = self.buffer[length:]
+                self.frame_received(fin, opcode, payload)
+        except WebSocketError as e:
+            log.warning("VNC proxy for session %s: %s" % (
+                self.session_id, e.message))
+            self.close(e.code)
+
+    def frame_received(self, fin, opcode, payload):
+        if opcode == ABNF.OPCODE_CLOSE:
+            self.close(CLOSE_NORMAL)
+        elif opcode == ABNF.OPCODE_PING:
+            self.send_frame(payload, ABNF.OPCODE_PONG)
+        elif opcode in (ABNF.OPCODE_CONT, ABNF.OPCODE_TEXT,
+                        ABNF.OPCODE_BINARY):
+            self.message.append(payload)
+            if fin:
+                data, self.message = "".join(self.message), []
+                if self.base64:
+                    data = base64.b64decode(data)
+                self.send_to_vm(data)
+
+    def send_to_vm(self, data):
+        self.to_vm += len(data)
+        if self.vnc is None:
+            self.pending.append(data)
+        else:
+            self.vnc.transport.write(data)
+
+    def vnc_connected(self, vnc):
+        if self.closed:
+            vnc.transport.loseConnection()
+            return
+        self.vnc = vnc
+        # stop reading from vm while viewer doesn't keep up
+        self.transport.registerProducer(vnc.transport, True)
+        if self.pending:
+            vnc.transport.writeSequence(self.pending)
+            self.pending = []
+
+    # Proxy => Client
+    def send(self, data):
+        if self.closed:
+            return
+        self.from_vm += len(data)
+        if self.base64:
+            self.send_frame(base64.b64encode(data), ABNF.OPCODE_TEXT)
+        else:
+            self.send_frame(data)
+
+    def send_frame(self, data, opcode=ABNF.OPCODE_BINARY):
+        self.transport.writeSequence([frame_header(len(data), opcode), data])
+
+    def close(self, code=CLOSE_NORMAL):
+        if self.closed:
+            return
+        self.send_frame(struct.pack("!H", code), ABNF.OPCODE_CLOSE)
+        self.connection_lost()
+        self.transport.loseConnection()
+
+    def connection_lost(self, reason=None):
+        if self.closed:
+            return
+        self.closed = True
+        if self.vnc is not None:
+            self.transport.unregisterProducer()
+            self.vnc.transport.loseConnection()
+        self.proxy.remove_viewer(self)
+
+
+class VNCProxyResource(Resource):
+    """
+    Websocket proxy to vnc servers of sessions:
+    /proxy/vnc/<session_id> is connected to port 5900 of session endpoint.
+    """
+    isLeaf = True
+
+    def __init__(self, app, port=5900):
+        Resource.__init__(self)
+        self.app = app
+        self.port = port
+        self.viewers = defaultdict(set)
+        self.lock = Lock()
+
+    def add_viewer(self, viewer):
+        with self.lock:
+            self.viewers[viewer.session_id].add(viewer)
+
+    def remove_viewer(self, viewer):
+        with self.lock:
+            viewers = self.viewers.get(viewer.session_id, set())
+            viewers.discard(viewer)
+            if not viewers:
+                self.viewers.pop(viewer.session_id, None)
+        log.info("VNC viewer of session %s disconnected, "
+                 "sent to vm: %s bytes, received from vm: %s bytes" % (
+                     viewer.session_id, viewer.to_vm, viewer.from_vm))
+        send_metrics("vnc_proxy.to_vm", viewer.to_vm)
+        send_metrics("vnc_proxy.from_vm", viewer.from_vm)
+
+    def disconnect(self, session_id):
+        """
+        Can be called from any thread.
+        """
+        with self.lock:
+            viewers = list(self.viewers.get(session_id, ()))
+        for viewer in viewers:
+            reactor.callFromThread(viewer.close, CLOSE_GOING_AWAY)
+
+    def stats(self, session_id):
+        """
+        Can be called from any thread.
+        """
+        with self.lock:
+            viewers = list(self.viewers.get(session_id, ()))
+        return {
+            "viewers": len(viewers),
+            "to_vm": sum(viewer.to_vm for viewer in viewers),
+            "from_vm": sum(viewer.from_vm for viewer in viewers)
+        }
+
+    def _parse_uri(self, request):
+        return int(request.postpath[0])
+
+    @staticmethod
+    def get_subprotocol(request):
+        protocols = [
+            p.strip() for p in
+            (request.getHeader("sec-websocket-protocol") or "").split(",")
+        ]
+        for subprotocol in ("binary", "base64"):
+            if subprotocol in protocols:
+                return subprotocol
+
+    @staticmethod
+    def handshake(request, subprotocol):
+        key = request.getHeader("sec-websocket-key")
+        lines = [
+            "HTTP/1.1 101 Switching Protocols",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Accept: %s" % accept_key(key)
+        ]
+        if subprotocol:
+            lines.append("Sec-WebSocket-Protocol: %s" % subprotocol)
+        request.channel.transport.write("\r\n".join(lines) + "\r\n\r\n")
+
+    def process(self, request):
+        try:
+            session_id = self._parse_uri(request)
+        except:
+            raise Exception(
+                "Couldn't parse request uri, "
+                "make sure you request uri has /proxy/vnc/<session_id>")
+
+        if (request.getHeader("upgrade") or "").lower() != "websocket" \
+                or not request.getHeader("sec-websocket-key"):
+            request.setResponseCode(400)
+            return "Websocket upgrade request expected"
+        if request.getHeader("sec-websocket-version") != WEBSOCKET_VERSION:
+            request.setResponseCode(426)
+            request.setHeader("Sec-WebSocket-Version", WEBSOCKET_VERSION)
+            return "Unsupported websocket version"
+
+        # session is read from database, which must not block reactor
+        d = deferToThread(self.get_session, session_id)
+        d.addCallback(self.connect, request, session_id)
+        d.addErrback(self.failed, request)
+        return NOT_DONE_YET
+
+    def get_session(self, session_id):
+        with self.app.app_context():
+            session = self.app.sessions.get_session(session_id)
+        if not session.endpoint_ip:
+            raise Exception("Session %s has no endpoint yet" % session_id)
+        return session
+
+    def connect(self, session, request, session_id):
+        if request._disconnected:
+            return
+
+        subprotocol = self.get_subprotocol(request)
+        self.handshake(request, subprotocol)
+
+        channel = request.channel
+        channel.setTimeout(None)
+        viewer = VNCViewer(self, session_id, channel, subprotocol)
+        channel.client = viewer
+        request.notifyFinish().addErrback(viewer.connection_lost)
+        self.add_viewer(viewer)
+        reactor.connectTCP(
+            session.endpoint_ip, self.port, VNCClientFactory(viewer),
+            timeout=getattr(config, "VNC_PROXY_CONNECT_TIMEOUT", 5))
+        log.info("VNC viewer of session %s connected" % session_id)
+
+    @staticmethod
+    def failed(failure, request):
+        if request._disconnected:
+            return
+        request.setResponseCode(500)
+        request.write(failure.getErrorMessage())
+        request.finish()
+
+    def render(self, request):
+        try:
+            return self.process(request)
+        except Exception as e:
+            request.setResponseCode(500)
+            return e.message
@@ -4,7 +4,7 @@ from datetime import datetime
 from traceback import format_exc
 from flask import Blueprint, current_app, request, jsonify, g
 
-from vmmaster.webdriver import commands, helpers
+from vmmaster.webdriver import commands, helpers, capture
 
 from core.exceptions import SessionException
 from core.auth.custom_auth import auth, anonymous
@@ -72,14 +72,18 @@ def before_request():
 
 
 def log_response(session, response, created=None):
-    response_data = utils.remove_base64_screenshot(response.data)
+    if response.is_streamed:
+        response_data = "<streamed>"
+    else:
+        response_data = utils.remove_base64_screenshot(response.data)
     session.add_session_step(control_line=response.status_code,
                              body=response_data, created=created)
 
 
 @webdriver.after_request
 def after_request(response):
-    log.debug('Response %s %s' % (response.data, response.status_code))
+    if not response.is_streamed:
+        log.debug('Response %s %s' % (response.data, response.status_code))
     session = get_vmmaster_session(request)
     parts = request.path.split("/")
 
@@ -89,7 +93,8 @@ def after_request(response):
             if request.method == 'DELETE' and parts[-2] == "session" \
                     and parts[-1] == str(session.id):
                 session.succeed()
-            else:
+            elif not response.is_streamed:
+                # streamed response starts timer when it's over
                 session.start_timer()
 
     return response
@@ -145,11 +150,10 @@ def take_screenshot(status, body):
     only_screenshots = ["element", "execute_async"]
     parts = request.path.split("/")
     if set(words) & set(parts) or parts[-1] == "session":
-        utils.to_thread(
-            helpers.take_screenshot_from_session(request.session))
+        capture.take_screenshot(request.session, request.method, request.path,
+                                request.data, status, body)
     elif set(only_screenshots) & set(parts) and status == 500:
-        utils.to_thread(
-            helpers.take_screenshot_from_response(request.session, body))
+        helpers.take_screenshot_from_response(request.session, body)
 
 
 @webdriver.route(
@@ -158,6 +162,10 @@ def take_screenshot(status, body):
 def agent_command(session_id):
     request.session = current_app.sessions.get_session(session_id)
 
+    if request.args.get("stream"):
+        return helpers.stream_vmmaster_agent(
+            commands.AgentCommands['runScript'])
+
     status, headers, body = helpers.vmmaster_agent(
         commands.AgentCommands['runScript'])
 
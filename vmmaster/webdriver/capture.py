@@ -0,0 +1,180 @@
+# coding: utf-8
+
+import json
+import time
+import logging
+
+from threading import Thread, Lock
+from flask import current_app
+
+from vmmaster.webdriver import commands, helpers
+from core.config import config
+from core.utils.graphite import send_metrics
+
+log = logging.getLogger(__name__)
+
+POLICIES = ("always", "failure", "every_n", "changed")
+
+
+def is_failed(status, body):
+    if status != 200:
+        return True
+    try:
+        return json.loads(body).get("status", 0) != 0
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+
+def get_screen(body):
+    try:
+        return json.loads(body).get("value", {}).get("screen")
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def get_url(data):
+    try:
+        return json.loads(data).get("url")
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+class CapturePolicy(object):
+    """
+    Decides which commands of session are followed by screenshot:
+    always - every command,
+    failure - failed commands,
+    every_n - every n-th command,
+    changed - commands which can change page: POST commands,
+    except navigation to current url.
+    """
+    def __init__(self, mode=None, every=None):
+        self.mode = mode or getattr(config, "SCREENSHOT_POLICY", "always")
+        if self.mode not in POLICIES:
+            log.warning("Unknown screenshot policy %s, "
+                        "screenshots are taken always" % self.mode)
+            self.mode = "always"
+        self.every = every or getattr(config, "SCREENSHOT_EVERY_N", 5)
+        self.commands = 0
+        self.url = None
+
+    def should_capture(self, method, path, data, status, body):
+        self.commands += 1
+        if self.mode == "failure":
+            return is_failed(status, body)
+        elif self.mode == "every_n":
+            return self.commands % self.every == 0
+        elif self.mode == "changed":
+            return self.changed(method, path, data)
+        return True
+
+    def changed(self, method, path, data):
+        if method != "POST":
+            return False
+        if path.split("/")[-1] == "url":
+            url, self.url = self.url, get_url(data)
+            return url != self.url
+        return True
+
+
+class ScreenshotCapture(object):
+    """
+    Takes screenshots of session from vmmaster agent in background thread.
+    Screenshots requested while previous one is taken are coalesced
+    into one screenshot of last step. Screenshots are taken
+    not more often than every min_interval seconds.
+    Screenshots of failed commands are taken at once in request thread.
+    """
+    log_step = None
+    thread = None
+    last_capture = 0
+    stopped = False
+
+    def __init__(self, session, policy=None, min_interval=None):
+        self.session = session
+        self.policy = policy or CapturePolicy()
+        self.min_interval = min_interval or getattr(
+            config, "SCREENSHOT_MIN_INTERVAL", 0)
+        self.app = current_app._get_current_object()
+        self.lock = Lock()
+
+    def on_command(self, method, path, data, status, body):
+        if not self.policy.should_capture(method, path, data, status, body):
+            return
+        # failed commands can have screenshot in response already
+        screenshot = get_screen(body) if status != 200 else None
+        if screenshot:
+            helpers.save_screenshot(self.session, screenshot)
+        elif self.policy.mode == "failure":
+            self.capture_safely(self.session.current_log_step)
+        else:
+            self.schedule(self.session.current_log_step)
+
+    def schedule(self, log_step):
+        with self.lock:
+            if self.stopped:
+                return
+            coalesced = self.log_step is not None
+            self.log_step = log_step
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+        if coalesced:
+            send_metrics("screenshots.coalesced", 1)
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                wait = self.last_capture + self.min_interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+                with self.lock:
+                    log_step, self.log_step = self.log_step, None
+                    if log_step is None:
+                        self.thread = None
+                        return
+
+                self.last_capture = time.time()
+                self.capture_safely(log_step)
+
+    def flush(self, timeout=None):
+        """
+        Wait until pending screenshot is taken,
+        new screenshots are not scheduled after it.
+        Called on session close, before endpoint is released.
+        """
+        if timeout is None:
+            timeout = getattr(config, "SCREENSHOT_FLUSH_TIMEOUT", 5)
+        with self.lock:
+            self.stopped = True
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                log.warning("Screenshot for session %s wasn't taken "
+                            "in %ss before close" % (self.session.id, timeout))
+
+    def capture_safely(self, log_step):
+        try:
+            self.capture(log_step)
+        except Exception as e:
+            log.warning("Screenshot for session %s wasn't taken: %s"
+                        % (self.session.id, e))
+
+    def capture(self, log_step):
+        screenshot = None
+        for screenshot in commands.take_screenshot(
+                self.session, config.VMMASTER_AGENT_PORT):
+            pass
+        helpers.save_screenshot(self.session, screenshot, log_step)
+
+
+def take_screenshot(session, method, path, data, status, body):
+    if not session.take_screenshot:
+        return
+    if session.screenshot_capture is None:
+        session.screenshot_capture = ScreenshotCapture(session)
+    session.screenshot_capture.on_command(method, path, data, status, body)
@@ -1,17 +1,19 @@
 # coding: utf-8
 
 import json
+import time
 import httplib
-from functools import partial, wraps
+from functools import wraps
 import websocket
 import logging
 
 from traceback import format_exc
 from core import utils
 from core.utils import network_utils
-from core.utils import generator_wait_for
+from core.utils import generator_join
 
 from vmmaster.webdriver.helpers import check_to_exist_ip, connection_watcher
+from vmpool import HealthState
 
 from core.config import config
 from core.exceptions import CreationException
@@ -60,15 +62,27 @@ def start_session(request, session):
     ping_vm(session)
     yield status, headers, body
 
-    selenium_status(request, session, config.SELENIUM_PORT)
-    yield status, headers, body
+    hot_session = None
+    if getattr(config, "HOT_SESSION_PROFILES", None):
+        hot_session = session.endpoint.take_hot_session(
+            get_desired_capabilities(request))
+
+    if hot_session:
+        log.info("Hot selenium session %s adopted for %s" %
+                 (hot_session.id, session.id))
+        status, headers, body = httplib.OK, {
+            "Content-Type": "application/json;charset=UTF-8"
+        }, hot_session.body
+    else:
+        selenium_status(request, session, config.SELENIUM_PORT)
+        yield status, headers, body
 
-    if session.run_script:
-        startup_script(session)
+        if session.run_script:
+            startup_script(session)
 
-    status, headers, body = start_selenium_session(
-        request, session, config.SELENIUM_PORT
-    )
+        status, headers, body = start_selenium_session(
+            request, session, config.SELENIUM_PORT
+        )
 
     selenium_session = json.loads(body)["sessionId"]
     session.selenium_session = selenium_session
@@ -96,15 +110,29 @@ def ping_vm(session):
     ip = check_to_exist_ip(session)
     ports = [config.SELENIUM_PORT, config.VMMASTER_AGENT_PORT]
 
+    health = getattr(session.endpoint, "health", None)
+    if isinstance(health, HealthState) and health.lookup():
+        log.info("Ping skipped, {ip} was checked {age:.1f}s ago".format(
+            ip=ip, age=time.time() - health.checked))
+        if session.closed:
+            raise CreationException("Session was closed while ping")
+        yield True
+        return
+
     log.info("Starting ping: {ip}:{ports}".format(ip=ip, ports=str(ports)))
-    _ping = partial(network_utils.ping, ip)
+    target = network_utils.probe_ports(ip, ports)
+    try:
+        deadline = time.time() + config.PING_TIMEOUT
+        while not target.ready.is_set() and time.time() < deadline:
+            target.ready.wait(min(0.5, deadline - time.time()))
+            yield False
+        result = target.wait(0)
+    finally:
+        target.release()
 
-    def check():
-        return all(map(_ping, ports))
-    for _ in generator_wait_for(check, config.PING_TIMEOUT):
-        yield False
+    if isinstance(health, HealthState):
+        health.update(all(result))
 
-    result = map(_ping, ports)
     if not all(result):
         fails = [port for port, res in zip(ports, result) if res is False]
         raise CreationException("Failed to ping ports %s" % str(fails))
@@ -226,12 +254,21 @@ def take_screenshot(session, port):
 
 
 @connection_watcher
-def run_script_through_websocket(script, session, host):
+def run_script_through_websocket(script, session, host, stream=None):
+    """
+    :param stream: Queue, gets output chunks as they arrive
+    """
     status_code = 200
     default_msg = json.dumps({"status": 0, "output": ""})
     sub_step = session.add_sub_step(
         control_line=status_code,
         body=default_msg)
+    update_interval = getattr(config, "RUN_SCRIPT_UPDATE_INTERVAL", 1)
+
+    def update_sub_step(_ws):
+        _ws.updated = time.time()
+        msg = json.dumps({"status": _ws.status, "output": _ws.output.getvalue()})
+        update_log_step(sub_step, message=msg)
 
     def on_open(_ws):
         def run():
@@ -243,22 +280,25 @@ def run_script_through_websocket(script, session, host):
         _t.start()
 
     def on_message(_ws, message):
-        _ws.output += message
-        if sub_step:
-            msg = json.dumps({"status": _ws.status, "output": _ws.output})
-            update_log_step(sub_step, message=msg)
+        _ws.output.append(message)
+        if stream is not None:
+            stream.put(message)
+        # sub-step is written not more often than once per update_interval
+        if sub_step and time.time() - _ws.updated >= update_interval:
+            update_sub_step(_ws)
 
     def on_close(_ws):
         if sub_step and ws.output:
-            msg = json.dumps({"status": _ws.status, "output": _ws.output})
-            update_log_step(sub_step, message=msg)
+            update_sub_step(_ws)
         log.info("RunScript: Close websocket on vm %s" % host)
 
     def on_error(_ws, message):
         global status_code
         status_code = 500
         _ws.status = 1
-        _ws.output += repr(message)
+        _ws.output.append(repr(message))
+        if stream is not None:
+            stream.put(repr(message))
         log.debug("RunScript error: %s" % message)
 
     ws = websocket.WebSocketApp(host,
@@ -266,22 +306,23 @@ def run_script_through_websocket(script, session, host):
                                 on_close=on_close,
                                 on_open=on_open,
                                 on_error=on_error)
-    ws.output = ""
+    ws.output = utils.OutputBuffer()
     ws.status = 0
+    ws.updated = 0
     session.ws = ws
 
     t = Thread(target=copy_current_request_context(ws.run_forever))
     t.daemon = True
     t.start()
 
-    while t.isAlive():
+    for _ in generator_join(t):
         yield None, None, None
 
-    full_msg = json.dumps({"status": ws.status, "output": ws.output})
+    full_msg = json.dumps({"status": ws.status, "output": ws.output.getvalue()})
     yield status_code, {}, full_msg
 
 
-def run_script(request, session):
+def run_script(request, session, stream=None):
     host = "ws://%s:%s/runScript" % (session.endpoint_ip,
                                      config.VMMASTER_AGENT_PORT)
 
@@ -289,12 +330,13 @@ def run_script(request, session):
         control_line="%s %s" % (request.method, '/runScript'),
         body=request.data)
 
-    return run_script_through_websocket(request.data, session, host)
+    return run_script_through_websocket(request.data, session, host, stream)
 
 
 def vmmaster_label(request, session):
     json_body = json.loads(request.data)
     label = session.current_log_step
+    label.flush()
     return 200, {}, json.dumps({"sessionId": session.id, "status": 0,
                                 "value": json_body["label"],
                                 "labelId": label.id})
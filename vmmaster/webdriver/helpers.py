@@ -1,23 +1,24 @@
 # coding: utf-8
 
-import base64
 import commands
 import json
 import time
 import logging
 
-from functools import wraps
-from flask import Response, request
+from Queue import Queue
+from threading import Thread
+from functools import wraps, partial
+from flask import Response, request, copy_current_request_context, \
+    stream_with_context, current_app
 
 from core.exceptions import CreationException, ConnectionError, \
     TimeoutException, SessionException
 from core.config import config
 
 from core import constants
-from core import utils
+from core import screenshots
 from core.sessions import Session, RequestHelper
 from vmpool import endpoint
-from PIL import Image
 
 log = logging.getLogger(__name__)
 
@@ -53,21 +54,20 @@ def connection_watcher(func):
                 raise TimeoutException(session_timeouted)
             elif session_closed:
                 raise SessionException(session_closed)
-
-            time.sleep(0.01)
         return value
     return wrapper
 
 
-def save_screenshot(session, screenshot):
+def save_screenshot(session, screenshot, log_step=None):
     if screenshot:
-        log_step = session.current_log_step
+        log_step = log_step or session.current_log_step
+        log_step.flush()
         path = config.SCREENSHOTS_DIR + "/" + str(session.id) + \
             "/" + str(log_step.id) + ".png"
-        utils.write_file(path, base64.b64decode(screenshot))
-        log_step.screenshot = path
-        log_step.save()
-        make_thumbnail_for_screenshot(path)
+        if current_app.screenshots is not None:
+            current_app.screenshots.put(log_step, path, screenshot)
+        else:
+            screenshots.save_screenshot(log_step, path, screenshot)
 
 
 def take_screenshot_from_response(session, body):
@@ -82,43 +82,6 @@ def take_screenshot_from_response(session, body):
     save_screenshot(session, screenshot)
 
 
-def take_screenshot_from_session(session):
-    if session.take_screenshot:
-        for screenshot in commands.take_screenshot(session,
-                                                   config.VMMASTER_AGENT_PORT):
-            pass
-    else:
-        screenshot = None
-
-    save_screenshot(session, screenshot)
-
-
-def make_thumbnail_for_screenshot(screenshot_path):
-    screenshot_resize(screenshot_path, 128, postfix="_thumb")
-
-
-def screenshot_resize(screenshot_path, width, height=None, postfix=None):
-    try:
-        img = Image.open(screenshot_path)
-
-        if height:
-            size = width, height
-        else:
-            wpercent = (width / float(img.size[0]))
-            size = width, int((float(img.size[1]) * float(wpercent)))
-
-        if postfix:
-            postfix = "%s.png" % postfix
-        else:
-            postfix = "%sx%s.png" % size
-
-        new_file_path = screenshot_path.split('.png')[0] + postfix
-        img = img.resize(size, Image.ANTIALIAS)
-        img.save(new_file_path, "PNG")
-    except IOError:
-        log.debug("Can\'t resize image '%s'" % screenshot_path)
-
-
 def form_response(code, headers, body):
     """ Send reply to client. """
     if not code:
@@ -159,6 +122,52 @@ def vmmaster_agent(command):
     return code, headers, body
 
 
+def stream_vmmaster_agent(command):
+    """
+    Run agent command in thread and yield its output chunks as json lines,
+    the last line has status of command.
+    """
+    session = request.session
+    output = Queue()
+    result = {}
+
+    @copy_current_request_context
+    def run():
+        try:
+            result["response"] = vmmaster_agent(
+                partial(command, stream=output))
+        except Exception as e:
+            log.exception("Agent command failed for session %s" % session.id)
+            result["error"] = "%s" % e
+        finally:
+            output.put(None)
+
+    t = Thread(target=run)
+    t.daemon = True
+    t.start()
+
+    def generate():
+        try:
+            for chunk in iter(output.get, None):
+                yield json.dumps({"output": chunk}) + "\n"
+
+            code, headers, body = result.get("response", (500, {}, None))
+            try:
+                status = json.loads(body)["status"]
+            except (TypeError, ValueError, KeyError):
+                status = 1
+            line = {"status": status, "code": code}
+            if "error" in result:
+                line["error"] = result["error"]
+            yield json.dumps(line) + "\n"
+        finally:
+            if not session.closed:
+                session.start_timer()
+
+    return Response(response=stream_with_context(generate()), status=200,
+                    mimetype="application/x-ndjson")
+
+
 def internal_exec(command):
     code, headers, body = command(request, request.session)
     return code, headers, body
@@ -193,7 +202,7 @@ def get_endpoint(session_id, dc):
         wait_time += wait_time_increment
         try:
             log.info("Try to get endpoint for session %s. Attempt %s" % (session_id, attempt))
-            for vm in endpoint.get_vm(dc):
+            for vm in endpoint.get_vm(dc, session_id):
                 _endpoint = vm
                 yield _endpoint
             log.info("Attempt %s to get endpoint %s for session %s was succeed"
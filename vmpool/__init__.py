@@ -1,9 +1,57 @@
 # coding: utf-8
 
+import time
 from datetime import datetime
+from threading import Lock
+
+from core.config import config
 from core.dispatcher import dispatcher, Signals
 
 
+class HealthState(object):
+    """
+    Time of the last successful ping of virtual machine.
+    Ping is skipped if vm was checked less than HEALTH_CACHE_TTL seconds ago.
+    """
+    lock = Lock()
+    hits = 0
+    misses = 0
+
+    def __init__(self):
+        self.checked = None
+
+    def update(self, healthy):
+        self.checked = time.time() if healthy else None
+
+    def is_fresh(self, max_age=None):
+        if max_age is None:
+            max_age = getattr(config, "HEALTH_CACHE_TTL", 5)
+        return self.checked is not None \
+            and time.time() - self.checked <= max_age
+
+    def lookup(self):
+        """
+        Same as is_fresh, but counted in cache statistics.
+        """
+        fresh = self.is_fresh()
+        with self.lock:
+            if fresh:
+                HealthState.hits += 1
+            else:
+                HealthState.misses += 1
+        return fresh
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            total = cls.hits + cls.misses
+            return {
+                "hits": cls.hits,
+                "misses": cls.misses,
+                "hit_rate": float(cls.hits) / total if total else 0.0
+            }
+
+
 class VirtualMachine(object):
     def __init__(self, name, platform):
         self.name = name
@@ -13,7 +61,9 @@ class VirtualMachine(object):
         self.created = datetime.now()
         self.ready = False
         self.checking = False
+        self.creating = False
         self.done = False
+        self.health = HealthState()
 
     @property
     def info(self):
@@ -1,29 +1,138 @@
 # coding: utf-8
-from threading import Thread
+from threading import Thread, Event, Condition
 
 import os
+import gzip
 import json
+import time
+import pipes
 import logging
 
 import websocket
+from fnmatch import fnmatch
+from collections import defaultdict
 from flask import current_app
+from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
 
 from core import utils
 from core.config import config
+from core.utils.graphite import send_metrics
 
 
 log = logging.getLogger(__name__)
 
+PRIORITY_FAILED = 0
+PRIORITY_DEFAULT = 1
 
-def run_script(script, host):
+DEFAULT_ARTIFACTS = {
+    "selenium_server": "/var/log/selenium_server.log"
+}
+
+
+def abort_websocket(ws):
+    """
+    Stop websocket app running in another thread,
+    its blocked read is woken up by socket shutdown.
+    """
+    ws.keep_running = False
+    sock = ws.sock
+    if sock is not None:
+        sock.abort()
+
+
+class ArtifactWriter(object):
+    """
+    Writes artifact chunks to file as they arrive, optionally gzipped.
+    Chunks above max_size bytes are dropped and artifact marked truncated.
+    """
+    def __init__(self, path, compress=None, max_size=None):
+        self.compress = getattr(config, "ARTIFACT_COMPRESS", False) \
+            if compress is None else compress
+        self.max_size = getattr(config, "ARTIFACT_MAX_SIZE", 100 * 1024 * 1024) \
+            if max_size is None else max_size
+        self.path = "%s.gz" % path if self.compress else path
+        self.received = 0
+        self.written = 0
+        self.truncated = False
+        self.aborted = False
+        self.file = None
+        self.websocket = None
+
+    def open(self):
+        basedir = os.path.dirname(self.path)
+        if not os.path.exists(basedir):
+            os.makedirs(basedir)
+        os.chmod(basedir, 0777)
+
+        if self.compress:
+            self.file = gzip.open(self.path, "wb")
+        else:
+            self.file = open(self.path, "wb")
+        os.chmod(self.path, 0777)
+
+    def write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        self.received += len(chunk)
+        if self.stopped:
+            return
+
+        if self.max_size and self.written + len(chunk) > self.max_size:
+            chunk = chunk[:self.max_size - self.written]
+            self.truncated = True
+            log.warning("Artifact %s exceeds %s bytes and was truncated" %
+                        (self.path, self.max_size))
+
+        if self.file is None:
+            self.open()
+        self.file.write(chunk)
+        self.written += len(chunk)
+
+    def attach(self, ws):
+        """
+        Websocket of agent, it's closed when writer is aborted.
+        """
+        self.websocket = ws
+        if self.aborted:
+            abort_websocket(ws)
+
+    def abort(self):
+        self.aborted = True
+        if self.websocket is not None:
+            abort_websocket(self.websocket)
+
+    @property
+    def stopped(self):
+        return self.truncated or self.aborted
+
+    def close(self):
+        if self.file is None:
+            self.open()
+        self.file.close()
+
+    def remove(self):
+        if self.file is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def info(self):
+        return {
+            "path": self.path,
+            "received": self.received,
+            "written": self.written,
+            "truncated": self.truncated
+        }
+
+
+def run_script(script, host, output=None):
     """
     :param script: str
     :param host: str
+    :param output: file-like object for output chunks,
+    output is not kept in body if it's set
     :return: status, headers, body
     """
-    status_code = 200
-
     def on_open(_ws):
         def run():
             _ws.send(script)
@@ -34,17 +143,27 @@ def run_script(script, host):
         _t.start()
 
     def on_message(_ws, message):
-        _ws.output += message
+        if output is None:
+            _ws.output += message
+            return
+
+        output.write(message)
+        if getattr(output, "stopped", False):
+            _ws.close()
 
     def on_close(_ws):
         log.info("RunScript: Close websocket on vm %s" % host)
 
     def on_error(_ws, message):
-        global status_code
-        status_code = 500
+        if getattr(output, "stopped", False):
+            # websocket was closed by on_message
+            return
+        _ws.status_code = 500
         _ws.status = 1
-        _ws.output += str(message)
-        log.debug("RunScript error: %s" % message)
+        # error text is kept in body, but never written to artifact
+        if output is None:
+            _ws.output += str(message)
+        log.warning("RunScript error on vm %s: %s" % (host, message))
 
     ws = websocket.WebSocketApp(host,
                                 on_message=on_message,
@@ -53,79 +172,218 @@ def run_script(script, host):
                                 on_error=on_error)
     ws.output = ""
     ws.status = 0
+    ws.status_code = 200
+    if hasattr(output, "attach"):
+        output.attach(ws)
 
     t = Thread(target=ws.run_forever)
     t.daemon = True
     t.start()
 
-    while t.isAlive():
+    for _ in utils.generator_join(t):
         yield None, None, None
 
     full_msg = json.dumps({"status": ws.status, "output": ws.output})
     ws.close()
-    yield status_code, {}, full_msg
+    yield ws.status_code, {}, full_msg
+
+
+def get_artifacts(platform):
+    """
+    Artifacts spec of platform from ARTIFACTS config:
+    {"default": {name: path}, platform: {name: path}}, where path may be
+    a glob or {"path": path, "max_size": bytes}
+    :param platform: str
+    :return: dict
+    """
+    artifacts = getattr(config, "ARTIFACTS", {})
+    spec = dict(artifacts.get("default", DEFAULT_ARTIFACTS))
+    spec.update(artifacts.get(platform, {}))
+    return spec
+
+
+def parse_artifact(spec):
+    """
+    :param spec: str or dict
+    :return: path, max_size
+    """
+    if isinstance(spec, dict):
+        return spec["path"], spec.get("max_size")
+    return spec, None
+
+
+def is_glob(path):
+    return any(char in path for char in "*?[")
+
+
+def quote_glob(pattern):
+    """
+    Quote every character of pattern for shell except glob ones,
+    so that pattern is expanded but never executed.
+    """
+    return "".join(
+        char if char.isalnum() or char in "*?[]/._-" else pipes.quote(char)
+        for char in pattern
+    )
+
+
+def get_artifact_path(session_id, filename, original_path=None):
+    """
+    :param session_id: int
+    :param filename: str
+    :param original_path: str
+    :return: str
+    """
+    extension = os.path.splitext(original_path or "")[1] or ".log"
+    return os.sep.join(
+        [config.SCREENSHOTS_DIR, str(session_id), filename + extension]
+    )
 
 
-def save_artifact(session, filename, original_path):
+def save_artifact(session, filename, original_path, writer=None):
     """
     :param session: Session
     :param filename: str
     :param original_path: str
+    :param writer: ArtifactWriter
     :return: str
     """
     new_path = ""
-    for code, headers, body in get_artifact_from_endpoint(session, original_path):
-        pass
+    if writer is None:
+        writer = ArtifactWriter(
+            get_artifact_path(session.id, filename, original_path))
 
-    if code == 200:
-        path = os.sep.join(
-            [config.SCREENSHOTS_DIR, str(session.id), "%s.log" % filename]
-        )
-        try:
-            body = json.loads(body)
-            utils.write_file(path, body.get("output", "no data"))
-            new_path = path
-            log.debug("File %s was saved to %s " % (filename, new_path))
-        except:
-            log.exception("Selenium log file %s doesn't created for session %s"
-                          % (filename, session.id))
+    code = None
+    try:
+        for code, headers, body in get_artifact_from_endpoint(
+                session, original_path, writer, writer.max_size):
+            pass
+    finally:
+        writer.close()
+
+    if code == 200 and not writer.aborted:
+        new_path = writer.path
+        log.debug("File %s was saved to %s (%s bytes received)" %
+                  (filename, new_path, writer.received))
+    else:
+        writer.remove()
+        log.error("Artifact %s doesn't created for session %s"
+                  % (filename, session.id))
     return new_path
 
 
-def get_artifact_from_endpoint(session, path):
+def get_agent_host(session):
+    return "ws://%s:%s/runScript" % (session.endpoint_ip,
+                                     config.VMMASTER_AGENT_PORT)
+
+
+def get_artifact_from_endpoint(session, path, output=None, max_size=None):
     """
     :param session: Session
     :param path: str
+    :param output: file-like object for artifact content
+    :param max_size: int, bytes to read are limited on endpoint
     :return: status, headers, body
     """
-    host = "ws://%s:%s/runScript" % (session.endpoint_ip,
-                                     config.VMMASTER_AGENT_PORT)
-    script = '{"command": "sudo -S sh", "script": "cat %s"}' % path
-    for status, headers, body in run_script(script, host):
+    if max_size:
+        # one more byte to know that artifact was truncated
+        command = "head -c %d %s" % (max_size + 1, pipes.quote(path))
+    else:
+        command = "cat %s" % pipes.quote(path)
+    script = json.dumps({"command": "sudo -S sh", "script": command})
+    for status, headers, body in run_script(script, get_agent_host(session),
+                                            output):
         yield None, None, None
 
     yield status, headers, body
 
 
-def save_selenium_log(session_id, filename, original_path):
+def find_artifact_files(session, patterns):
     """
-    :param session_id: int
-    :param filename: str
-    :param original_path: str
+    :param session: Session
+    :param patterns: list of globs
+    :return: list of paths on endpoint
     """
-    session = get_session_from_db(session_id)
+    # paths are separated by NUL, the only character file name can't have
+    script = json.dumps({
+        "command": "sudo -S sh",
+        "script": "for f in %s; do [ -f \"$f\" ] && printf '%%s\\0' \"$f\"; "
+                  "done; true" % " ".join(quote_glob(p) for p in patterns)
+    })
+    status, body = None, None
+    for status, headers, body in run_script(script, get_agent_host(session)):
+        pass
+
+    try:
+        result = json.loads(body)
+    except (TypeError, ValueError):
+        result = {}
+    if status != 200 or result.get("status") != 0:
+        log.warning("Artifacts %s were not listed for session %s: %s" %
+                    (patterns, session.id, result.get("output", body)))
+        return []
+
+    return [path for path in result.get("output", "").split("\0") if path]
+
+
+def collect_artifacts(task):
+    """
+    Fetch all artifacts of task in parallel and
+    register saved ones on session with one update.
+    :param task: ArtifactTask
+    """
+    session = get_session_from_db(task.session_id)
 
     if not session:
-        log.error("Session %s not found and selenium log doesn't saved" % session_id)
+        log.error("Session %s not found and artifacts doesn't saved" %
+                  task.session_id)
         return
 
-    log_path = save_artifact(session, filename, original_path)
-    if log_path:
-        session.selenium_log = log_path
-        session.save()
-        log.info("Selenium log saved to %s for session %s" % (log_path, session_id))
-    else:
-        log.info("Selenium log doesn't saved for session %s" % session_id)
+    files, patterns = [], {}
+    for name, spec in task.artifacts.items():
+        path, max_size = parse_artifact(spec)
+        if is_glob(path):
+            patterns[name] = path, max_size
+        else:
+            files.append((name, path, max_size))
+
+    if patterns:
+        found = find_artifact_files(
+            session, [pattern for pattern, _ in patterns.values()])
+        for name, (pattern, max_size) in patterns.items():
+            for path in found:
+                if fnmatch(path, pattern):
+                    filename = os.path.splitext(os.path.basename(path))[0]
+                    files.append(
+                        ("%s/%s" % (name, filename), path, max_size))
+
+    if not files:
+        log.info("Artifacts not found for session %s" % session.id)
+        return
+
+    def fetch(args):
+        name, path, max_size = args
+        writer = task.writer(name, path, max_size)
+        return name, save_artifact(session, name, path, writer)
+
+    transfers = ThreadPool(
+        min(len(files), getattr(config, "ARTIFACT_PARALLEL_TRANSFERS", 4)))
+    try:
+        saved = dict(
+            (name, path) for name, path in transfers.map(fetch, files) if path
+        )
+    finally:
+        transfers.close()
+
+    if not saved:
+        log.info("Artifacts doesn't saved for session %s" % session.id)
+        return
+
+    if "selenium_server" in saved:
+        session.selenium_log = saved["selenium_server"]
+    session.artifacts = json.dumps(saved)
+    session.save()
+    log.info("Artifacts %s saved for session %s" % (saved.keys(), session.id))
 
 
 def on_completed_task(session_id):
@@ -159,81 +417,223 @@ def get_session_from_db(session_id):
     return session
 
 
-class ArtifactCollector(ThreadPool):
-    def __init__(self, vmpool):
-        if hasattr(config, "ARTIFACT_COLLECTOR_PROCESSES"):
-            super(ArtifactCollector, self).__init__(
-                processes=config.ARTIFACT_COLLECTOR_PROCESSES
-            )
-        else:
-            super(ArtifactCollector, self).__init__()
+class ArtifactTask(object):
+    def __init__(self, session_id, artifacts, priority=PRIORITY_DEFAULT,
+                 hypervisor=None):
+        self.session_id = session_id
+        self.artifacts = artifacts
+        self.priority = priority
+        self.hypervisor = hypervisor
+        self.created = time.time()
+        self.started = None
+        self.writers = {}
+        self.aborted = False
+        self.done = Event()
+
+    def __repr__(self):
+        return "<ArtifactTask %s:%s priority:%s hypervisor:%s>" % (
+            self.session_id, self.artifacts.keys(), self.priority,
+            self.hypervisor)
+
+    def sort_key(self):
+        return self.priority, self.created
+
+    def writer(self, name, original_path, max_size=None):
+        writer = ArtifactWriter(
+            get_artifact_path(self.session_id, name, original_path),
+            max_size=max_size
+        )
+        self.writers[name] = writer
+        if self.aborted:
+            writer.abort()
+        return writer
+
+    def ready(self):
+        return self.done.is_set()
+
+    def abort(self):
+        self.aborted = True
+        for writer in self.writers.values():
+            writer.abort()
+
+    def cancel(self):
+        self.abort()
+        self.done.set()
+
+    @property
+    def info(self):
+        return {
+            "priority": self.priority,
+            "hypervisor": self.hypervisor,
+            "running": self.started is not None,
+            "artifacts": {
+                name: writer.info for name, writer in self.writers.items()
+            }
+        }
+
+
+class ArtifactCollector(object):
+    """
+    Runs artifact tasks on a fixed number of worker threads,
+    failed sessions first, at most hypervisor_limit tasks per hypervisor.
+    Tasks of unknown hypervisor (local libvirt) are limited by workers only.
+    Endpoint is deleted when all tasks of session are done or timed out,
+    websockets of timed out task are closed.
+    """
+    def __init__(self, vmpool, processes=None, hypervisor_limit=None,
+                 timeout=None, maxsize=None):
+        self.processes = processes or getattr(
+            config, "ARTIFACT_COLLECTOR_PROCESSES", cpu_count())
+        self.hypervisor_limit = hypervisor_limit or getattr(
+            config, "ARTIFACT_COLLECTOR_HYPERVISOR_LIMIT", 2)
+        self.timeout = timeout or getattr(
+            config, "ARTIFACT_COLLECTOR_TIMEOUT", 300)
+        self.maxsize = maxsize or getattr(
+            config, "ARTIFACT_COLLECTOR_QUEUE_SIZE", 100)
         self.in_queue = {}
+        self.pending = []
+        self.running = defaultdict(int)
+        self.condition = Condition()
+        self.stopped = False
         self.vmpool = vmpool
-        log.info("ArtifactCollector started")
 
-    def __reduce__(self):
-        super(ArtifactCollector, self).__reduce__()
+        self.workers = []
+        for _ in range(self.processes):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        log.info("ArtifactCollector started")
 
     def get_queue(self):
-        return self.in_queue.keys()
-
-    def add_task(self, session_id, artifact_name, artifact_path):
+        with self.condition:
+            return self.in_queue.keys()
+
+    def get_progress(self):
+        with self.condition:
+            return {
+                session_id: [task.info for task in tasks]
+                for session_id, tasks in self.in_queue.items()
+            }
+
+    def add_task(self, session_id, artifact_name, artifact_path,
+                 priority=PRIORITY_DEFAULT, hypervisor=None):
         """
         :param session_id: int
         :param artifact_name: str
         :param artifact_path: str
+        :param priority: int, lower is earlier
+        :param hypervisor: str
         :return: True or False
         """
-        if artifact_name == "selenium_server":
-            self.run_task(
-                session_id,
-                self.save_selenium_log,
-                args=(session_id, artifact_name, artifact_path)
-            )
-            return True
-        else:
-            log.warning("Task not found for session %s" % session_id)
+        return self.add_tasks(session_id, {artifact_name: artifact_path},
+                              priority, hypervisor)
+
+    def add_tasks(self, session_id, artifacts, priority=PRIORITY_DEFAULT,
+                  hypervisor=None):
+        """
+        :param session_id: int
+        :param artifacts: dict of name: path or glob or
+        {"path": path, "max_size": bytes}
+        :param priority: int, lower is earlier
+        :param hypervisor: str
+        :return: True or False
+        """
+        if not artifacts:
+            log.warning("No artifacts to collect for session %s" % session_id)
             return False
 
-    def run_task(self, session_id, method, args):
-        apply_result = self.apply_async(method, args=args)
-        log.debug("Apply Result %s" % apply_result)
-        if session_id in self.in_queue:
-            self.in_queue[session_id].append(apply_result)
-        else:
-            self.in_queue[session_id] = [apply_result]
+        with self.condition:
+            if len(self.pending) >= self.maxsize:
+                log.warning("Artifacts queue is full (%s tasks), artifacts "
+                            "of session %s skipped" % (self.maxsize, session_id))
+                return False
+
+            task = ArtifactTask(session_id, artifacts, priority, hypervisor)
+            self.pending.append(task)
+            self.in_queue.setdefault(session_id, []).append(task)
+            self.condition.notify()
         log.info("Task for getting artifacts added to queue for session %s" % session_id)
         log.debug('ArtifactCollector Queue: %s' % str(self.in_queue))
+        return True
+
+    def next_task(self):
+        for task in sorted(self.pending, key=ArtifactTask.sort_key):
+            if task.hypervisor is None \
+                    or self.running[task.hypervisor] < self.hypervisor_limit:
+                self.pending.remove(task)
+                self.running[task.hypervisor] += 1
+                return task
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    task = self.next_task()
+                    if task is not None:
+                        break
+                    self.condition.wait()
+                else:
+                    return
 
-    def add_tasks(self, session_id, artifacts):
-        """
-        :param session_id: int
-        :param artifacts: dict
-        :return: list of True or False
-        """
-        result = True
-        for artifact_name, artifact_path in artifacts.items():
-            completed = self.add_task(session_id, artifact_name, artifact_path)
-            if not completed:
-                result = False
+            try:
+                self.run(task)
+            except:
+                log.exception("Getting artifacts failed for session %s" %
+                              task.session_id)
+            finally:
+                with self.condition:
+                    self.running[task.hypervisor] -= 1
+                    self.condition.notify_all()
+
+    def run(self, task):
+        task.started = time.time()
+        send_metrics("artifact_collector.queue_wait_time",
+                     (task.started - task.created) * 1000)
+
+        t = Thread(target=self.collect, args=(task,))
+        t.daemon = True
+        t.start()
+        t.join(self.timeout)
+        if t.is_alive():
+            log.warning("Getting artifacts for session %s timed out "
+                        "after %s sec" % (task.session_id, self.timeout))
+            task.abort()
+
+        self.complete(task)
+
+    def complete(self, task):
+        with self.condition:
+            tasks = self.in_queue.get(task.session_id)
+            if tasks is None or task not in tasks:
+                # task was deleted
+                return
+            tasks.remove(task)
+            task.done.set()
+            if tasks:
+                return
+            del self.in_queue[task.session_id]
 
-        return result
+        with self.vmpool.app.app_context():
+            on_completed_task(task.session_id)
+        send_metrics("artifact_collector.vm_hold_time",
+                     (time.time() - task.created) * 1000)
 
     def del_task(self, session_id):
         """
         :param session_id: int
         """
-        tasks = self.in_queue.get(session_id, list())
-        for task in tasks:
-            if task and not task.ready():
-                task.successful()
-                log.info("Getting artifacts for session %s aborted" % session_id)
-        try:
-            del self.in_queue[session_id]
-        except KeyError:
-            log.exception("Tasks already deleted from queue for session %s" % session_id)
-        log.info("Getting artifacts abort has been failed for "
-                 "session %s because it's already done" % session_id)
+        with self.condition:
+            tasks = self.in_queue.pop(session_id, None)
+            for task in tasks or []:
+                if task in self.pending:
+                    self.pending.remove(task)
+                task.cancel()
+
+        if tasks is None:
+            log.warning("Tasks already deleted from queue for session %s" % session_id)
+        else:
+            log.info("Getting artifacts for session %s aborted" % session_id)
 
     def del_tasks(self, sessions_ids):
         """
@@ -242,20 +642,19 @@ class ArtifactCollector(ThreadPool):
         for session_id in sessions_ids:
             self.del_task(session_id)
 
-    def save_selenium_log(self, session_id, artifact_name, artifact_path):
+    def collect(self, task):
         """
-        :param session_id: int
-        :param artifact_name: str
-        :param artifact_path: str
+        :param task: ArtifactTask
         """
         with self.vmpool.app.app_context():
-            try:
-                save_selenium_log(session_id, artifact_name, artifact_path)
-            finally:
-                self.in_queue.pop(session_id)
-                on_completed_task(session_id)
+            collect_artifacts(task)
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
 
     def stop(self):
-        self.del_tasks(self.in_queue.keys())
+        self.del_tasks(self.get_queue())
         self.close()
         log.info("ArtifactCollector stopped")
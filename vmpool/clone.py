@@ -1,21 +1,29 @@
 # coding: utf-8
 import os
+import json
 import time
 import logging
 
+from Queue import Empty
 from functools import wraps
-from functools import partial
+from datetime import datetime
 from xml.dom import minidom
 from uuid import uuid4
 from threading import Thread
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
 
 from vmpool import VirtualMachine
+from vmpool.artifact_collector import run_script, get_artifacts, \
+    PRIORITY_FAILED, PRIORITY_DEFAULT
 
 from core import dumpxml
 from core import utils
 from core.exceptions import libvirtError, CreationException
 from core.config import config
+from core.http_pool import EndpointHTTPPool
 from core.utils import network_utils
+from core.utils.graphite import send_metrics
 
 log = logging.getLogger(__name__)
 
@@ -33,6 +41,43 @@ def threaded_wait(func):
     return wrapper
 
 
+SNAPSHOT_XML = "<domainsnapshot><name>%s</name></domainsnapshot>"
+RESET_SCRIPT = "pkill -9 -f 'chrome|firefox|iexplore|opera|driver' ; true"
+
+
+# capabilities used by vmmaster itself, they don't change browser
+VMMASTER_CAPABILITIES = ("platform", "name", "user", "token",
+                         "takeScreenshot", "takeScreencast", "runScript")
+
+
+def browser_capabilities(desired_caps):
+    return dict((key, value) for key, value in desired_caps.items()
+                if key not in VMMASTER_CAPABILITIES)
+
+
+class HotSession(object):
+    """
+    Selenium session started on pooled vm before it was requested.
+    """
+    def __init__(self, selenium_session, profile, body):
+        self.id = selenium_session
+        self.profile = profile
+        self.body = body
+        self.created = time.time()
+
+    def __repr__(self):
+        return "<HotSession id:%s profile:%s>" % (self.id, self.profile)
+
+    def matches(self, desired_caps):
+        if desired_caps.get("runScript"):
+            return False
+        return browser_capabilities(desired_caps) == \
+            browser_capabilities(self.profile)
+
+    def expired(self, ttl):
+        return time.time() - self.created > ttl
+
+
 class Clone(VirtualMachine):
     def __init__(self, origin, prefix, pool):
         self.uuid = str(uuid4())[:8]
@@ -43,6 +88,11 @@ class Clone(VirtualMachine):
             platform=origin.name, prefix=self.prefix, uuid=self.uuid)
 
         super(Clone, self).__init__(name=name, platform=origin.name)
+        self.sessions_count = 0
+        self.hot_session = None
+        self.http_pool = None
+        # None for local libvirt
+        self.hypervisor = None
 
     def __str__(self):
         return "{name}({ip})".format(name=self.name, ip=self.ip)
@@ -56,26 +106,161 @@ class Clone(VirtualMachine):
     def rebuild(self):
         raise NotImplementedError
 
-    def save_artifacts(self, session, artifacts):
-        return self.pool.save_artifact(session.id, artifacts)
+    def save_artifacts(self, session, artifacts=None):
+        if artifacts is None:
+            artifacts = get_artifacts(self.platform)
+        if session.status == "failed":
+            priority = PRIORITY_FAILED
+        else:
+            priority = PRIORITY_DEFAULT
+        return self.pool.save_artifact(
+            session.id, artifacts, priority, self.hypervisor
+        )
+
+    def recycle(self):
+        """
+        Return used preloaded vm to pool instead of rebuild,
+        if VM_RECYCLE is on and vm is younger than VM_RECYCLE_MAX_AGE
+        seconds and served less than VM_RECYCLE_MAX_SESSIONS sessions.
+        :return: True if vm was returned to pool
+        """
+        if not getattr(config, "VM_RECYCLE", False) \
+                or not self.is_preloaded() or self not in self.pool.using:
+            return False
+
+        self.sessions_count += 1
+        age = (datetime.now() - self.created).total_seconds()
+        if self.sessions_count >= getattr(
+                config, "VM_RECYCLE_MAX_SESSIONS", 10) \
+                or age >= getattr(config, "VM_RECYCLE_MAX_AGE", 3600):
+            log.info("VM %s served %s sessions for %ss, rebuilding" %
+                     (self.name, self.sessions_count, int(age)))
+            return False
+
+        if not self.reset():
+            log.warning("Reset of vm %s was failed, rebuilding" % self.name)
+            return False
+
+        log.info("Recycled vm %s after %s sessions" %
+                 (self.name, self.sessions_count))
+        self.pool.return_vm(self)
+        return True
+
+    @property
+    def selenium_url(self):
+        return "http://%s:%s/wd/hub/session" % (self.ip, config.SELENIUM_PORT)
+
+    def get_http_pool(self):
+        if not self.http_pool:
+            self.http_pool = EndpointHTTPPool(self.ip)
+        return self.http_pool
+
+    def close_http_pool(self):
+        http_pool, self.http_pool = self.http_pool, None
+        if http_pool:
+            http_pool.close()
+
+    def selenium_request(self, method, url, data=None):
+        """
+        Request to selenium of vm through kept-alive connections
+        served by the reactor.
+        :return: status, headers, body
+        """
+        timeout = getattr(config, "HOT_SESSION_START_TIMEOUT", 60)
+        result = self.get_http_pool().request_from_thread(
+            method=method, url=url, data=data, timeout=timeout
+        )
+        try:
+            # request is cancelled by the reactor after timeout
+            response = result.get(timeout=timeout + 1)
+        except Empty:
+            raise TimeoutError("No response for %s in %s sec" %
+                               (url, timeout))
+        if isinstance(response, Failure):
+            response = response.value
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def start_hot_session(self, profile):
+        desired_caps = dict(profile, platform=u"ANY")
+        status, headers, body = self.selenium_request(
+            "POST", self.selenium_url,
+            data=json.dumps({"desiredCapabilities": desired_caps})
+        )
+        if status != 200:
+            raise CreationException(
+                "Failed to start hot session on %s: %s" % (self.name, body))
+
+        selenium_session = json.loads(body)["sessionId"]
+        self.hot_session = HotSession(selenium_session, profile, body)
+        log.info("Hot session %s started on %s" %
+                 (selenium_session, self.name))
+
+    def delete_hot_session(self):
+        hot_session, self.hot_session = self.hot_session, None
+        if hot_session is None:
+            return
+        try:
+            self.selenium_request(
+                "DELETE", "%s/%s" % (self.selenium_url, hot_session.id))
+        except Exception as e:
+            log.warning("Hot session %s was not deleted on %s: %s" %
+                        (hot_session.id, self.name, e))
+        else:
+            log.info("Hot session %s deleted on %s" %
+                     (hot_session.id, self.name))
+
+    def take_hot_session(self, desired_caps):
+        """
+        :return: hot session if it matches desired_caps,
+                 otherwise it's deleted to free the browser
+        """
+        hot_session = self.hot_session
+        if hot_session is not None and hot_session.matches(desired_caps):
+            self.hot_session = None
+            return hot_session
+        self.delete_hot_session()
+
+    def reset(self):
+        """
+        Kill browsers through vmmaster-agent and check vm is alive.
+        """
+        self.hot_session = None
+        host = "ws://%s:%s/runScript" % (self.ip, config.VMMASTER_AGENT_PORT)
+        script = json.dumps({
+            "command": "sudo -S sh",
+            "script": getattr(config, "VM_RECYCLE_RESET_SCRIPT",
+                              RESET_SCRIPT)
+        })
+
+        status, body = None, None
+        for status, headers, body in run_script(script, host):
+            pass
+
+        try:
+            result = json.loads(body)
+        except (TypeError, ValueError):
+            result = {}
+        if status != 200 or result.get("status") != 0:
+            log.warning("Reset script failed on vm %s: %s" %
+                        (self.name, result.get("output", body)))
+            return False
+
+        return self.ping_vm()
 
     def ping_vm(self):
         ports = [config.SELENIUM_PORT, config.VMMASTER_AGENT_PORT]
-        result = [False, False]
         timeout = config.PING_TIMEOUT
-        start = time.time()
 
         log.info("Starting ping vm {clone}: {ip}:{port}".format(
             clone=self.name, ip=self.ip, port=ports))
-        _ping = partial(network_utils.ping, self.ip)
-        while time.time() - start < timeout:
-            result = map(_ping, ports)
-            if all(result):
-                log.info(
-                    "Successful ping for {clone} with {ip}:{ports}".format(
-                        clone=self.name, ip=self.ip, ports=ports))
-                break
-            time.sleep(0.1)
+        result = network_utils.wait_ports(self.ip, ports, timeout)
+        self.health.update(all(result))
+        if all(result):
+            log.info(
+                "Successful ping for {clone} with {ip}:{ports}".format(
+                    clone=self.name, ip=self.ip, ports=ports))
 
         if not all(result):
             fails = [port for port, res in zip(ports, result) if res is False]
@@ -90,6 +275,7 @@ class Clone(VirtualMachine):
 class KVMClone(Clone):
     dumpxml_file = None
     drive_path = None
+    snapshot = None
 
     def __init__(self, origin, prefix, pool):
         super(KVMClone, self).__init__(origin, prefix, pool)
@@ -99,7 +285,8 @@ class KVMClone(Clone):
 
     def delete(self, try_to_rebuild=True):
         if try_to_rebuild and self.is_preloaded():
-            self.rebuild()
+            if not self.recycle():
+                self.rebuild()
             return
 
         log.info("Deleting kvm clone: {}".format(self.name))
@@ -108,47 +295,134 @@ class KVMClone(Clone):
         utils.delete_file(self.dumpxml_file)
         try:
             domain = self.conn.lookupByName(self.name)
-            if domain.isActive():
-                domain.destroy()
-            domain.undefine()
         except libvirtError:
-            # not running
-            pass
+            # not defined
+            domain = None
+        if domain is not None:
+            self.delete_snapshot(domain)
+            try:
+                if domain.isActive():
+                    domain.destroy()
+                domain.undefine()
+            except libvirtError:
+                # not running
+                pass
         try:
             self.network.append_free_mac(self.mac)
         except ValueError, e:
             log.warning(e)
             pass
         self.pool.remove_vm(self)
+        self.close_http_pool()
         VirtualMachine.delete(self)
 
     def create(self):
         log.info("Creating kvm clone of {platform}".format(
             platform=self.platform)
         )
+        start = time.time()
         self.dumpxml_file = self.clone_origin(self.platform)
         self.define_clone(self.dumpxml_file)
         self.start_virtual_machine(self.name)
         self.ip = self.network.get_ip(self.mac)
-        self.ready = True
+        if getattr(config, "KVM_SNAPSHOT_RESET", False) \
+                and self.is_preloaded():
+            self.take_snapshot(start)
+        else:
+            self.ready = True
         log.info("Created kvm {clone} on ip: {ip} with mac: {mac}".format(
             clone=self.name, ip=self.ip, mac=self.mac)
         )
         return self
 
+    @threaded_wait
+    def take_snapshot(self, start):
+        """
+        Save disk and memory state of booted clone,
+        rebuild reverts clone to it instead of cloning it again.
+        """
+        if self.ping_vm():
+            try:
+                domain = self.conn.lookupByName(self.name)
+                domain.snapshotCreateXML(SNAPSHOT_XML % self.name)
+                self.snapshot = self.name
+            except libvirtError as e:
+                log.warning("Snapshot of %s was failed: %s" % (self.name, e))
+        else:
+            log.warning("Clone %s is not alive, snapshot was not taken"
+                        % self.name)
+
+        self.ready = True
+        self.send_ready_time("boot", start)
+        self.pool.notify(self.platform)
+
+    def delete_snapshot(self, domain):
+        # failed snapshot deletion mustn't leave domain on hypervisor
+        if not self.snapshot:
+            return
+        try:
+            domain.snapshotLookupByName(self.snapshot).delete()
+        except libvirtError as e:
+            log.warning("Snapshot of %s wasn't deleted: %s" % (self.name, e))
+
+    def revert(self):
+        start = time.time()
+        self.ready = False
+        try:
+            domain = self.conn.lookupByName(self.name)
+            domain.revertToSnapshot(
+                domain.snapshotLookupByName(self.snapshot))
+        except libvirtError as e:
+            log.warning("Revert of %s was failed: %s" % (self.name, e))
+            return False
+
+        if not self.ping_vm():
+            return False
+
+        self.ready = True
+        self.sessions_count = 0
+        self.hot_session = None
+        # age of reverted clone is counted from its fresh state
+        self.created = datetime.now()
+        self.send_ready_time("revert", start)
+        if self in self.pool.using:
+            self.pool.return_vm(self)
+        else:
+            if self not in self.pool.pool:
+                self.pool.add_vm(self)
+            self.pool.notify(self.platform)
+        return True
+
+    def send_ready_time(self, method, start):
+        ready_time = time.time() - start
+        log.info("Clone %s is ready after %s in %.2fs" %
+                 (self.name, method, ready_time))
+        send_metrics("clone_ready_time.%s.%s" % (
+            self.platform.replace(".", "_"), method), ready_time * 1000)
+
     def rebuild(self):
         log.info(
             "Rebuilding kvm clone {clone} ({ip}, {platform})...".format(
                 clone=self.name, ip=self.ip, platform=self.platform)
         )
+        if self.snapshot and self.revert():
+            return
+
         self.pool.remove_vm(self)
         self.delete(try_to_rebuild=False)
 
+        # new clone is counted as loading, so preloader doesn't load another
+        preloader = self.pool.preloader
+        if preloader is not None:
+            preloader.started(self.platform)
         try:
             self.pool.add(
                 self.platform, self.prefix, self.pool.pool)
         except CreationException:
             pass
+        finally:
+            if preloader is not None:
+                preloader.finished(self.platform)
 
     def clone_origin(self, origin_name):
         self.drive_path = utils.clone_qcow2_drive(origin_name, self.name)
@@ -261,6 +535,8 @@ class OpenstackClone(Clone):
                 server = self.get_vm(self.name)
                 if not server:
                     return
+                self.hypervisor = getattr(
+                    server, "OS-EXT-SRV-ATTR:hypervisor_hostname", None)
                 addresses = server.addresses.get(self.network_name, None)
                 if addresses is not None:
                     ip = addresses[0].get('addr', None)
@@ -310,6 +586,7 @@ class OpenstackClone(Clone):
                     method()
                 if self.ping_vm():
                     self.ready = True
+                    self.pool.notify(self.platform)
                     break
                 if ping_retry > config.OPENSTACK_PING_RETRY_COUNT:
                     p = config.OPENSTACK_PING_RETRY_COUNT * config.PING_TIMEOUT
@@ -366,7 +643,8 @@ class OpenstackClone(Clone):
 
     def delete(self, try_to_rebuild=True):
         if try_to_rebuild and self.is_preloaded():
-            self.rebuild()
+            if not self.recycle():
+                self.rebuild()
             return
 
         self.ready = False
@@ -379,6 +657,7 @@ class OpenstackClone(Clone):
                 log.exception("Delete vm %s was FAILED." % self.name)
 
         log.info("Deleted openstack clone: {0}".format(self.name))
+        self.close_http_pool()
         VirtualMachine.delete(self)
 
     def rebuild(self):
@@ -389,6 +668,10 @@ class OpenstackClone(Clone):
             self.pool.pool.append(self)
 
         self.ready = False
+        self.sessions_count = 0
+        self.hot_session = None
+        self.close_http_pool()
+        self.created = datetime.now()
         server = self.get_vm(self.name)
         if server:
             try:
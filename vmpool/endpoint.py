@@ -1,4 +1,5 @@
 # coding: utf-8
+import time
 import logging
 from core.utils import generator_wait_for
 from core.config import config
@@ -35,16 +36,44 @@ def get_platform(desired_caps):
     return platform
 
 
-def get_vm(desired_caps):
+def wait_for_turn(platform, session_id=None, desired_caps=None):
+    """
+    Wait in platform queue until vm is taken.
+    Only the first waiter tries to take vm, it's woken up
+    when vm of platform is ready or any vm is deleted.
+    Waiting is yielded every GET_VM_CHECK_INTERVAL, so that caller
+    can give up its turn when client is gone or session is closed.
+    """
+    pool = current_app.pool
+    waiter = pool.enqueue(platform, session_id)
+    interval = getattr(config, "GET_VM_CHECK_INTERVAL", 1)
+    deadline = time.time() + config.GET_VM_TIMEOUT
+
+    try:
+        while not waiter.cancelled:
+            if pool.is_first(waiter):
+                vm = pool.get_vm(platform, desired_caps)
+                if vm:
+                    yield vm
+                    return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            waiter.wait(min(interval, remaining))
+            yield None
+    finally:
+        pool.dequeue(waiter)
+
+
+def get_vm(desired_caps, session_id=None):
     platform = get_platform(desired_caps)
 
     vm = None
-    for _ in generator_wait_for(
-        lambda: vm, timeout=config.GET_VM_TIMEOUT
-    ):
-        vm = current_app.pool.get_vm(platform)
+    for vm in wait_for_turn(platform, session_id, desired_caps):
         if vm:
             break
+        yield None
 
     if not vm:
         raise CreationException(
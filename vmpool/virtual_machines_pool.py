@@ -1,22 +1,211 @@
 # coding: utf-8
 
 import time
+import math
 import logging
-from threading import Thread, Lock
-from collections import defaultdict
+from threading import Thread, Lock, Event
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, OrderedDict, deque
 
 from core.config import config
 from core.network import Network
+from core.utils import network_utils
 
+from vmpool import HealthState
 from vmpool.platforms import Platforms, UnlimitedCount
-from vmpool.artifact_collector import ArtifactCollector
+from vmpool.artifact_collector import ArtifactCollector, PRIORITY_DEFAULT
 
 log = logging.getLogger(__name__)
 
 
+class VirtualMachinesList(object):
+    """
+    List of virtual machines indexed by name and by platform.
+    Every platform has its own lock, so operations on different
+    platforms don't wait for each other.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.names = dict()
+        self.platforms = dict()
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __getitem__(self, index):
+        return self.snapshot()[index]
+
+    def __contains__(self, vm):
+        return self.names.get(vm.name) is vm
+
+    def __add__(self, other):
+        return self.snapshot() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.snapshot()
+
+    def bucket(self, platform):
+        bucket = self.platforms.get(platform)
+        if bucket is None:
+            with self.lock:
+                bucket = self.platforms.setdefault(
+                    platform, (Lock(), OrderedDict()))
+        return bucket
+
+    def snapshot(self):
+        vms = []
+        for platform in list(self.platforms):
+            lock, vms_by_name = self.bucket(platform)
+            with lock:
+                vms.extend(vms_by_name.values())
+        return vms
+
+    def append(self, vm):
+        lock, vms_by_name = self.bucket(vm.platform)
+        with lock:
+            vms_by_name[vm.name] = vm
+            self.names[vm.name] = vm
+
+    def remove(self, vm):
+        lock, vms_by_name = self.bucket(vm.platform)
+        with lock:
+            if vms_by_name.get(vm.name) is not vm:
+                raise ValueError("%s not in list" % vm.name)
+            del vms_by_name[vm.name]
+            del self.names[vm.name]
+
+    def discard(self, vm):
+        try:
+            self.remove(vm)
+            return True
+        except ValueError:
+            return False
+
+    def get(self, name):
+        return self.names.get(name)
+
+    def counts(self):
+        return dict(
+            (platform, len(vms_by_name))
+            for platform, (_, vms_by_name) in self.platforms.items()
+            if vms_by_name
+        )
+
+    def has_ready(self, platform):
+        lock, vms_by_name = self.bucket(platform)
+        with lock:
+            return any(vm.ready and not vm.checking
+                       for vm in vms_by_name.itervalues())
+
+    def move_ready(self, platform, to, prefer=None):
+        """
+        Move the newest ready vm of platform to another list.
+        Search stops at the first ready vm, or with prefer given,
+        at the first ready vm for which it's true.
+        """
+        lock, vms_by_name = self.bucket(platform)
+        with lock:
+            vm = None
+            for name in reversed(vms_by_name):
+                candidate = vms_by_name[name]
+                if not candidate.ready or candidate.checking:
+                    continue
+                if vm is None:
+                    vm = candidate
+                if prefer is None or prefer(candidate):
+                    vm = candidate
+                    break
+            if vm is None:
+                return None
+            # appending first keeps vm counted while it moves
+            to.append(vm)
+            del vms_by_name[vm.name]
+            del self.names[vm.name]
+            return vm
+
+    def check_out(self, vm):
+        """
+        Mark ready vm as checking, so it can't be moved until
+        checking is over.
+        """
+        lock, vms_by_name = self.bucket(vm.platform)
+        with lock:
+            if vms_by_name.get(vm.name) is vm \
+                    and vm.ready and not vm.checking:
+                vm.checking = True
+                return True
+        return False
+
+
+class VirtualMachineWaiter(object):
+    """
+    Request waiting for a vm of platform.
+    """
+    cancelled = False
+
+    def __init__(self, platform, session_id=None):
+        self.platform = platform
+        self.session_id = session_id
+        self.event = Event()
+
+    def __repr__(self):
+        return "<VirtualMachineWaiter platform:%s session:%s>" % (
+            self.platform, self.session_id)
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        self.event.clear()
+
+    def wake(self):
+        self.event.set()
+
+
+class PlatformArrivals(object):
+    """
+    Requests for virtual machines per platform for the last window seconds.
+    """
+    def __init__(self, window=None):
+        self.window = window or getattr(config, "PRELOADER_RATE_WINDOW", 60)
+        self.arrivals = defaultdict(deque)
+        self.lock = Lock()
+
+    def _expire(self, now):
+        for platform, arrivals in self.arrivals.items():
+            while arrivals and arrivals[0] <= now - self.window:
+                arrivals.popleft()
+            if not arrivals:
+                del self.arrivals[platform]
+
+    def add(self, platform, now=None):
+        with self.lock:
+            self.arrivals[platform].append(now or time.time())
+
+    def rates(self, now=None):
+        """
+        :return: requests per second for every platform
+        """
+        with self.lock:
+            self._expire(now or time.time())
+            return dict(
+                (platform, len(arrivals) / float(self.window))
+                for platform, arrivals in self.arrivals.items()
+            )
+
+
 class VirtualMachinesPool(object):
-    pool = list()
-    using = list()
+    pool = VirtualMachinesList()
+    using = VirtualMachinesList()
+    waiters = defaultdict(deque)
+    waiters_by_session = {}
+    positions = None
+    waiters_lock = Lock()
+    arrivals = PlatformArrivals()
     network = Network()
     lock = Lock()
     platforms = Platforms
@@ -47,16 +236,78 @@ class VirtualMachinesPool(object):
 
     @classmethod
     def remove_vm(cls, vm):
-        if vm in list(cls.using):
-            try:
-                cls.using.remove(vm)
-            except ValueError:
-                log.warning("VM %s not found in using" % vm.name)
-        if vm in list(cls.pool):
+        if cls.using.discard(vm) or cls.pool.discard(vm):
+            # any platform may be waiting for free resources
+            cls.notify()
+
+    @classmethod
+    def enqueue(cls, platform, session_id=None):
+        cls.arrivals.add(platform)
+        waiter = VirtualMachineWaiter(platform, session_id)
+        with cls.waiters_lock:
+            cls.waiters[platform].append(waiter)
+            if session_id is not None:
+                cls.waiters_by_session[session_id] = waiter
+            cls.positions = None
+        return waiter
+
+    @classmethod
+    def dequeue(cls, waiter):
+        with cls.waiters_lock:
             try:
-                cls.pool.remove(vm)
+                cls.waiters[waiter.platform].remove(waiter)
             except ValueError:
-                log.warning("VM %s not found in pool" % vm.name)
+                pass
+            if cls.waiters_by_session.get(waiter.session_id) is waiter:
+                del cls.waiters_by_session[waiter.session_id]
+            cls.positions = None
+        cls.notify(waiter.platform)
+
+    @classmethod
+    def cancel(cls, session_id):
+        """
+        Remove waiter of closed session from queue, so that it never takes vm.
+        """
+        with cls.waiters_lock:
+            waiter = cls.waiters_by_session.get(session_id)
+        if waiter is not None:
+            waiter.cancelled = True
+            cls.dequeue(waiter)
+            waiter.wake()
+
+    @classmethod
+    def is_first(cls, waiter):
+        with cls.waiters_lock:
+            queue = cls.waiters[waiter.platform]
+            return bool(queue) and queue[0] is waiter
+
+    @classmethod
+    def notify(cls, platform=None):
+        """
+        Wake the first waiter of platform (or of every platform)
+        to take a vm.
+        """
+        with cls.waiters_lock:
+            if platform is None:
+                queues = cls.waiters.values()
+            else:
+                queues = [cls.waiters[platform]]
+            for queue in queues:
+                if queue:
+                    queue[0].wake()
+
+    @classmethod
+    def queue_position(cls, session_id):
+        with cls.waiters_lock:
+            # rebuilt once after queues are changed, not for every session
+            if cls.positions is None:
+                cls.positions = dict(
+                    (waiter.session_id, position)
+                    for queue in cls.waiters.values()
+                    for position, waiter in enumerate(queue, 1)
+                    if waiter.session_id is not None
+                )
+            return cls.positions.get(session_id)
 
     @classmethod
     def add_vm(cls, vm, to=None):
@@ -98,37 +349,31 @@ class VirtualMachinesPool(object):
 
     @classmethod
     def has(cls, platform):
-        for vm in cls.pool:
-            if vm.platform == platform and vm.ready and not vm.checking:
-                return True
-        return False
+        return cls.pool.has_ready(platform)
 
     @classmethod
-    def get_by_platform(cls, platform):
-        res = None
-
-        with cls.lock:
-            if not cls.has(platform):
-                return None
-
-            for vm in sorted(cls.pool, key=lambda v: v.created, reverse=True):
-                if vm.platform == platform and vm.ready and not vm.checking:
-                    log.info(
-                        "Got VM %s (ip=%s, ready=%s, checking=%s)" %
-                        (vm.name, vm.ip, vm.ready, vm.checking)
-                    )
-                    cls.pool.remove(vm)
-                    cls.using.append(vm)
-                    res = vm
-                    break
+    def get_by_platform(cls, platform, desired_caps=None):
+        prefer = None
+        # without hot sessions there is nothing to prefer
+        if desired_caps is not None \
+                and getattr(config, "HOT_SESSION_PROFILES", None):
+            def prefer(vm):
+                hot_session = getattr(vm, "hot_session", None)
+                return hot_session is not None \
+                    and hot_session.matches(desired_caps)
+
+        res = cls.pool.move_ready(platform, to=cls.using, prefer=prefer)
 
         if not res:
             return None
 
-        if res.ping_vm():
+        log.info("Got VM %s (ip=%s, ready=%s, checking=%s)" %
+                 (res.name, res.ip, res.ready, res.checking))
+
+        if res.health.lookup() or res.ping_vm():
             return res
         else:
-            cls.using.remove(res)
+            cls.using.discard(res)
             res.delete()
             return None
 
@@ -137,9 +382,7 @@ class VirtualMachinesPool(object):
         # TODO: remove get_by_name
         if _name:
             log.debug('Getting VM: %s' % _name)
-            for vm in cls.pool + cls.using:
-                if vm.name == _name:
-                    return vm
+            return cls.pool.get(_name) or cls.using.get(_name)
 
     @classmethod
     def count_virtual_machines(cls, it):
@@ -151,11 +394,11 @@ class VirtualMachinesPool(object):
 
     @classmethod
     def pooled_virtual_machines(cls):
-        return cls.count_virtual_machines(cls.pool)
+        return cls.pool.counts()
 
     @classmethod
     def using_virtual_machines(cls):
-        return cls.count_virtual_machines(cls.using)
+        return cls.using.counts()
 
     @classmethod
     def add(cls, platform, prefix="ondemand", to=None):
@@ -178,12 +421,14 @@ class VirtualMachinesPool(object):
                 )
                 return None
 
+            clone.creating = True
             cls.add_vm(clone, to)
 
         try:
             clone.create()
         except Exception as e:
             log.exception("Error creating vm: %s" % e.message)
+            clone.creating = False
             clone.delete()
             try:
                 to.remove(clone)
@@ -191,11 +436,15 @@ class VirtualMachinesPool(object):
                 log.warning("VM %s not found while removing" % clone.name)
             return None
 
+        clone.creating = False
+        if to is cls.pool and clone.ready:
+            cls.notify(platform)
+
         return clone
 
     @classmethod
-    def get_vm(cls, platform):
-        vm = cls.get_by_platform(platform)
+    def get_vm(cls, platform, desired_caps=None):
+        vm = cls.get_by_platform(platform, desired_caps)
 
         if vm:
             return vm
@@ -206,8 +455,13 @@ class VirtualMachinesPool(object):
             return vm
 
     @classmethod
-    def save_artifact(cls, session_id, artifacts):
-        return cls.artifact_collector.add_tasks(session_id, artifacts)
+    def save_artifact(cls, session_id, artifacts, priority=None,
+                      hypervisor=None):
+        if priority is None:
+            priority = PRIORITY_DEFAULT
+        return cls.artifact_collector.add_tasks(
+            session_id, artifacts, priority, hypervisor
+        )
 
     @classmethod
     def preload(cls, origin_name, prefix=None):
@@ -215,8 +469,9 @@ class VirtualMachinesPool(object):
 
     @classmethod
     def return_vm(cls, vm):
-        cls.using.remove(vm)
         cls.pool.append(vm)
+        cls.using.remove(vm)
+        cls.notify(vm.platform)
 
     @property
     def info(self):
@@ -235,34 +490,146 @@ class VirtualMachinesPool(object):
                 'list': print_view(self.using),
             },
             "already_use": self.count(),
+            "health_cache": HealthState.stats(),
         }
 
 
 class VirtualMachinesPoolPreloader(Thread):
-    def __init__(self, pool):
+    """
+    Keeps preloaded virtual machines for every platform.
+    Up to PRELOADER_PARALLELISM machines are created at once.
+    Hot sessions and health checks of pooled machines run in separate
+    PRELOADER_MAINTENANCE_THREADS, so they don't hold up creation.
+    Platform targets are static KVM_PRELOADED/OPENSTACK_PRELOADED numbers
+    raised by recent requests rate for PRELOADER_FORECAST_TIME seconds.
+    """
+    def __init__(self, pool, parallelism=None):
         Thread.__init__(self)
         self.running = True
         self.daemon = True
         self.pool = pool
+        self.parallelism = parallelism or getattr(
+            config, "PRELOADER_PARALLELISM", 4)
+        self.forecast_time = getattr(config, "PRELOADER_FORECAST_TIME", 0)
+        self.threads = ThreadPool(processes=self.parallelism)
+        self.maintenance = ThreadPool(processes=getattr(
+            config, "PRELOADER_MAINTENANCE_THREADS", self.parallelism))
+        self.loading = defaultdict(int)
+        self.refreshing = set()
+        self.lock = Lock()
+        self.wakeup = Event()
 
     def run(self):
         while self.running:
             try:
-                platform = self.need_load()
-                if platform is not None:
-                    self.pool.preload(platform, "preloaded")
+                for platform in self.need_load():
+                    self.load(platform)
+                self.warm_up()
+                self.refresh_health()
             except Exception as e:
                 log.exception('Exception in preloader: %s', e.message)
 
-            time.sleep(config.PRELOADER_FREQUENCY)
+            self.wakeup.wait(config.PRELOADER_FREQUENCY)
+            self.wakeup.clear()
 
-    def need_load(self):
-        if self.pool.using is not []:
-            using = [vm for vm in self.pool.using
-                     if vm.is_preloaded()]
-        else:
-            using = []
-        already_have = self.pool.count_virtual_machines(self.pool.pool + using)
+    def started(self, platform):
+        """
+        Count vm of platform being created for pool,
+        by preloader or by rebuild of pooled vm.
+        """
+        with self.lock:
+            self.loading[platform] += 1
+
+    def finished(self, platform):
+        with self.lock:
+            self.loading[platform] -= 1
+
+    def load(self, platform):
+        self.started(platform)
+        self.threads.apply_async(self.preload, args=(platform,))
+
+    def preload(self, platform):
+        vm = None
+        try:
+            vm = self.pool.preload(platform, "preloaded")
+        except Exception as e:
+            log.exception('Exception while preloading %s: %s' %
+                          (platform, e.message))
+        finally:
+            self.finished(platform)
+            # check shortage again only if there are free resources
+            if vm:
+                self.wakeup.set()
+
+    def warm_up(self):
+        """
+        Start selenium sessions of HOT_SESSION_PROFILES on idle pooled
+        vms, hot sessions older than HOT_SESSION_TTL seconds are restarted.
+        """
+        profiles = getattr(config, "HOT_SESSION_PROFILES", [])
+        if not profiles:
+            return
+        ttl = getattr(config, "HOT_SESSION_TTL", 300)
+
+        hot = defaultdict(int)
+        idle = []
+        for vm in self.pool.pool:
+            hot_session = getattr(vm, "hot_session", None)
+            if hot_session is not None and not hot_session.expired(ttl):
+                hot[(vm.platform, repr(hot_session.profile))] += 1
+            elif hasattr(vm, "start_hot_session"):
+                idle.append(vm)
+
+        for vm in idle:
+            candidates = [
+                profile for profile in profiles
+                if profile.get("platform") in (None, vm.platform)
+            ]
+            if not candidates or not self.pool.pool.check_out(vm):
+                continue
+            profile = min(candidates, key=lambda p: hot[(vm.platform, repr(p))])
+            hot[(vm.platform, repr(profile))] += 1
+            self.maintenance.apply_async(self.warm, args=(vm, profile))
+
+    def warm(self, vm, profile):
+        try:
+            vm.delete_hot_session()
+            vm.start_hot_session(profile)
+        except Exception as e:
+            log.warning('Hot session was not started on %s: %s' %
+                        (vm.name, e))
+        finally:
+            vm.checking = False
+            self.pool.notify(vm.platform)
+
+    def refresh_health(self):
+        """
+        Ping idle pooled vms in background,
+        so they are fresh in health cache when requested.
+        """
+        max_age = max(getattr(config, "HEALTH_CACHE_TTL", 5) -
+                      config.PRELOADER_FREQUENCY, 0)
+        for vm in self.pool.pool:
+            if not vm.ready or vm.checking or not hasattr(vm, "ping_vm") \
+                    or vm.health.is_fresh(max_age):
+                continue
+            with self.lock:
+                if vm.name in self.refreshing:
+                    continue
+                self.refreshing.add(vm.name)
+            self.maintenance.apply_async(self.refresh, args=(vm,))
+
+    def refresh(self, vm):
+        ports = [config.SELENIUM_PORT, config.VMMASTER_AGENT_PORT]
+        try:
+            vm.health.update(all(network_utils.wait_ports(vm.ip, ports, 0)))
+        except Exception as e:
+            log.warning('Health of %s was not refreshed: %s' % (vm.name, e))
+        finally:
+            with self.lock:
+                self.refreshing.discard(vm.name)
+
+    def targets(self):
         platforms = {}
 
         if config.USE_KVM:
@@ -270,12 +637,51 @@ class VirtualMachinesPoolPreloader(Thread):
         if config.USE_OPENSTACK:
             platforms.update(config.OPENSTACK_PRELOADED)
 
-        for platform, need in platforms.iteritems():
-            have = already_have.get(platform, 0)
-            if need > have:
-                return platform
+        if self.forecast_time:
+            for platform, rate in self.pool.arrivals.rates().items():
+                expected = int(math.ceil(rate * self.forecast_time))
+                platforms[platform] = max(
+                    platforms.get(platform, 0), expected)
+
+        return platforms
+
+    def need_load(self):
+        """
+        :return: platforms to load now, one vm for every platform
+                 with shortage per round, the biggest shortage first
+        """
+        using = [vm for vm in self.pool.using if vm.is_preloaded()]
+        # clones being created are counted in self.loading
+        already_have = self.pool.count_virtual_machines(
+            vm for vm in self.pool.pool + using if not vm.creating)
+
+        with self.lock:
+            shortage = dict(
+                (platform, need - already_have.get(platform, 0) -
+                 self.loading[platform])
+                for platform, need in self.targets().iteritems()
+            )
+            free = self.parallelism - sum(self.loading.values())
+
+        platforms = []
+        while free > 0:
+            candidates = sorted(
+                (platform for platform, count in shortage.items() if count > 0),
+                key=lambda platform: (-shortage[platform], platform)
+            )
+            if not candidates:
+                break
+            for platform in candidates[:free]:
+                platforms.append(platform)
+                shortage[platform] -= 1
+                free -= 1
+
+        return platforms
 
     def stop(self):
         self.running = False
+        self.wakeup.set()
         self.join(1)
+        self.threads.close()
+        self.maintenance.close()
         log.info("Preloader stopped")